@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import wwCode_apr1_3_instructions_3 as ww
+
+PARAMS = {"mean": 100, "std": 10, "distribution_type": "normal"}
+
+
+def _run(engine, **overrides):
+    kwargs = dict(behavior="stable", params=PARAMS, n_baseline=200, change=None, change_day=None,
+                  analysis_method="shewhart", n_replications=20000, sigma_multiplier=3.0, max_days=2000,
+                  lambda_val=0.2, seed=7, engine=engine)
+    kwargs.update(overrides)
+    return ww.run_simulation(**kwargs)["summary"]
+
+
+@pytest.mark.parametrize("overrides", [
+    dict(analysis_method="shewhart"),
+    dict(analysis_method="ewma"),
+    dict(analysis_method="shewhart", n_baseline=100, sigma_multiplier=2.5),
+    dict(analysis_method="ewma", n_baseline=100, sigma_multiplier=2.5),
+    dict(analysis_method="ewma", max_days=300),  # Mostly censored: the tail terms carry the ARL
+    dict(analysis_method="shewhart", change={"type": "step", "factor": 1.1}, change_day=200),
+])
+def test_analytic_arl_matches_monte_carlo(overrides):
+    analytic, mc = _run("auto", **overrides), _run("montecarlo", **overrides)
+    assert analytic["engine"] == "analytic" and mc["engine"] == "montecarlo"
+    half_width = 1.96 * mc["std"] / np.sqrt(mc["n_replications"])
+    assert abs(analytic["arl"] - mc["arl"]) <= 1.5 * half_width
+    assert analytic["std"] == pytest.approx(mc["std"], rel=0.1)
+
+
+@pytest.mark.parametrize("n_baseline, sigma_multiplier", [(30, 3.0), (40, 2.5), (50, 3.5)])
+def test_tail_dominated_baselines_are_simulated(n_baseline, sigma_multiplier):
+    assert not ww.analytic_supported("stable", PARAMS, n_baseline, None, "shewhart", sigma_multiplier)
+    summary = _run("auto", n_baseline=n_baseline, sigma_multiplier=sigma_multiplier, n_replications=200)
+    assert summary["engine"] == "montecarlo"
+
+
+def test_analytic_variance_counts_censored_extension():
+    run_lengths = {"survival": np.array([1.0, 0.5]), "offset": 0, "tail": 0.5, "tail_sq": 0.5}
+    summary = ww.analytic_summary(run_lengths, 100)
+    # Half the runs alarm on day 1; the other half are censored at 2 and extend by 1 day: 1 or 3
+    assert summary["arl"] == pytest.approx(2.0)
+    assert summary["std"] == pytest.approx(1.0)
@@ -0,0 +1,32 @@
+import numpy as np
+
+import wwCode_apr1_3_instructions_3 as ww
+
+
+def naive_cusum(increments, initial):
+    out, current = np.empty(len(increments)), initial
+    for k, value in enumerate(increments):
+        current = max(0.0, current + value)
+        out[k] = current
+    return out
+
+
+def test_cusum_filter_matches_loop():
+    y = np.random.default_rng(1).normal(0, 1, 1000) - 0.5
+    np.testing.assert_allclose(ww.cusum_filter(y, 0.0), naive_cusum(y, 0.0), atol=1e-9)
+
+
+def test_cusum_filter_batch_with_start_per_row():
+    y = np.random.default_rng(2).normal(0.2, 1, (3, 400)) - 0.5
+    initial = np.array([0.0, 2.5, 10.0])
+    expected = np.array([naive_cusum(row, start) for row, start in zip(y, initial)])
+    np.testing.assert_allclose(ww.cusum_filter(y, initial), expected, atol=1e-9)
+
+
+def test_cusum_series_is_zero_before_monitoring():
+    data = np.random.default_rng(3).normal(100, 10, 60)
+    upper, lower = ww.cusum_series(data, 0.5, 100.0, 10.0, 20)
+    z = (data - 100.0) / 10.0
+    assert not upper[:20].any() and not lower[:20].any()
+    np.testing.assert_allclose(upper[20:], naive_cusum(z[20:] - 0.5, 0.0), atol=1e-9)
+    np.testing.assert_allclose(lower[20:], naive_cusum(-z[20:] - 0.5, 0.0), atol=1e-9)
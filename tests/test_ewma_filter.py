@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import wwCode_apr1_3_instructions_3 as ww
+
+
+def naive_ewma(x, lambda_val, initial):
+    out, current = np.empty(len(x)), initial
+    for k, value in enumerate(x):
+        current = lambda_val * value + (1 - lambda_val) * current
+        out[k] = current
+    return out
+
+
+@pytest.mark.parametrize("lambda_val", [0.01, 0.2, 0.5, 0.99, 1.0])
+def test_ewma_filter_matches_loop(lambda_val):
+    x = np.random.default_rng(1).normal(100, 10, 500)
+    np.testing.assert_allclose(ww.ewma_filter(x, lambda_val, 95.0), naive_ewma(x, lambda_val, 95.0), rtol=1e-10)
+
+
+def test_ewma_filter_small_lambda_across_chunks():
+    # With lambda = 0.01 a chunk holds about 30k days, so this series spans three of them
+    x = np.random.default_rng(2).normal(100, 10, 70_000)
+    assert len(x) > 2 * ww.FILTER_MAX_EXPONENT / -np.log(0.99)
+    np.testing.assert_allclose(ww.ewma_filter(x, 0.01, 100.0), naive_ewma(x, 0.01, 100.0), rtol=1e-10)
+
+
+def test_ewma_filter_batch_with_start_per_row():
+    x = np.random.default_rng(3).normal(100, 10, (4, 300))
+    initial = np.array([90.0, 100.0, 110.0, 105.0])
+    expected = np.array([naive_ewma(row, 0.3, start) for row, start in zip(x, initial)])
+    np.testing.assert_allclose(ww.ewma_filter(x, 0.3, initial), expected, rtol=1e-10)
+
+
+def test_ewma_filter_batch_with_lambda_and_start_per_row():
+    x = np.random.default_rng(3).normal(100, 10, (4, 300))
+    lambdas, initial = np.array([0.05, 0.3, 1.0, 0.7]), np.array([90.0, 100.0, 110.0, 105.0])
+    expected = np.array([naive_ewma(row, lam, start) for row, lam, start in zip(x, lambdas, initial)])
+    np.testing.assert_allclose(ww.ewma_filter(x, lambdas, initial), expected, rtol=1e-10)
+
+
+def test_ewma_and_mc_ewma_series():
+    data = np.random.default_rng(4).normal(100, 10, 50)
+    series, center = ww.ewma_series(data, 0.2, 100.0), ww.mc_ewma_series(data, 0.2, 100.0)
+    assert series[0] == center[0] == 100.0
+    np.testing.assert_allclose(series[1:], naive_ewma(data[1:], 0.2, 100.0), rtol=1e-10)
+    np.testing.assert_allclose(center[1:], naive_ewma(data[:-1], 0.2, 100.0), rtol=1e-10)
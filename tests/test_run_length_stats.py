@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+import wwCode_apr1_3_instructions_3 as ww
+
+
+def _shard(run_lengths, censored, tail_days):
+    n = len(run_lengths)
+    return {"run_lengths": np.array(run_lengths), "out_idx": np.where(censored, -1, 0), "sigmas": np.ones(n),
+            "baseline_means": np.zeros(n), "baseline_period": 30, "lambdas": 0.2, "traces": [],
+            "tail_days": None if tail_days is None else np.array(tail_days, dtype=float)}
+
+
+def test_moments_include_censored_tail():
+    # Runs censored at 10 extend by 4 and 6 days: the corrected run lengths are 3, 5, 5, 14, 16
+    stats = ww.new_run_length_stats()
+    ww.add_shard_stats(stats, _shard([3, 10], [False, True], [0.0, 4.0]))
+    ww.add_shard_stats(stats, _shard([5, 10, 5], [False, True, False], [0.0, 6.0, 0.0]))
+    corrected = np.array([3, 5, 5, 14, 16])
+    low, median, high, mean, variance = ww.run_length_moments(stats)
+    assert (low, median, high) == (3, 5, 10)  # Quantiles stay those of the censored runs
+    assert mean == pytest.approx(np.mean(corrected))
+    assert variance == pytest.approx(np.var(corrected, ddof=1))
+    assert stats["tail_corrected"] and stats["censored"] == 2
+
+
+def test_moments_without_tail_match_numpy():
+    run_lengths = np.random.default_rng(1).geometric(0.01, 3000)
+    stats = ww.new_run_length_stats()
+    for lo in range(0, len(run_lengths), 1024):
+        chunk = run_lengths[lo:lo + 1024]
+        ww.add_shard_stats(stats, _shard(chunk, np.zeros(len(chunk), dtype=bool), None))
+    low, median, high, mean, variance = ww.run_length_moments(stats)
+    assert (low, median, high) == (run_lengths.min(), np.median(run_lengths), run_lengths.max())
+    assert mean == pytest.approx(np.mean(run_lengths))
+    assert variance == pytest.approx(np.var(run_lengths, ddof=1))
+    assert stats["tail_corrected"] is False
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+import wwCode_apr1_3_instructions_3 as ww
+
+WINDOWS = (1, 3, 7)
+
+
+def naive_scan(z, window):
+    """Sum of z over the window ending on each day, scaled by sqrt(its length) while it is partial."""
+    out = np.empty(len(z))
+    for k in range(len(z)):
+        values = z[max(0, k + 1 - window):k + 1]
+        out[k] = values.sum() / np.sqrt(len(values))
+    return out
+
+
+def test_scan_statistics_with_partial_windows():
+    z = np.random.default_rng(1).normal(0, 1, 40)
+    for window, stat in zip(WINDOWS, ww.scan_statistics(z, WINDOWS)):
+        np.testing.assert_allclose(stat, naive_scan(z, window), atol=1e-12)
+
+
+@pytest.mark.parametrize("split", [1, 2, 5, 20])
+def test_scan_statistics_resumes_from_recent_and_seen(split):
+    z = np.random.default_rng(2).normal(0, 1, 30)
+    longest = max(WINDOWS)
+    head = ww.scan_statistics(z[:split], WINDOWS)
+    recent = np.concatenate([np.zeros(longest - 1), z[:split]])[-(longest - 1):]
+    tail = ww.scan_statistics(z[split:], WINDOWS, recent=recent, seen=split)
+    for whole, first, rest in zip(ww.scan_statistics(z, WINDOWS), head, tail):
+        np.testing.assert_allclose(np.concatenate([first, rest]), whole, atol=1e-12)
+
+
+def test_scan_statistics_batch_with_seen_per_row():
+    rng = np.random.default_rng(3)
+    longest, seen = max(WINDOWS), np.array([0, 2, 10])
+    history = rng.normal(0, 1, (3, 10))
+    z = rng.normal(0, 1, (3, 15))
+    recent = np.zeros((3, longest - 1))
+    for row, count in enumerate(seen):
+        taken = history[row, 10 - count:][-(longest - 1):]
+        recent[row, longest - 1 - len(taken):] = taken
+    stats = ww.scan_statistics(z, WINDOWS, recent=recent, seen=seen)
+    for row, count in enumerate(seen):
+        full = np.concatenate([history[row, 10 - count:], z[row]])
+        for window, stat in zip(WINDOWS, stats):
+            expected = naive_scan(full, window)[count:]
+            np.testing.assert_allclose(stat[row], expected, atol=1e-12)
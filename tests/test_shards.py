@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+import wwCode_apr1_3_instructions_3 as ww
+
+PARAMS = {"mean": 100, "std": 10, "distribution_type": "normal"}
+
+
+def _simulate(workers, n_replications=5000, seed=11, **kwargs):
+    return ww.simulate_replications_parallel("stable", PARAMS, 100, None, None, "ewma", n_replications, 3.0, 2000,
+                                             0.2, seed=seed, workers=workers, **kwargs)
+
+
+def _assert_same_stats(a, b):
+    assert a["n"] == b["n"] and a["censored"] == b["censored"]
+    np.testing.assert_array_equal(a["values"], b["values"])
+    np.testing.assert_array_equal(a["counts"], b["counts"])
+    assert a["sigma_sum"] == b["sigma_sum"]
+    assert ww.run_length_moments(a) == ww.run_length_moments(b)
+
+
+@pytest.mark.parametrize("workers", [2, 3])
+def test_results_do_not_depend_on_worker_count(workers):
+    assert 5000 >= ww.PARALLEL_MIN_REPLICATIONS
+    _assert_same_stats(_simulate(1), _simulate(workers))
+
+
+def test_seed_reproduces_a_run():
+    _assert_same_stats(_simulate(1, n_replications=500), _simulate(1, n_replications=500))
+    other = _simulate(1, n_replications=500, seed=12)
+    assert ww.run_length_moments(other) != ww.run_length_moments(_simulate(1, n_replications=500))
+
+
+def test_precision_stop_does_not_depend_on_worker_count():
+    serial = _simulate(1, n_replications=30000, precision=0.03)
+    _assert_same_stats(serial, _simulate(3, n_replications=30000, precision=0.03))
+    assert ww.SHARD_REPLICATIONS < serial["n"] < 30000 and serial["n"] % ww.SHARD_REPLICATIONS == 0
+    assert ww.arl_confidence_interval(serial)[2] <= 0.03
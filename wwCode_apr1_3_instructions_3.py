@@ -1,24 +1,57 @@
-from flask import Flask, render_template_string, request, redirect, url_for, session 
+from flask import Flask, Response, render_template_string, request, redirect, url_for, session, jsonify, g, make_response, send_file
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import io
-import base64
+import sys
+import re
+import csv
+import argparse
 import matplotlib.gridspec as gridspec
 from matplotlib.lines import Line2D
+from matplotlib.ticker import FuncFormatter
 import psutil
+import os
+import platform
+import secrets
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+import time
+import uuid
+import math
+import bisect
+import json
+import pickle
+import cProfile
+import pstats
+import tracemalloc
+import hashlib
+import hmac
+import sqlite3
+import tempfile
+import shutil
+import itertools
+from contextlib import closing, contextmanager
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache, wraps
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # Optional: only needed for Parquet uploads on the multi-site page
+    pq = None
 
 app = Flask(__name__)
 app.secret_key = "your_secret_key_here"  # Replace with a secure key in production
 
-previous_results = []  # Global list to store previous chart results
+render_lock = threading.Lock()  # pyplot keeps global figure state, so charts are rendered one at a time
 
 # Navigation bar HTML (used on all pages) wrapped in a white box
 nav_bar = """
-<div class="menu-box" style="background-color: #fff; border-radius: 8px; padding: 5px 10px; margin: 10px auto; max-width: 250px;">
+<div class="menu-box" style="background-color: #fff; border-radius: 8px; padding: 5px 10px; margin: 10px auto; max-width: 320px;">
   <div class="menu-bar" style="text-align:center; font-size: 1.1em;">
     <a href="/" style="margin-right:10px; text-decoration:none; color:#007BFF; font-weight:bold;">Tool</a>
+    <a href="/sites" style="margin-right:10px; text-decoration:none; color:#007BFF; font-weight:bold;">Sites</a>
     <a href="/instructions" style="text-decoration:none; color:#007BFF; font-weight:bold;">Instructions</a>
   </div>
 </div>
@@ -60,7 +93,7 @@ main_template = """
   </div>
   
   <!-- Main Input Form -->
-  <form class="input-form" method="post" onsubmit="showLoading()">
+  <form class="input-form" method="post" onsubmit="return submitJob(this)">
     <div class="form-container">
       <!-- Column 1: Baseline Data -->
       <div class="column">
@@ -71,7 +104,7 @@ main_template = """
           <option value="stable">Stable</option>
           <option value="trending">Trending</option>
           <option value="periodic">Periodic</option>
-          <option value="randomwalk" disabled style="color: gray;">Random Walk</option>
+          <option value="randomwalk">Random Walk</option>
         </select>
         <div id="stableInputs" style="display:none;" class="sub-section">
           <label>Distribution Type (for stable):</label>
@@ -103,6 +136,14 @@ main_template = """
           <label>Noise Level:</label>
           <input type="number" step="any" name="p_noise">
         </div>
+        <div id="randomwalkInputs" style="display:none;" class="sub-section">
+          <label>Start Value:</label>
+          <input type="number" step="any" name="rw_start">
+          <label>Drift (per day, optional):</label>
+          <input type="number" step="any" name="drift" placeholder="0">
+          <label>Step Standard Deviation:</label>
+          <input type="number" step="any" name="step">
+        </div>
         <div class="sub-section">
           <label>Number of Days for Baseline Data:</label>
           <input type="number" name="n_baseline">
@@ -149,9 +190,23 @@ main_template = """
           <option value="shewhart">Shewhart</option>
           <option value="ewma">EWMA</option>
           <option value="mc-ewma">MC-EWMA</option>
-          <option value="cusum" disabled style="color: gray;">CUSUM</option>
-          <option value="scan" disabled style="color: gray;">SCAN</option>
+          <option value="cusum">CUSUM</option>
+          <option value="scan">SCAN</option>
         </select>
+        <div id="scanInput" style="display:none;" class="sub-section">
+          <label>Window lengths in days (comma-separated, evaluated together):</label>
+          <input type="text" name="scan_windows" value="7, 14, 28">
+        </div>
+        <div id="cusumInput" style="display:none;" class="sub-section">
+          <label>Reference value k (in sigmas, about half the shift to detect):</label>
+          <input type="number" step="any" name="cusum_k" min="0" value="0.5">
+          <label>Sides:</label>
+          <select name="cusum_sides">
+            <option value="both" selected>Two-sided</option>
+            <option value="upper">Upper (increases only)</option>
+            <option value="lower">Lower (decreases only)</option>
+          </select>
+        </div>
         <div id="lambdaInput" style="display:none;" class="sub-section">
           <label>Choose your lambda option:</label>
           <select name="lam_option">
@@ -169,6 +224,18 @@ main_template = """
           <input type="number" name="n_replications">
           <label>How many sigmas would you like to use?</label>
           <input type="number" step="any" name="sigma_multiplier">
+          <label>Monitoring horizon in days (runs without an alarm are stopped here):</label>
+          <input type="number" name="max_days" min="1" value="10000">
+          <label>Random Seed (optional):</label>
+          <input type="number" name="seed" min="0">
+          <label>Target ARL precision, ± % (optional; replications then stop early, up to the number above):</label>
+          <input type="number" step="any" name="precision" min="0">
+          <label>Engine:</label>
+          <select name="engine">
+            <option value="auto" selected>Auto (analytic when available)</option>
+            <option value="montecarlo">Monte Carlo</option>
+          </select>
+          <label><input type="checkbox" name="validate"> Overlay a Monte Carlo check on analytic results</label>
         </div>
       </div>
     </div>
@@ -185,17 +252,32 @@ main_template = """
   <!-- Reanalysis Form in a White Box -->
   <br>
   <div class="form-container" style="max-width:800px; margin:20px auto;">
-    <form class="reanalysis-form" method="post" action="{{ url_for('reanalyze') }}" onsubmit="showLoading()" style="text-align:left;">
+    <form class="reanalysis-form" method="post" action="{{ url_for('reanalyze') }}" onsubmit="return submitJob(this)" style="text-align:left;">
       <h3>Reanalyze</h3>
+      <input type="hidden" name="job_type" value="reanalyze">
       <label>Choose Analysis Method:</label><br>
       <select name="analysis_method" id="analysisSelectRe">
         <option value="" disabled selected>Select method</option>
         <option value="shewhart">Shewhart</option>
         <option value="ewma">EWMA</option>
         <option value="mc-ewma">MC-EWMA</option>
-        <option value="cusum" disabled style="color: gray;">CUSUM</option>
-        <option value="scan" disabled style="color: gray;">SCAN</option>
+        <option value="cusum">CUSUM</option>
+        <option value="scan">SCAN</option>
       </select><br><br>
+      <div id="scanInputRe" style="display:none;">
+        <label>Window lengths in days (comma-separated):</label><br>
+        <input type="text" name="scan_windows" value="7, 14, 28"><br><br>
+      </div>
+      <div id="cusumInputRe" style="display:none;">
+        <label>Reference value k (in sigmas):</label><br>
+        <input type="number" step="any" name="cusum_k" min="0" value="0.5"><br>
+        <label>Sides:</label><br>
+        <select name="cusum_sides">
+          <option value="both" selected>Two-sided</option>
+          <option value="upper">Upper (increases only)</option>
+          <option value="lower">Lower (decreases only)</option>
+        </select><br><br>
+      </div>
       <div id="lambdaInputRe" style="display:none;">
         <label>Choose your lambda option:</label><br>
         <select name="lam_option" id="lam_option_re">
@@ -207,11 +289,17 @@ main_template = """
           <label>Enter your lambda value (0 &lt; lambda &lt; 1):</label><br>
           <input type="number" step="any" name="lambda_val" id="lambda_val_re"><br><br>
         </div>
-        <div id="sigmaInputRe" style="display:none;">
-          <label>Enter sigma multiplier:</label><br>
-          <input type="number" step="any" name="sigma_multiplier_re"><br><br>
-        </div>
       </div>
+      <div id="sigmaInputRe" style="display:none;">
+        <label>Enter sigma multiplier (the decision interval h for CUSUM):</label><br>
+        <input type="number" step="any" name="sigma_multiplier_re"><br><br>
+      </div>
+      <label>Engine:</label><br>
+      <select name="engine">
+        <option value="auto" selected>Auto (analytic when available)</option>
+        <option value="montecarlo">Monte Carlo</option>
+      </select><br>
+      <label><input type="checkbox" name="validate"> Overlay a Monte Carlo check on analytic results</label><br><br>
       <input type="submit" value="Reanalyze">
     </form>
   </div>
@@ -228,7 +316,13 @@ main_template = """
     {% for result in results %}
       <div class="chart">
         <h3>{{ result.title }}</h3>
-        <img src="data:image/png;base64,{{ result.image }}" />
+        <p>{{ result.summary.metric_label }}: {{ "%.2f"|format(result.summary.arl) }} &middot; Median: {{ "%.2f"|format(result.summary.median) }} &middot; Replications: {{ result.summary.n_replications }}</p>
+        <img src="{{ url_for('chart_image', chart_id=result.chart_id) }}" loading="lazy" alt="{{ result.title }}" />
+        <p>Download:
+          {% for fmt in ["csv", "jsonl", "npy", "json"] %}
+            <a href="{{ url_for('export_results', chart_id=result.chart_id, fmt=fmt) }}">{{ fmt }}</a>{% if not loop.last %} &middot;{% endif %}
+          {% endfor %}
+        </p>
       </div>
     {% endfor %}
   </div>
@@ -237,11 +331,42 @@ main_template = """
     function showLoading() { 
       document.getElementById("loading").style.display = "block"; 
     }
+    // Queue the simulation as a background job and poll its progress; fall back to a normal
+    // form post only if the job endpoint cannot be reached. Errors from the server are shown.
+    function submitJob(form) {
+      showLoading();
+      fetch("{{ url_for('submit_job') }}", { method: "POST", body: new FormData(form) })
+        .then(function(response) {
+          return response.json().catch(function() {
+            return { error: "The simulation could not be queued (HTTP " + response.status + ")." };
+          });
+        }, function() { form.submit(); return null; })
+        .then(function(job) {
+          if (job === null) { return; }
+          if (job.error) { document.getElementById("loading").innerText = job.error; return; }
+          pollJob(job.status_url);
+        });
+      return false;
+    }
+    function pollJob(statusUrl) {
+      fetch(statusUrl)
+        .then(function(response) { return response.json(); })
+        .then(function(job) {
+          var loading = document.getElementById("loading");
+          if (job.status === "done") { window.location = "{{ url_for('index') }}"; return; }
+          if (job.status === "failed" || job.error) { loading.innerText = "Simulation failed: " + job.error; return; }
+          var text = "Loading... " + job.replications_done + " / " + job.n_replications + " replications";
+          if (job.partial_arl !== null) { text += " (partial ARL " + job.partial_arl.toFixed(2) + ")"; }
+          loading.innerText = text;
+          setTimeout(function() { pollJob(statusUrl); }, 1000);
+        });
+    }
     document.getElementById('behaviorSelect').addEventListener('change', function(){
       var val = this.value;
       document.getElementById('stableInputs').style.display = (val === 'stable') ? 'block' : 'none';
       document.getElementById('trendingInputs').style.display = (val === 'trending') ? 'block' : 'none';
       document.getElementById('periodicInputs').style.display = (val === 'periodic') ? 'block' : 'none';
+      document.getElementById('randomwalkInputs').style.display = (val === 'randomwalk') ? 'block' : 'none';
     });
     document.querySelector('select[name="induce_change"]').addEventListener('change', function(){
       document.getElementById('changeInputs').style.display = (this.value.toLowerCase() === 'yes') ? 'block' : 'none';
@@ -254,6 +379,8 @@ main_template = """
     document.getElementById('analysisSelect').addEventListener('change', function(){
       var val = this.value;
       document.getElementById('lambdaInput').style.display = (val === 'ewma' || val === 'mc-ewma') ? 'block' : 'none';
+      document.getElementById('cusumInput').style.display = (val === 'cusum') ? 'block' : 'none';
+      document.getElementById('scanInput').style.display = (val === 'scan') ? 'block' : 'none';
     });
     document.querySelector('select[name="lam_option"]').addEventListener('change', function(){
       document.getElementById('manualLambda').style.display = (this.value.toLowerCase() === 'manual') ? 'block' : 'none';
@@ -262,7 +389,9 @@ main_template = """
     document.getElementById('analysisSelectRe').addEventListener('change', function(){
       var val = this.value;
       document.getElementById('lambdaInputRe').style.display = (val === 'ewma' || val === 'mc-ewma') ? 'block' : 'none';
-      document.getElementById('sigmaInputRe').style.display = (val === 'ewma' || val === 'mc-ewma') ? 'block' : 'none';
+      document.getElementById('sigmaInputRe').style.display = (val === 'ewma' || val === 'mc-ewma' || val === 'cusum' || val === 'scan') ? 'block' : 'none';
+      document.getElementById('cusumInputRe').style.display = (val === 'cusum') ? 'block' : 'none';
+      document.getElementById('scanInputRe').style.display = (val === 'scan') ? 'block' : 'none';
     });
     document.getElementById('lam_option_re').addEventListener('change', function(){
       document.getElementById('manualLambdaRe').style.display = (this.value.toLowerCase() === 'manual') ? 'block' : 'none';
@@ -307,6 +436,7 @@ instructions_template = """
           <li><em>Stable:</em> Data generated using a fixed mean and standard deviation. You can choose between a normal or lognormal distribution.</li>
           <li><em>Trending:</em> Data with a linear trend plus noise. Provide a starting value, slope, and noise level.</li>
           <li><em>Periodic:</em> Data that fluctuates periodically. Provide the mean, amplitude, period, and noise level.</li>
+          <li><em>Random Walk:</em> Data that wanders: each day's value is the previous day's plus a random step. Provide a starting value, the standard deviation of the daily step, and optionally a drift added every day. A step change scales the level reached just before the change day; a trending change adds its ramp on top of the walk.</li>
         </ul>
       </li>
       <li>
@@ -322,11 +452,17 @@ instructions_template = """
           <li><em>Shewhart:</em> Monitors individual data points using control limits.</li>
           <li><em>EWMA:</em> Uses an Exponentially Weighted Moving Average, which incorporates a lambda value to weight recent observations.</li>
           <li><em>MC-EWMA:</em> A variation of EWMA where the center line is updated differently. You can also choose to optimize lambda here.</li>
+          <li><em>SCAN:</em> Watches the average of the last few days over several window lengths at once (for example 7, 14 and 28 days) and signals when any window's average moves more than the sigma multiplier times sigma / √(window length) from the baseline mean. Short windows catch sharp surges and long windows catch smaller sustained changes. Early in monitoring, windows use the days available so far.</li>
+          <li><em>CUSUM:</em> A tabular cumulative sum chart that accumulates deviations from the baseline mean beyond a reference value k (in sigmas) and signals when the sum exceeds the decision interval h, which is the sigma multiplier. It is the most sensitive choice for small persistent shifts; k is usually half the shift you want to detect (0.5 for a one-sigma shift) and h around 4 to 5. Choose two-sided, or upper/lower to watch only for increases or decreases.</li>
         </ul>
-        For EWMA and MC-EWMA, you have the option to enter a lambda value manually or use the "optimized" setting, which automatically finds the lambda value that minimizes the squared residual error over the baseline period.
+        For EWMA and MC-EWMA, you have the option to enter a lambda value manually or use the "optimized" setting, which automatically finds, for every replication, the lambda value that minimizes the squared residual error over that replication's own baseline period.
       </li>
       <li>
         <strong>Simulation Parameters:</strong> Specify the number of days for the baseline data, the number of replications, and the sigma multiplier (used to set the control limits).
+        Optionally enter a random seed: the same seed and settings always reproduce the same results, and repeated runs are served instantly from a cache. If you leave it blank, the seed is derived from the scenario settings and shown on the chart: resubmitting the same scenario gives the same results (from the cache), and every method tried on it sees the same simulated data. Enter a different seed for an independent run.
+        With the "Auto" engine, stable normal data with no change or a step change analyzed with Shewhart or a fixed-lambda EWMA is computed analytically instead of simulated: the run-length distribution (scaled to the number of replications) is exact up to small numerical approximations, including the effect of estimating the limits from the baseline. Baselines shorter than 50 days, and settings whose ARL hinges on rare overestimates of sigma, are still simulated. Tick the Monte Carlo check to overlay simulated replications, or choose "Monte Carlo" to always simulate.
+        Simulated results show a 95% confidence interval for the ARL. If you enter a target precision (for example 5 for ±5%), replications run in batches of 1024 and stop as soon as the interval is that narrow; the number of replications then acts as a budget cap, and the chart reports how many were actually needed.
+        Replications with no alarm by the monitoring horizon are stopped there. For stable data analyzed with Shewhart or EWMA (and Shewhart after a step change), the days those runs would still have lasted are computed from each run's own control limits, so the ARL and FAR are not biased low by the horizon and a short horizon (for example 1000 days) gives the same answer much faster; the chart then marks the stopped percentage as "extrapolated". For other settings the ARL only counts days up to the horizon, so choose a horizon well above the expected run length.
       </li>
       <li>
         <strong>Important Note:</strong> The change day must always be greater than the number of days used for baseline data.
@@ -337,6 +473,14 @@ instructions_template = """
       <li>
         <strong>Reanalyze:</strong> Use the reanalysis form to adjust parameters or change the analysis method without re-entering all of the baseline settings.
       </li>
+      <li>
+        <strong>Your Own Sites:</strong> The Sites page monitors real series instead of simulated ones. Upload a CSV (or, when the server has pyarrow installed, Parquet) file with one row per measurement and the columns <em>site</em>, <em>date</em> (for example 2024-03-01) and <em>value</em>; other columns are ignored, blank values count as missing, and repeated measurements of a site on one day are averaged.
+        Each site's limits are estimated from its own first observations (the baseline), and the chosen method then runs over the rest of its series. Charts work on consecutive observations, so sites sampled a few times a week are handled like daily ones. The table lists every site's alarms, with sites in alarm on their latest observation first; open a site's chart to see its series, or download the table as CSV. Change the method or settings above the table to reanalyze without uploading again.
+      </li>
+      <li>
+        <strong>Live Monitoring:</strong> For daily feeds, a monitor keeps each site's chart running on the server, so only the newest samples need to be sent. Create one with a JSON <em>PUT</em> to <em>/api/monitors/&lt;name&gt;</em> holding the same settings as the Sites page (for example {"analysis_method": "ewma", "lambda_val": 0.2, "n_baseline": 30}), then <em>POST</em> {"observations": [{"site": ..., "date": ..., "value": ...}, ...]} to <em>/api/monitors/&lt;name&gt;/observations</em> as samples arrive, thousands of sites at a time if needed.
+        Each site's first observations form its baseline; after that every sample is reported as in control, warning (beyond the limits drawn one sigma closer, like the Shewhart warning lines) or alarm, together with the current limits. A sample with no value only records the date, and samples not dated after a site's latest one are rejected.
+      </li>
     </ol>
     <p>
       Use the navigation links above to return to the main simulation page or to revisit these instructions.
@@ -347,145 +491,343 @@ instructions_template = """
 """
 
 # ---------------------------
-# Simulation Functions (including optimize_lambda)
+# Recursive Filter Kernel (EWMA / MC-EWMA)
+# ---------------------------
+FILTER_MAX_EXPONENT = 300.0  # Largest |log| of the rescaling weights used inside one filter chunk
+
+def ewma_filter(x, lambda_val, initial):
+    """
+    Exponential filter z[k] = lambda * x[k] + (1 - lambda) * z[k-1] with z[-1] = initial, applied
+    along the last axis of x (1-D series or 2-D batch of replications, one row each).
+    lambda_val is a scalar or an array broadcastable to x.shape[:-1] (one lambda per row).
+
+    Uses the closed form z[k] = a^(k+1) * (z[-1] + lambda * sum_j x[j] / a^(j+1)), a = 1 - lambda,
+    evaluated with cumsum over chunks short enough that the weights cannot overflow.
+    """
+    x = np.asarray(x, dtype=float)
+    current = np.array(np.broadcast_to(initial, x.shape[:-1]), dtype=float)
+    lam = np.asarray(lambda_val, dtype=float)
+    n = x.shape[-1]
+    decay = 1.0 - lam
+    passthrough = decay == 0.0
+    if n == 0 or passthrough.all():
+        return x.copy()
+    decay = np.where(passthrough, 1.0, decay)
+    log_decay = np.abs(np.log(np.abs(decay))).max()
+    chunk = n if log_decay == 0.0 else max(1, min(n, int(FILTER_MAX_EXPONENT / log_decay)))
+    # Powers are computed on lambda's own (unbroadcast) shape and broadcast against x
+    powers = decay[..., None] ** np.arange(1, chunk + 1)
+    inverse_powers = 1.0 / powers
+    lam = lam[..., None]
+    out = np.empty_like(x)
+    for lo in range(0, n, chunk):
+        hi = min(lo + chunk, n)
+        weighted = np.cumsum(x[..., lo:hi] * inverse_powers[..., :hi - lo], axis=-1)
+        out[..., lo:hi] = powers[..., :hi - lo] * (current[..., None] + lam * weighted)
+        current = out[..., hi - 1]
+    if passthrough.any():
+        out = np.where(passthrough[..., None], x, out)
+    return out
+
+def ewma_series(data, lambda_val, start):
+    """EWMA chart series: series[0] = start, series[i] = lambda * data[i] + (1 - lambda) * series[i-1]."""
+    data = np.asarray(data, dtype=float)
+    series = np.empty_like(data)
+    series[..., 0] = start
+    series[..., 1:] = ewma_filter(data[..., 1:], lambda_val, start)
+    return series
+
+def mc_ewma_series(data, lambda_val, start):
+    """MC-EWMA center line: series[0] = start, series[i] = lambda * data[i-1] + (1 - lambda) * series[i-1]."""
+    data = np.asarray(data, dtype=float)
+    series = np.empty_like(data)
+    series[..., 0] = start
+    series[..., 1:] = ewma_filter(data[..., :-1], lambda_val, start)
+    return series
+
+# ---------------------------
+# Cumulative Sum Kernel (CUSUM)
+# ---------------------------
+CUSUM_DEFAULT_K = 0.5  # Reference value k in sigma units (tuned to a one-sigma shift)
+CUSUM_SIDES = {"cusum": (True, True), "cusum-upper": (True, False), "cusum-lower": (False, True)}
+
+def cusum_filter(increments, initial):
+    """
+    Tabular CUSUM C[k] = max(0, C[k-1] + y[k]) with C[-1] = initial, applied along the last axis of
+    the increments y (1-D series or 2-D batch of replications, one row each).
+
+    Uses the closed form C[k] = S[k] - min(-initial, min_{j<=k} S[j]) with S the cumulative sum of y,
+    so the resets to zero need no loop over days.
+    """
+    sums = np.cumsum(np.asarray(increments, dtype=float), axis=-1)
+    floor = np.minimum(np.minimum.accumulate(sums, axis=-1), -np.asarray(initial, dtype=float)[..., None])
+    return sums - floor
+
+def cusum_series(data, cusum_k, baseline_mean, sigma, start):
+    """Upper and lower CUSUM series of data in sigma units, zero before day `start` (monitoring start)."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (np.asarray(data, dtype=float) - baseline_mean) / sigma
+    upper = np.zeros_like(z)
+    lower = np.zeros_like(z)
+    upper[..., start:] = cusum_filter(z[..., start:] - cusum_k, np.zeros(z.shape[:-1]))
+    lower[..., start:] = cusum_filter(-z[..., start:] - cusum_k, np.zeros(z.shape[:-1]))
+    return upper, lower
+
+# ---------------------------
+# Windowed-Sum Kernel (SCAN)
+# ---------------------------
+SCAN_DEFAULT_WINDOWS = (7, 14, 28)  # Window lengths in days (weekly, fortnightly, four-weekly)
+SCAN_MAX_WINDOW = 365               # Longest window accepted from the forms
+SCAN_MAX_WINDOWS = 8                # Most window lengths evaluated together
+SCAN_COLORS = ["green", "teal", "olive", "purple", "brown", "darkcyan", "darkgreen", "slategray"]
+
+def scan_statistics(z, windows, recent=None, seen=0):
+    """
+    Standardized moving sums sum(z over the last w days) / sqrt(w) for every window length w, along
+    the last axis of z (1-D series or 2-D batch of replications, one row each).
+
+    `recent` holds the max(windows) - 1 values before z (zeros for days before monitoring) and `seen`
+    the number of monitored days before z (per row or scalar). Windows that still reach back before
+    monitoring are partial and scaled by the square root of their actual length. Every window comes
+    from one cumulative sum, so each day's statistic costs O(1) whatever the window length.
+    Returns a list with one array shaped like z per window.
+    """
+    z = np.asarray(z, dtype=float)
+    longest, n = max(windows), z.shape[-1]
+    if recent is None:
+        recent = np.zeros(z.shape[:-1] + (longest - 1,))
+    sums = np.zeros(z.shape[:-1] + (longest + n,))
+    np.cumsum(np.concatenate([recent, z], axis=-1), axis=-1, out=sums[..., 1:])
+    seen = np.asarray(seen, dtype=float)
+    stats = []
+    for w in windows:
+        window_sum = sums[..., longest:] - sums[..., longest - w:longest - w + n]
+        if seen.min(initial=w) >= w:
+            window_sum /= np.sqrt(w)
+        else:
+            window_sum /= np.sqrt(np.minimum(seen[..., None] + np.arange(1, n + 1), w))
+        stats.append(window_sum)
+    return stats
+
+def scan_means(data, windows, baseline_mean, sigma, start):
+    """
+    Moving means of data over each window from day `start` (monitoring start) on, and the limit
+    half-width per sigma multiplier for each (sigma / sqrt(window length)); NaN before `start`.
+    """
+    data = np.asarray(data, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats = scan_statistics((data[start:] - baseline_mean) / sigma, windows)
+    means = np.full((len(windows), len(data)), np.nan)
+    half_widths = np.full((len(windows), len(data)), np.nan)
+    length = np.arange(1, len(data) - start + 1)
+    for i, w in enumerate(windows):
+        scale = sigma / np.sqrt(np.minimum(length, w))
+        means[i, start:] = baseline_mean + stats[i] * scale
+        half_widths[i, start:] = scale
+    return means, half_widths
+
+# ---------------------------
+# EWMA Control-Limit Tables
+# ---------------------------
+LIMIT_TABLE_HORIZON = 10000   # Default number of days covered by a cached limit table
+DEFAULT_MAX_DAYS = 10000      # Default monitoring horizon; runs still in control are censored there
+MAX_MONITORING_DAYS = 1_000_000
+LIMIT_TABLE_CACHE_SIZE = 256  # Number of (lambda, sigma multiplier, horizon) tables kept
+
+@lru_cache(maxsize=LIMIT_TABLE_CACHE_SIZE)
+def _ewma_limit_table(lambda_val, sigma_multiplier, horizon):
+    """
+    Normalized EWMA limit half-widths sigma_multiplier * sqrt(lambda/(2-lambda) * (1-(1-lambda)^(2i)))
+    for days i = 0..horizon-1, stored only up to the day the factor reaches its asymptotic constant.
+    Returns the read-only prefix, the asymptote and whether the prefix converged.
+    """
+    asymptote = sigma_multiplier * np.sqrt(lambda_val / (2 - lambda_val))
+    decay = abs(1 - lambda_val)
+    if 0 < decay < 1:
+        converged_at = int(np.ceil(np.log(np.finfo(float).eps) / (2 * np.log(decay)))) + 1
+    else:
+        converged_at = horizon if decay else 1
+    n = min(horizon, converged_at)
+    i = np.arange(n)
+    prefix = asymptote * np.sqrt(1 - (1 - lambda_val)**(2 * i))
+    prefix.flags.writeable = False
+    return prefix, asymptote, n == converged_at
+
+def ewma_limit_factors(lambda_val, sigma_multiplier, day0, day1, horizon=LIMIT_TABLE_HORIZON):
+    """
+    EWMA control-limit half-widths in units of sigma for absolute days [day0, day1).
+    A scalar lambda reads from the cached table for (lambda, sigma_multiplier, horizon) and returns
+    the asymptotic constant as a scalar once the factor has converged. One lambda per row, or one
+    starting day per row (day0 and day1 arrays a fixed number of days apart), returns an
+    (n_rows, day1 - day0) array.
+    """
+    if np.ndim(lambda_val) or np.ndim(day0):
+        lam = np.asarray(lambda_val, dtype=float)
+        lam = lam[:, None] if lam.ndim else lam
+        i = np.add.outer(day0, np.arange(np.max(np.subtract(day1, day0))))
+        return sigma_multiplier * np.sqrt(lam/(2 - lam) * (1 - (1 - lam)**(2 * i)))
+    prefix, asymptote, converged = _ewma_limit_table(float(lambda_val), float(sigma_multiplier), int(horizon))
+    if day0 >= len(prefix) and converged:
+        return asymptote
+    if day1 <= len(prefix):
+        return prefix[day0:day1]
+    i = np.arange(max(day0, len(prefix)), day1)
+    tail = (np.full(len(i), asymptote) if converged else
+            sigma_multiplier * np.sqrt(lambda_val/(2 - lambda_val) * (1 - (1 - lambda_val)**(2 * i))))
+    return np.concatenate([prefix[day0:], tail])
+
+# ---------------------------
+# Simulation Functions (including optimize_lambda_batch)
 # ---------------------------
-def generate_behavior_data_sim(behavior, params, n_baseline):
-    x = np.arange(n_baseline)
+def compile_scenario(behavior, params, change, change_day, n_baseline, max_days):
+    """
+    Compile (behavior, params, change, change_day) into precomputed per-day vectors so that the
+    simulated value on absolute day t is
+
+        const[t] + mean_coef[t] * baseline_mean + anchor_coef[t] * anchor + scale[t] * noise
+
+    where baseline_mean is the replication's estimated baseline mean and anchor is the mean of the
+    replication's history over `anchor_window` (used by changes to a trending or random-walk baseline).
+    Days before n_baseline describe the baseline draw; stable lognormal baselines are drawn from
+    `lognormal` = (mu_log, std_log) instead.
+
+    Random-walk scenarios are `integrated`: drift[t] + scale[t] * noise is the day's step, the walk
+    is `level0` plus the cumulative sum of the steps, and the value is the walk plus the const,
+    mean and anchor terms above.
+    """
+    horizon = max(max_days, n_baseline)
+    days = np.arange(horizon, dtype=float)
+    const = np.zeros(horizon)
+    mean_coef = np.zeros(horizon)
+    anchor_coef = np.zeros(horizon)
+    scale = np.zeros(horizon)
+    drift = np.zeros(horizon)
+    lognormal = None
+    anchor_window = None
+    level0 = None
+    base = slice(0, n_baseline)
+    mon = slice(n_baseline, horizon)
     if behavior == 'stable':
         dt = params.get('distribution_type', 'normal')
-        if dt == 'normal':
-            data = np.random.normal(loc=params['mean'], scale=params['std'], size=n_baseline)
-        elif dt == 'lognormal':
+        if dt == 'lognormal':
             m = params['mean']
             s = params['std']
             std_log = np.sqrt(np.log(1 + (s**2) / (m**2)))
             mu_log = np.log(m) - 0.5 * std_log**2
-            data = np.random.lognormal(mean=mu_log, sigma=std_log, size=n_baseline)
-        else:
+            lognormal = (mu_log, std_log)
+        elif dt != 'normal':
             raise ValueError("Unsupported distribution type for stable behavior!")
+        const[base] = params['mean']
+        scale[base] = params['std']
+        mean_coef[mon] = 1.0
+        scale[mon] = params['std']
+        seasonal = 0.0
     elif behavior == 'trending':
         noise = params.get('noise', 1.0)
-        data = params['start'] + params['slope'] * x + np.random.normal(scale=noise, size=n_baseline)
+        const[base] = params['start'] + params['slope'] * days[base]
+        slope = params.get('slope', 0.1)
+        const[mon] = params['start'] + slope * days[mon]
+        scale[:] = noise
+        seasonal = 0.0
     elif behavior == 'periodic':
         noise = params.get('noise', 1.0)
-        data = params['mean'] + params['amplitude'] * np.sin(2 * np.pi * x / params['period']) + np.random.normal(scale=noise, size=n_baseline)
+        const[base] = params['mean'] + params['amplitude'] * np.sin(2 * np.pi * days[base] / params['period'])
+        period = params.get('period', 50)
+        amplitude = params.get('amplitude', 10)
+        seasonal = amplitude * np.sin(2*np.pi*(days % period)/period)
+        const[mon] = seasonal[mon]
+        mean_coef[mon] = 1.0
+        scale[:] = noise
+    elif behavior == 'randomwalk':
+        level0 = params['start']
+        drift[1:] = params.get('drift', 0.0)
+        scale[1:] = params.get('step', 1.0)
+        seasonal = 0.0
     else:
         raise ValueError("Unsupported behavior type!")
-    return list(data)
 
-def calculate_limits_sim(data, sigma_multiplier, analysis_method="shewhart", lambda_val=0.3):
-    mean = np.mean(data)
-    if analysis_method == "mc-ewma":
-        n = len(data)
-        mc_ewma = np.zeros(n)
-        mc_ewma[0] = mean
-        for i in range(1, n):
-            mc_ewma[i] = lambda_val * data[i-1] + (1 - lambda_val) * mc_ewma[i-1]
-        residuals = np.array(data) - mc_ewma
-        MR = np.abs(np.diff(residuals))
-    else:
-        MR = np.abs(np.diff(data))
-    MR_bar = np.mean(MR) if len(MR) > 0 else 0
-    sigma = MR_bar / 1.128
-    return (mean - sigma_multiplier * sigma, mean + sigma_multiplier * sigma), \
-           (mean - (sigma_multiplier - 1) * sigma, mean + (sigma_multiplier - 1) * sigma), mean, sigma
-
-def apply_change_sim(data, change, change_day, params, original_behavior, baseline_mean, sigma, analysis_method, sigma_multiplier, baseline_period, lambda_val):
-    max_days = 10000
-    noise_val = params.get('noise', 1.0)
-    std = params.get('std', None)
-    if original_behavior == 'periodic':
-        period = params.get('period', 50)
-        amplitude = params.get('amplitude', 10)
-    elif original_behavior == 'trending':
-        slope = params.get('slope', 0.1)
-        start = params['start']
-    while len(data) < baseline_period:
-        idx = len(data)
-        if original_behavior == 'stable':
-            new_value = np.random.normal(loc=baseline_mean, scale=std)
-        elif original_behavior == 'periodic':
-            cycle = idx % period
-            new_value = baseline_mean + amplitude * np.sin(2*np.pi*cycle/period) + np.random.normal(scale=noise_val)
-        elif original_behavior == 'trending':
-            new_value = np.random.normal(loc=start + slope * idx, scale=noise_val)
-        data.append(new_value)
-    starting_value = data[change_day - 1] if (original_behavior=='trending' and change and change_day) else None
-    step_change_done = False
-    new_intercept = None
-    out_of_control_index = None
-    ewma_current = baseline_mean
-    if analysis_method == 'mc-ewma':
-        mc_ewma_list = [baseline_mean]
-    while len(data) < max_days:
-        idx = len(data)
-        if change and idx >= (change_day if change_day is not None else baseline_period):
-            if change['type'] == 'step':
-                factor = change['factor']
-                if original_behavior == 'stable':
-                    new_value = np.random.normal(loc=baseline_mean * factor, scale=std)
-                elif original_behavior == 'periodic':
-                    cycle = idx % period
-                    new_value = np.random.normal(loc=baseline_mean * factor, scale=noise_val) + amplitude * np.sin(2*np.pi*cycle/period)
-                elif original_behavior == 'trending':
-                    if not step_change_done:
-                        new_intercept = np.mean(data[-min(5, len(data)):]) * factor
-                        step_change_done = True
-                    new_value = np.random.normal(loc=new_intercept + slope * (idx - change_day), scale=noise_val)
-            elif change['type'] == 'trending':
-                added_slope = change['slope']
-                duration = change['duration']
-                trend_index = idx - change_day
-                if trend_index < duration:
-                    if original_behavior == 'stable':
-                        new_value = np.random.normal(loc=baseline_mean + added_slope * trend_index, scale=std)
-                    elif original_behavior == 'periodic':
-                        cycle = idx % period
-                        new_value = np.random.normal(loc=baseline_mean + added_slope * trend_index, scale=noise_val) + amplitude * np.sin(2*np.pi*cycle/period)
-                    elif original_behavior == 'trending':
-                        new_value = np.random.normal(loc=starting_value + added_slope * trend_index, scale=noise_val)
-                else:
-                    if original_behavior == 'stable':
-                        new_value = np.random.normal(loc=baseline_mean + added_slope * duration, scale=std)
-                    elif original_behavior == 'periodic':
-                        cycle = idx % period
-                        new_value = np.random.normal(loc=baseline_mean + added_slope * duration, scale=noise_val) + amplitude * np.sin(2*np.pi*cycle/period)
-                    elif original_behavior == 'trending':
-                        new_value = np.random.normal(loc=starting_value + added_slope * duration + slope * (idx - (change_day + duration)), scale=noise_val)
-        else:
-            if original_behavior == 'stable':
-                new_value = np.random.normal(loc=baseline_mean, scale=std)
-            elif original_behavior == 'periodic':
-                cycle = idx % period
-                new_value = baseline_mean + amplitude * np.sin(2*np.pi*cycle/period) + np.random.normal(scale=noise_val)
-            elif original_behavior == 'trending':
-                if change and change['type'] == 'step' and step_change_done:
-                    new_value = np.random.normal(loc=new_intercept + slope * (idx - change_day), scale=noise_val)
-                else:
-                    new_value = np.random.normal(loc=start + slope * idx, scale=noise_val)
-        data.append(new_value)
-        if len(data) > baseline_period:
-            i = len(data) - 1
-            if analysis_method == 'shewhart':
-                if new_value > baseline_mean + sigma_multiplier * sigma or new_value < baseline_mean - sigma_multiplier * sigma:
-                    out_of_control_index = i
-                    break
-            elif analysis_method == 'ewma':
-                ewma_current = lambda_val * new_value + (1 - lambda_val) * ewma_current
-                sigma_ewma = sigma * np.sqrt(lambda_val/(2 - lambda_val) * (1 - (1 - lambda_val)**(2 * i)))
-                if ewma_current > baseline_mean + sigma_multiplier * sigma_ewma or ewma_current < baseline_mean - sigma_multiplier * sigma_ewma:
-                    out_of_control_index = i
-                    break
-            elif analysis_method == 'mc-ewma':
-                k = len(mc_ewma_list)
-                mc_current = lambda_val * data[-2] + (1 - lambda_val) * mc_ewma_list[-1]
-                mc_ewma_list.append(mc_current)
-                if new_value > mc_current + sigma_multiplier * sigma or new_value < mc_current - sigma_multiplier * sigma:
-                    out_of_control_index = i
-                    break
-    return data, out_of_control_index
-
-def analyze_data_sim(data, control_limits, warning_limits, baseline_mean, sigma, out_of_control_index, change_day, analysis_method, sigma_multiplier, baseline_period, lambda_val):
+    if change:
+        first = max(n_baseline, change_day)
+        changed = slice(first, horizon)
+        trend_index = days[changed] - change_day
+        if change['type'] == 'step':
+            factor = change['factor']
+            if behavior == 'trending':
+                anchor_window = (first - min(5, first), first)
+                anchor_coef[changed] = factor
+                const[changed] = slope * trend_index
+            elif behavior == 'randomwalk':
+                anchor_window = (first - min(5, first), first)
+                anchor_coef[changed] = factor - 1.0
+            else:
+                mean_coef[changed] = factor
+        elif change['type'] == 'trending':
+            added_slope = change['slope']
+            duration = change['duration']
+            ramp = added_slope * np.minimum(trend_index, duration)
+            if behavior == 'trending':
+                anchor_window = (change_day - 1, change_day)
+                anchor_coef[changed] = 1.0
+                const[changed] = ramp + slope * np.maximum(trend_index - duration, 0)
+            else:
+                const[changed] = ramp + (seasonal[changed] if behavior == 'periodic' else 0.0)
+    return {"const": const, "mean_coef": mean_coef, "anchor_coef": anchor_coef, "scale": scale,
+            "lognormal": lognormal, "anchor_window": anchor_window, "n_baseline": n_baseline,
+            "uses_mean": bool(mean_coef.any()), "uses_anchor": anchor_window is not None,
+            "integrated": level0 is not None, "drift": drift, "level0": level0}
+
+def sample_scenario_baseline(scenario, n_replications, rng=None):
+    """
+    Draw an (n_replications, n_baseline) baseline block from a compiled scenario.
+    rng is a np.random.Generator; None uses the global np.random state.
+    """
+    rng = np.random if rng is None else rng
+    n_baseline = scenario["n_baseline"]
+    if scenario["lognormal"] is not None:
+        mu_log, std_log = scenario["lognormal"]
+        return rng.lognormal(mean=mu_log, sigma=std_log, size=(n_replications, n_baseline))
+    noise = rng.standard_normal((n_replications, n_baseline))
+    if scenario["integrated"]:
+        steps = scenario["drift"][:n_baseline] + scenario["scale"][:n_baseline] * noise
+        return scenario["level0"] + np.cumsum(steps, axis=1, out=steps)
+    return scenario["const"][:n_baseline] + scenario["scale"][:n_baseline] * noise
+
+def sample_scenario_block(scenario, day0, day1, baseline_means, anchors, rng=None, levels=None):
+    """
+    Draw days [day0, day1) for every replication as mean + scale x noise. `anchors` may be None
+    for days before the change, where the anchor coefficient is zero.
+    For integrated scenarios `levels` holds each row's walk on day day0 - 1 (see scenario_levels);
+    the block's steps are cumulated onto it and it is advanced to day day1 - 1 in place.
+    """
+    rng = np.random if rng is None else rng
+    values = scenario["scale"][day0:day1] * rng.standard_normal((len(baseline_means), day1 - day0))
+    if scenario["integrated"] and day1 > day0:
+        values += scenario["drift"][day0:day1]
+        np.cumsum(values, axis=1, out=values)
+        values += levels[:, None]
+        levels[:] = values[:, -1]
+    values += scenario["const"][day0:day1]
+    if scenario["uses_mean"]:
+        values += baseline_means[:, None] * scenario["mean_coef"][day0:day1]
+    if scenario["uses_anchor"] and anchors is not None:
+        values += anchors[:, None] * scenario["anchor_coef"][day0:day1]
+    return values
+
+def scenario_levels(scenario, baseline):
+    """Per-replication walk levels at the end of the baseline for integrated scenarios, else None."""
+    if not scenario["integrated"]:
+        return None
+    return baseline[:, -1].copy()
+
+def scenario_anchors(scenario, history):
+    """Per-replication anchor values taken from the simulated history before the change."""
+    if not scenario["uses_anchor"]:
+        return None
+    lo, hi = scenario["anchor_window"]
+    return history[:, lo:hi].mean(axis=1)
+
+def analyze_data_sim(data, control_limits, warning_limits, baseline_mean, sigma, out_of_control_index, change_day, analysis_method, sigma_multiplier, baseline_period, lambda_val,
+                     cusum_k=CUSUM_DEFAULT_K, scan_windows=SCAN_DEFAULT_WINDOWS):
     plt.figure(figsize=(10, 5))
     if change_day is not None:
         plt.axvline(change_day, color="purple", linestyle="dotted", label="Change Day", zorder=2)
@@ -501,34 +843,49 @@ def analyze_data_sim(data, control_limits, warning_limits, baseline_mean, sigma,
         marker_value = data[out_of_control_index] if out_of_control_index is not None else None
     elif analysis_method == "ewma":
         n = len(data)
-        ewma = np.zeros(n); ewma[0] = baseline_mean
-        ucl = np.zeros(n); lcl = np.zeros(n)
-        for i in range(1, n):
-            ewma[i] = lambda_val * data[i] + (1 - lambda_val) * ewma[i-1]
-        for i in range(n):
-            sigma_ewma = sigma * np.sqrt(lambda_val/(2 - lambda_val) * (1 - (1 - lambda_val)**(2*i)))
-            ucl[i] = baseline_mean + sigma_multiplier * sigma_ewma
-            lcl[i] = baseline_mean - sigma_multiplier * sigma_ewma
+        ewma = ewma_series(data, lambda_val, baseline_mean)
+        width = sigma * np.broadcast_to(ewma_limit_factors(lambda_val, sigma_multiplier, 0, n), (n,))
+        ucl = baseline_mean + width; lcl = baseline_mean - width
         plt.plot(ewma, color="green", zorder=2, label="EWMA")
         plt.plot(ucl, color="red", linestyle="dashed", zorder=2, label="Upper EWMA CL")
         plt.plot(lcl, color="red", linestyle="dashed", zorder=2, label="Lower EWMA CL")
         plt.title(f"EWMA Chart (λ = {lambda_val:.3f}".rstrip('0').rstrip('.') + f", {sigma_multiplier}σ)")
         marker_value = ewma[out_of_control_index] if out_of_control_index is not None else None
     elif analysis_method == "mc-ewma":
-        n = len(data)
-        mc_ewma = np.zeros(n); mc_ewma[0] = baseline_mean
-        ucl = np.zeros(n); lcl = np.zeros(n)
-        for i in range(1, n):
-            mc_ewma[i] = lambda_val * data[i-1] + (1 - lambda_val) * mc_ewma[i-1]
-        for i in range(n):
-            ucl[i] = mc_ewma[i] + sigma_multiplier * sigma
-            lcl[i] = mc_ewma[i] - sigma_multiplier * sigma
+        mc_ewma = mc_ewma_series(data, lambda_val, baseline_mean)
+        ucl = mc_ewma + sigma_multiplier * sigma; lcl = mc_ewma - sigma_multiplier * sigma
         plt.plot(mc_ewma, color="green", zorder=2, label="MC-EWMA")
         plt.plot(ucl, color="red", linestyle="dashed", zorder=2, label="Upper MC-EWMA CL")
         plt.plot(lcl, color="red", linestyle="dashed", zorder=2, label="Lower MC-EWMA CL")
         formatted_lambda = format(lambda_val, '.3f').rstrip('0').rstrip('.')
         plt.title(f"MC-EWMA Chart (λ = {formatted_lambda}, {sigma_multiplier}σ)")
         marker_value = data[out_of_control_index] if out_of_control_index is not None else None
+    elif analysis_method in CUSUM_SIDES:
+        upper_side, lower_side = CUSUM_SIDES[analysis_method]
+        upper, lower = cusum_series(data, cusum_k, baseline_mean, sigma, baseline_period)
+        plt.plot(data, label="Data", zorder=1)
+        if upper_side:
+            plt.plot(baseline_mean + sigma * upper, color="green", zorder=2, label="Upper CUSUM")
+            plt.axhline(baseline_mean + sigma_multiplier * sigma, color="red", linestyle="dashed", label="Upper Decision Interval", zorder=2)
+        if lower_side:
+            plt.plot(baseline_mean - sigma * lower, color="darkgreen", zorder=2, label="Lower CUSUM")
+            plt.axhline(baseline_mean - sigma_multiplier * sigma, color="red", linestyle="dashed", label="Lower Decision Interval", zorder=2)
+        plt.title(f"CUSUM Chart (k = {cusum_k:g}, h = {sigma_multiplier}σ)")
+        if out_of_control_index is not None:
+            i = out_of_control_index
+            marker_value = baseline_mean + sigma * upper[i] if upper_side and upper[i] > sigma_multiplier else baseline_mean - sigma * lower[i]
+    elif analysis_method == "scan":
+        means, half_widths = scan_means(data, scan_windows, baseline_mean, sigma, baseline_period)
+        plt.plot(data, label="Data", zorder=1)
+        for i, w in enumerate(scan_windows):
+            color = SCAN_COLORS[i % len(SCAN_COLORS)]
+            plt.plot(means[i], color=color, zorder=2, label=f"{w}-day Mean")
+            plt.plot(baseline_mean + sigma_multiplier * half_widths[i], color=color, linestyle="dashed", zorder=2)
+            plt.plot(baseline_mean - sigma_multiplier * half_widths[i], color=color, linestyle="dashed", zorder=2)
+        plt.title(f"SCAN Chart (windows {'/'.join(str(w) for w in scan_windows)} days, {sigma_multiplier}σ)")
+        if out_of_control_index is not None:
+            i = np.nanargmax(np.abs(means[:, out_of_control_index] - baseline_mean) / half_widths[:, out_of_control_index])
+            marker_value = means[i, out_of_control_index]
 
     if out_of_control_index is not None:
         run_length = (out_of_control_index - baseline_period) + 1
@@ -536,8 +893,8 @@ def analyze_data_sim(data, control_limits, warning_limits, baseline_mean, sigma,
     plt.legend()
     plt.tight_layout()
      
-def plot_replicates_and_histogram(replications, run_lengths, change_day, analysis_method, sigma_multiplier, baseline_period, n_replications,
-                                  arl_value, metric_label, avg_sigma, avg_change_day, limit_stopped_percentage, lambda_val):
+def plot_replicates_and_histogram(replications, summary, change_day, analysis_method, sigma_multiplier, baseline_period, lambda_val,
+                                  cusum_k=CUSUM_DEFAULT_K, scan_windows=SCAN_DEFAULT_WINDOWS):
     fig = plt.figure(figsize=(14, 8))
     gs = fig.add_gridspec(nrows=2, ncols=3, width_ratios=[0.8, 1, 3])
     
@@ -570,6 +927,24 @@ def plot_replicates_and_histogram(replications, run_lengths, change_day, analysi
             Line2D([0], [0], color="red", lw=2, linestyle="dashed", label="Lower MC-EWMA CL"),
             Line2D([0], [0], marker="o", color="w", markerfacecolor="red", markersize=10, label="Out-of-Control")
         ]
+    elif analysis_method in CUSUM_SIDES:
+        upper_side, lower_side = CUSUM_SIDES[analysis_method]
+        handles = [Line2D([0], [0], color="blue", lw=2, label="Simulated Data")]
+        if upper_side:
+            handles.append(Line2D([0], [0], color="green", lw=2, label="X̄ + σ·CUSUM⁺"))
+        if lower_side:
+            handles.append(Line2D([0], [0], color="darkgreen", lw=2, label="X̄ − σ·CUSUM⁻"))
+        handles += [
+            Line2D([0], [0], color="red", lw=2, linestyle="dashed", label=f"Decision Interval (h = {sigma_multiplier}σ)"),
+            Line2D([0], [0], marker="o", color="w", markerfacecolor="red", markersize=10, label="Out-of-Control")
+        ]
+    elif analysis_method == "scan":
+        handles = [Line2D([0], [0], color="blue", lw=2, label="Simulated Data")]
+        for i, w in enumerate(scan_windows):
+            color = SCAN_COLORS[i % len(SCAN_COLORS)]
+            handles.append(Line2D([0], [0], color=color, lw=2, label=f"{w}-day Mean"))
+            handles.append(Line2D([0], [0], color=color, lw=2, linestyle="dashed", label=f"{w}-day Limits"))
+        handles.append(Line2D([0], [0], marker="o", color="w", markerfacecolor="red", markersize=10, label="Out-of-Control"))
     else:
         handles = []
     legend_ax.legend(handles=handles, loc="center")
@@ -579,7 +954,8 @@ def plot_replicates_and_histogram(replications, run_lengths, change_day, analysi
     for idx, pos in enumerate(rep_positions):
         if idx < len(replications):
             ax = fig.add_subplot(gs[pos[0], pos[1]])
-            data, out_idx, _, _, baseline_mean, sigma = replications[idx]
+            data, out_idx, baseline_mean, sigma = replications[idx]
+            lam = lambda_val[idx] if np.ndim(lambda_val) else lambda_val
             ax.plot(data, color="blue", zorder=1)
             if change_day is not None:
                 ax.axvline(change_day, color="purple", linestyle="dotted", zorder=2)
@@ -593,35 +969,45 @@ def plot_replicates_and_histogram(replications, run_lengths, change_day, analysi
                 ax.axhline(baseline_mean - (sigma_multiplier - 1) * sigma, color="orange", linestyle="dashed", zorder=2)
             elif analysis_method == "ewma":
                 n = len(data)
-                ewma = np.zeros(n)
-                ewma[0] = baseline_mean
-                ucl = np.zeros(n)
-                lcl = np.zeros(n)
-                for i in range(1, n):
-                    ewma[i] = lambda_val * data[i] + (1 - lambda_val) * ewma[i-1]
-                for i in range(n):
-                    sigma_ewma = sigma * np.sqrt(lambda_val/(2 - lambda_val) * (1 - (1 - lambda_val)**(2*i)))
-                    ucl[i] = baseline_mean + sigma_multiplier * sigma_ewma
-                    lcl[i] = baseline_mean - sigma_multiplier * sigma_ewma
+                ewma = ewma_series(data, lam, baseline_mean)
+                width = sigma * np.broadcast_to(ewma_limit_factors(lam, sigma_multiplier, 0, n), (n,))
+                ucl = baseline_mean + width
+                lcl = baseline_mean - width
                 ax.plot(ewma, color="green", zorder=2)
                 ax.plot(ucl, color="red", linestyle="dashed", zorder=2)
                 ax.plot(lcl, color="red", linestyle="dashed", zorder=2)
             elif analysis_method == "mc-ewma":
-                n = len(data)
-                mc_ewma = np.zeros(n)
-                mc_ewma[0] = baseline_mean
-                ucl = np.zeros(n)
-                lcl = np.zeros(n)
-                for i in range(1, n):
-                    mc_ewma[i] = lambda_val * data[i-1] + (1 - lambda_val) * mc_ewma[i-1]
-                for i in range(n):
-                    ucl[i] = mc_ewma[i] + sigma_multiplier * sigma
-                    lcl[i] = mc_ewma[i] - sigma_multiplier * sigma
+                mc_ewma = mc_ewma_series(data, lam, baseline_mean)
+                ucl = mc_ewma + sigma_multiplier * sigma
+                lcl = mc_ewma - sigma_multiplier * sigma
                 ax.plot(mc_ewma, color="green", zorder=2)
                 ax.plot(ucl, color="red", linestyle="dashed", zorder=2)
                 ax.plot(lcl, color="red", linestyle="dashed", zorder=2)
+            elif analysis_method in CUSUM_SIDES:
+                upper_side, lower_side = CUSUM_SIDES[analysis_method]
+                upper, lower = cusum_series(data, cusum_k, baseline_mean, sigma, baseline_period)
+                if upper_side:
+                    ax.plot(baseline_mean + sigma * upper, color="green", zorder=2)
+                    ax.axhline(baseline_mean + sigma_multiplier * sigma, color="red", linestyle="dashed", zorder=2)
+                if lower_side:
+                    ax.plot(baseline_mean - sigma * lower, color="darkgreen", zorder=2)
+                    ax.axhline(baseline_mean - sigma_multiplier * sigma, color="red", linestyle="dashed", zorder=2)
+            elif analysis_method == "scan":
+                means, half_widths = scan_means(data, scan_windows, baseline_mean, sigma, baseline_period)
+                for i in range(len(scan_windows)):
+                    color = SCAN_COLORS[i % len(SCAN_COLORS)]
+                    ax.plot(means[i], color=color, zorder=2)
+                    ax.plot(baseline_mean + sigma_multiplier * half_widths[i], color=color, linestyle="dashed", zorder=2)
+                    ax.plot(baseline_mean - sigma_multiplier * half_widths[i], color=color, linestyle="dashed", zorder=2)
             if out_idx is not None:
-                marker = ewma[out_idx] if analysis_method=="ewma" else data[out_idx]
+                if analysis_method == "scan":
+                    i = np.nanargmax(np.abs(means[:, out_idx] - baseline_mean) / half_widths[:, out_idx])
+                    marker = means[i, out_idx]
+                elif analysis_method in CUSUM_SIDES:
+                    marker = (baseline_mean + sigma * upper[out_idx] if upper[out_idx] > sigma_multiplier
+                              else baseline_mean - sigma * lower[out_idx])
+                else:
+                    marker = ewma[out_idx] if analysis_method=="ewma" else data[out_idx]
                 ax.scatter(out_idx, marker, color="red", s=100, zorder=3)
     
     # Histogram and Text Box in Column 2
@@ -631,84 +1017,798 @@ def plot_replicates_and_histogram(replications, run_lengths, change_day, analysi
     hist_ax = fig.add_subplot(inner_gs[0])
     text_ax = fig.add_subplot(inner_gs[1])
     
-    run_arr = np.array(run_lengths)
-    unique_vals = np.unique(run_arr)
-    if len(unique_vals) <= 10:
-        bins = np.concatenate(([unique_vals[0]-0.5], unique_vals+0.5))
-    else:
-        bins = int(np.ceil(np.sqrt(n_replications)))
-    hist_ax.hist(run_arr, bins=bins, edgecolor="black")
-    hist_ax.set_title("Histogram of Run Lengths")
+    bins, counts = np.asarray(summary["bins"]), np.asarray(summary["counts"])
+    hist_ax.hist(bins[:-1], bins=bins, weights=counts, edgecolor="black")
+    if summary.get("mc_counts") is not None:
+        hist_ax.hist(bins[:-1], bins=bins, weights=np.asarray(summary["mc_counts"]), histtype="step", color="red",
+                     linewidth=1.5, label="Monte Carlo")
+        hist_ax.legend()
+    hist_ax.set_title("Histogram of Run Lengths" if summary.get("engine") != "analytic" else "Run-Length Distribution (expected counts)")
     hist_ax.set_xlabel("Run Length")
     hist_ax.set_ylabel("Frequency")
     
-    stats = (f"Replications: {n_replications}\nMin: {run_arr.min():.2f}\nMedian: {np.median(run_arr):.2f}\nMax: {run_arr.max():.2f}\nARL: {arl_value:.2f}\n")
-    if metric_label=="FAR":
-        stats += f"FAR: {1/arl_value:.4f}\n"
-    stats += f"Avg Sigma: {avg_sigma:.2f}\nChange Day: {int(avg_change_day) if avg_change_day is not None else 'N/A'}\nStopped at 10000: {limit_stopped_percentage:.2f}%"
+    analytic = summary.get("engine") == "analytic"
+    if analytic:
+        stats = f"Engine: analytic\nScaled to: {summary['n_replications']} runs\n"
+    else:
+        stats = f"Replications: {summary['n_replications']}\n"
+        if summary.get("precision"):
+            stats += f"Target: ±{summary['precision']*100:g}% (max {summary['max_replications']})\n"
+    stats += (f"Min: {summary['min']:.2f}\nMedian: {summary['median']:.2f}\nMax: {summary['max']:.2f}\nARL: {summary['arl']:.2f}\n")
+    if not analytic and summary.get("ci_low") is not None:
+        stats += f"95% CI: [{summary['ci_low']:.2f}, {summary['ci_high']:.2f}]\n"
+    if summary["metric_label"]=="FAR":
+        stats += f"FAR: {1/summary['arl']:.4f}\n"
+        if not analytic and summary.get("ci_low") is not None and summary["ci_low"] > 0:
+            stats += f"FAR 95% CI: [{1/summary['ci_high']:.4f}, {1/summary['ci_low']:.4f}]\n"
+    avg_change_day = summary["avg_change_day"]
+    stats += f"Avg Sigma: {summary['avg_sigma']:.2f}\nChange Day: {int(avg_change_day) if avg_change_day is not None else 'N/A'}\nStopped at {summary.get('max_days', DEFAULT_MAX_DAYS)}: {summary['limit_pct']:.2f}%"
+    if summary.get("tail_corrected") and summary["limit_pct"] > 0:
+        stats += " (extrapolated)"
+    if summary.get("mc_arl") is not None:
+        stats += f"\nMC ARL: {summary['mc_arl']:.2f} [{summary['ci_low']:.2f}, {summary['ci_high']:.2f}]"
+        stats += f"\nMC Replications: {summary['mc_replications']}"
+    if summary.get("seed") is not None:
+        stats += f"\nSeed: {summary['seed']}"
     text_ax.text(0.05, 0.95, stats, transform=text_ax.transAxes, verticalalignment="top",
                 bbox=dict(boxstyle="round", facecolor="wheat", alpha=0.5))
     text_ax.axis("off")
     
     plt.tight_layout()
     
-def optimize_lambda(baseline_data, method):
+LAMBDA_GRID = np.arange(0.01, 1.0, 0.01)  # Coarse lambda grid evaluated in one pass
+LAMBDA_TOLERANCE = 1e-6                   # Bracket width at which the refinement stops
+LAMBDA_GRID_MAX_CELLS = 1_000_000         # Cap on rows x grid x days evaluated at once
+GOLDEN_RATIO = (np.sqrt(5) - 1) / 2
+
+def _lambda_sse(data, lambdas, method):
     """
-    Optimize lambda by brute force over the baseline data.
-    For each lambda value between 0.01 and 0.99, compute the EWMA or MC-EWMA series
-    (depending on method) and sum the squared residuals between the series and the data.
-    Returns the lambda that minimizes the error.
+    Sum of squared residuals between each baseline row and its EWMA/MC-EWMA series started at the
+    row's first value. data has shape (..., n) and lambdas broadcasts against data.shape[:-1].
+    """
+    lambdas = np.asarray(lambdas, dtype=float)
+    data = np.broadcast_to(data, np.broadcast_shapes(data.shape[:-1], lambdas.shape) + data.shape[-1:])
+    if method == "mc-ewma":
+        series = mc_ewma_series(data, lambdas, data[..., 0])
+    else:
+        series = ewma_series(data, lambdas, data[..., 0])
+    return np.sum((data - series)**2, axis=-1)
+
+def optimize_lambda_batch(baselines, method, tol=LAMBDA_TOLERANCE):
+    """
+    Optimize lambda for every row of an (n_replications, n_baseline) array in one vectorized pass.
+    The whole LAMBDA_GRID is evaluated as a (rows x grid) array, then each row's bracket around its
+    best grid point is refined by golden-section search until it is narrower than tol.
+    Returns the per-row lambdas and their squared residual errors.
+    """
+    baselines = np.atleast_2d(np.asarray(baselines, dtype=float))
+    n_rows, n = baselines.shape
+    grid = LAMBDA_GRID
+    rows_per_chunk = max(1, LAMBDA_GRID_MAX_CELLS // (len(grid) * max(n, 1)))
+    best = np.empty(n_rows, dtype=np.int64)
+    for lo in range(0, n_rows, rows_per_chunk):
+        chunk = baselines[lo:lo + rows_per_chunk, None, :]
+        best[lo:lo + rows_per_chunk] = np.argmin(_lambda_sse(chunk, grid[None, :], method), axis=1)
+
+    left = grid[np.maximum(best - 1, 0)]
+    right = grid[np.minimum(best + 1, len(grid) - 1)]
+    x1 = right - GOLDEN_RATIO * (right - left)
+    x2 = left + GOLDEN_RATIO * (right - left)
+    f1 = _lambda_sse(baselines, x1, method)
+    f2 = _lambda_sse(baselines, x2, method)
+    while np.max(right - left) > tol:
+        # Rows whose minimum lies right of x1 drop [left, x1); the others drop (x2, right]
+        move = f1 > f2
+        left = np.where(move, x1, left)
+        right = np.where(move, right, x2)
+        new_x1 = np.where(move, x2, right - GOLDEN_RATIO * (right - left))
+        new_x2 = np.where(move, left + GOLDEN_RATIO * (right - left), x1)
+        f_probe = _lambda_sse(baselines, np.where(move, new_x2, new_x1), method)
+        f1, f2 = np.where(move, f2, f_probe), np.where(move, f_probe, f1)
+        x1, x2 = new_x1, new_x2
+    lambdas = (left + right) / 2
+    return lambdas, _lambda_sse(baselines, lambdas, method)
+
+# ---------------------------
+# Batch Replication Engine
+# ---------------------------
+BATCH_BLOCK_DAYS = 256       # Size of the first day-block; later blocks grow geometrically
+BATCH_MAX_BLOCK_DAYS = 4096  # Upper bound on a single day-block
+TRACE_REPLICATIONS = 2       # Number of replications whose full trace is kept for plotting
+
+def calculate_limits_batch(data, analysis_method="shewhart", lambda_val=0.3):
+    """
+    Baseline mean and sigma (average moving range / 1.128, taken on the residuals from the
+    MC-EWMA series for MC-EWMA) of each row of an (n_replications, n_baseline) array.
+    Returns the per-replication baseline means and sigma estimates.
+    """
+    means = data.mean(axis=1)
+    n = data.shape[1]
+    if n < 2:
+        return means, np.zeros(data.shape[0])
+    if analysis_method == "mc-ewma":
+        mc_ewma = mc_ewma_series(data, lambda_val, means)
+        MR = np.abs(np.diff(data - mc_ewma, axis=1))
+    else:
+        MR = np.abs(np.diff(data, axis=1))
+    return means, MR.mean(axis=1) / 1.128
+
+def _detector_init(analysis_method, baseline_means, sigmas, last_values, scan_windows=SCAN_DEFAULT_WINDOWS):
+    """Initial per-replication detector state at the start of monitoring."""
+    if analysis_method == "ewma":
+        return {"ewma": baseline_means.copy()}
+    if analysis_method == "mc-ewma":
+        return {"mc_ewma": baseline_means.copy(), "prev": last_values.copy()}
+    if analysis_method in CUSUM_SIDES:
+        return {"upper": np.zeros(len(baseline_means)), "lower": np.zeros(len(baseline_means))}
+    if analysis_method == "scan":
+        return {"recent": np.zeros((len(baseline_means), max(scan_windows) - 1)), "seen": np.zeros(len(baseline_means))}
+    return {}
+
+def _detector_block(analysis_method, state, block, day0, baseline_means, sigmas, sigma_multiplier, lambda_val,
+                    horizon=LIMIT_TABLE_HORIZON, cusum_k=CUSUM_DEFAULT_K, scan_windows=SCAN_DEFAULT_WINDOWS):
+    """
+    Run one detector over a (n_rows, n_days) block of monitored values starting at absolute
+    day `day0` (a scalar, or one day per row). Returns a boolean alarm mask of the same shape
+    and the statistic that is compared to the limits; `state` is advanced to the end of the block.
+    lambda_val is a scalar or one value per row of the block. For CUSUM, sigma_multiplier is the
+    decision interval h and cusum_k the reference value, both in sigma units. SCAN alarms when any
+    window's standardized sum exceeds sigma_multiplier in absolute value.
+    """
+    bm = baseline_means[:, None]
+    sg = sigmas[:, None]
+    n_days = block.shape[1]
+    if analysis_method == "shewhart":
+        return (block > bm + sigma_multiplier * sg) | (block < bm - sigma_multiplier * sg), block
+    if analysis_method == "ewma":
+        ewma = ewma_filter(block, lambda_val, state["ewma"])
+        state["ewma"] = ewma[:, -1]
+        width = sg * ewma_limit_factors(lambda_val, sigma_multiplier, day0, day0 + n_days, horizon)
+        return (ewma > bm + width) | (ewma < bm - width), ewma
+    if analysis_method == "mc-ewma":
+        lagged = np.concatenate([state["prev"][:, None], block[:, :-1]], axis=1)
+        mc_ewma = ewma_filter(lagged, lambda_val, state["mc_ewma"])
+        state["mc_ewma"], state["prev"] = mc_ewma[:, -1], block[:, -1]
+        return (block > mc_ewma + sigma_multiplier * sg) | (block < mc_ewma - sigma_multiplier * sg), mc_ewma
+    if analysis_method in CUSUM_SIDES:
+        upper_side, lower_side = CUSUM_SIDES[analysis_method]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = (block - bm) / sg
+        upper = cusum_filter(z - cusum_k, state["upper"]) if upper_side else np.zeros_like(z)
+        lower = cusum_filter(-z - cusum_k, state["lower"]) if lower_side else np.zeros_like(z)
+        state["upper"], state["lower"] = upper[:, -1], lower[:, -1]
+        return (upper > sigma_multiplier) | (lower > sigma_multiplier), np.where(upper >= lower, upper, -lower)
+    if analysis_method == "scan":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = (block - bm) / sg
+        stats = scan_statistics(z, scan_windows, state["recent"], state["seen"])
+        largest = stats[0]
+        for window_stat in stats[1:]:
+            largest = np.where(np.abs(window_stat) > np.abs(largest), window_stat, largest)
+        keep_days = state["recent"].shape[1]
+        if keep_days:
+            state["recent"] = np.concatenate([state["recent"], z], axis=1)[:, -keep_days:]
+        state["seen"] = state["seen"] + n_days
+        return np.abs(largest) > sigma_multiplier, largest
+    raise ValueError("Unsupported analysis method!")
+
+def monitor_replications_batch(scenario, baseline, baseline_means, sigmas, baseline_period, analysis_method,
+                               sigma_multiplier, max_days, lambda_val, keep_traces=TRACE_REPLICATIONS, rng=None,
+                               cusum_k=CUSUM_DEFAULT_K, scan_windows=SCAN_DEFAULT_WINDOWS):
+    """
+    Monitoring phase of the batch engine. Extends each baseline row in control up to the first
+    monitored day, then advances through the remaining days in blocks. Each block finds every row's
+    first control-limit crossing with a vectorized mask/argmax, and rows that have alarmed are
+    dropped from later blocks.
+
+    Returns a dict with per-replication `out_idx` (-1 when no alarm before max_days), `run_lengths`,
+    and the full `traces` of the first `keep_traces` replications.
+    """
+    n_replications, n_baseline = baseline.shape
+    start = max(n_baseline, baseline_period)
+    levels = scenario_levels(scenario, baseline)
+    history = np.concatenate([baseline, sample_scenario_block(scenario, n_baseline, start, baseline_means, None, rng, levels)], axis=1)
+    anchors = scenario_anchors(scenario, history)
+
+    out_idx = np.full(n_replications, -1, dtype=np.int64)
+    n_traces = min(keep_traces, n_replications)
+    trace_blocks = [[history[r]] for r in range(n_traces)]
+    rows = np.arange(n_replications)
+    state = _detector_init(analysis_method, baseline_means, sigmas, history[:, -1], scan_windows)
+    day0 = start
+    block_days = BATCH_BLOCK_DAYS
+    while day0 < max_days and len(rows) > 0:
+        day1 = min(day0 + block_days, max_days)
+        row_levels = levels[rows] if levels is not None else None
+        block = sample_scenario_block(scenario, day0, day1, baseline_means[rows],
+                                      anchors[rows] if anchors is not None else None, rng, row_levels)
+        if levels is not None:
+            levels[rows] = row_levels
+        alarms, _ = _detector_block(analysis_method, state, block, day0, baseline_means[rows], sigmas[rows],
+                                    sigma_multiplier, lambda_val[rows] if np.ndim(lambda_val) else lambda_val, max_days,
+                                    cusum_k, scan_windows)
+        hit = alarms.any(axis=1)
+        first = alarms.argmax(axis=1)
+        out_idx[rows[hit]] = day0 + first[hit]
+        for pos in np.flatnonzero(rows < n_traces):
+            trace_blocks[rows[pos]].append(block[pos])
+        keep = ~hit
+        rows = rows[keep]
+        state = {key: value[keep] for key, value in state.items()}
+        day0 = day1
+        block_days = min(2 * block_days, BATCH_MAX_BLOCK_DAYS)
+
+    censored = out_idx < 0
+    run_lengths = np.where(censored, max_days - baseline_period + 1, out_idx - baseline_period + 1)
+    traces = []
+    for r in range(n_traces):
+        trace = np.concatenate(trace_blocks[r])
+        traces.append(trace if censored[r] else trace[:out_idx[r] + 1])
+    return {"out_idx": out_idx, "run_lengths": run_lengths, "traces": traces}
+
+def simulate_replications_batch(behavior, params, n_baseline, change, change_day, analysis_method, n_replications,
+                                sigma_multiplier, max_days, lambda_val, keep_traces=TRACE_REPLICATIONS, optimize_lam=False,
+                                rng=None, cusum_k=CUSUM_DEFAULT_K, scan_windows=SCAN_DEFAULT_WINDOWS):
+    """
+    Simulate all replications at once as a (replications x days) matrix: one vectorized baseline
+    draw per replication, row-wise limits, then monitor_replications_batch.
+    The scenario is compiled once per call. With optimize_lam, each EWMA/MC-EWMA replication uses
+    the lambda optimized on its own baseline instead of lambda_val.
+    `tail_days` holds each censored replication's expected days beyond its censored run length
+    (see censored_tail_days), or is None when they cannot be extrapolated.
+    `timings` holds the seconds spent generating baselines, optimizing lambda and monitoring, and
+    `simulated_days` the days drawn, for the metrics (see record_simulation_metrics).
+    """
+    timings = {}
+    started = time.perf_counter()
+    baseline_period = change_day if (change and change_day is not None) else n_baseline
+    if change and change_day is None:
+        change_day = baseline_period
+    scenario = compile_scenario(behavior, params, change, change_day, n_baseline, max_days)
+    baseline = sample_scenario_baseline(scenario, n_replications, rng)
+    timings["generate"] = time.perf_counter() - started
+    if optimize_lam and analysis_method in ["ewma", "mc-ewma"]:
+        started = time.perf_counter()
+        lambda_val, _ = optimize_lambda_batch(baseline, analysis_method)
+        timings["optimize_lambda"] = time.perf_counter() - started
+    started = time.perf_counter()
+    baseline_means, sigmas = calculate_limits_batch(baseline, analysis_method, lambda_val)
+    result = monitor_replications_batch(scenario, baseline, baseline_means, sigmas, baseline_period, analysis_method,
+                                        sigma_multiplier, max_days, lambda_val, keep_traces, rng, cusum_k, scan_windows)
+    timings["monitor"] = time.perf_counter() - started
+    result.update({"baseline_means": baseline_means, "sigmas": sigmas, "baseline_period": baseline_period,
+                   "lambdas": lambda_val, "timings": timings,
+                   "simulated_days": int(np.where(result["out_idx"] >= 0, result["out_idx"] + 1, max_days).sum())})
+    censored = result["out_idx"] < 0
+    tail = censored_tail_days(behavior, params, change, change_day, analysis_method, sigma_multiplier, max_days,
+                              lambda_val[censored] if np.ndim(lambda_val) else lambda_val,
+                              baseline_means[censored], sigmas[censored])
+    if tail is not None:
+        result["tail_days"] = np.zeros(n_replications)
+        result["tail_days"][censored] = tail
+    else:
+        result["tail_days"] = None
+    return result
+
+# ---------------------------
+# Streaming Run-Length Statistics
+# ---------------------------
+# Run lengths are whole days, so they are tallied exactly as sorted distinct values with a count
+# each. The tally grows with the number of distinct run lengths seen (at most max_days + 1), not
+# with the number of replications, and gives exact moments and quantiles. When the
+# censored runs can be extrapolated past the horizon, their expected extra days are summed
+# separately and folded into the mean and variance (quantiles stay those of the censored runs).
+LAMBDA_HISTOGRAM_RESOLUTION = 10000  # Optimized lambdas are tallied in steps of 1 / resolution
+ARL_CONFIDENCE_Z = 1.96              # Two-sided 95% normal quantile for ARL confidence intervals
+
+def new_run_length_stats():
+    """Empty accumulator for add_shard_stats."""
+    return {"n": 0, "values": np.zeros(0, dtype=np.int64), "counts": np.zeros(0, dtype=np.int64), "censored": 0, "sigma_sum": 0.0,
+            "tail_corrected": None, "tail_sum": 0.0, "tail_sq_sum": 0.0,
+            "lambda_counts": None, "lambda_val": None, "baseline_period": None, "stage_seconds": {}, "simulated_days": 0,
+            "traces": [], "trace_out_idx": [], "trace_means": [], "trace_sigmas": [], "trace_lambdas": []}
+
+def add_shard_stats(stats, shard, keep_traces=TRACE_REPLICATIONS):
+    """
+    Fold a simulate_replications_batch result into the accumulator. Per-replication arrays are
+    reduced to counts and sums; only the first keep_traces traces are retained for plotting.
+    """
+    values, counts = np.unique(shard["run_lengths"], return_counts=True)
+    if len(stats["values"]):
+        values, inverse = np.unique(np.concatenate([stats["values"], values]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([stats["counts"], counts])).astype(np.int64)
+    stats["values"], stats["counts"] = values.astype(np.int64), counts
+    stats["n"] += len(shard["run_lengths"])
+    stats["censored"] += int(np.count_nonzero(shard["out_idx"] < 0))
+    stats["sigma_sum"] += float(np.sum(shard["sigmas"]))
+    stats["baseline_period"] = shard["baseline_period"]
+    for stage, seconds in shard.get("timings", {}).items():
+        stats["stage_seconds"][stage] = stats["stage_seconds"].get(stage, 0.0) + seconds
+    stats["simulated_days"] += shard.get("simulated_days", 0)
+    tail = shard.get("tail_days")
+    if tail is None:
+        stats["tail_corrected"] = False
+        stats["tail_sum"] = stats["tail_sq_sum"] = 0.0
+    elif stats["tail_corrected"] is not False:
+        stats["tail_corrected"] = True
+        stats["tail_sum"] += float(np.sum(tail))
+        stats["tail_sq_sum"] += float(np.dot(tail, tail))
+    lambdas = shard["lambdas"]
+    if np.ndim(lambdas):
+        tally = np.bincount(np.rint(np.asarray(lambdas) * LAMBDA_HISTOGRAM_RESOLUTION).astype(np.int64),
+                            minlength=LAMBDA_HISTOGRAM_RESOLUTION + 1)
+        stats["lambda_counts"] = tally if stats["lambda_counts"] is None else stats["lambda_counts"] + tally
+    else:
+        stats["lambda_val"] = lambdas
+    take = min(keep_traces - len(stats["traces"]), len(shard["traces"]))
+    for idx in range(max(take, 0)):
+        stats["traces"].append(shard["traces"][idx])
+        stats["trace_out_idx"].append(int(shard["out_idx"][idx]))
+        stats["trace_means"].append(shard["baseline_means"][idx])
+        stats["trace_sigmas"].append(shard["sigmas"][idx])
+        stats["trace_lambdas"].append(lambdas[idx] if np.ndim(lambdas) else lambdas)
+    return stats
+
+def _ranked_value(values, counts, rank):
+    """The rank-th smallest (0-based) observation of a tally of sorted distinct values."""
+    return int(values[np.searchsorted(np.cumsum(counts), rank, side="right")])
+
+def run_length_mean(stats):
+    if stats["n"] == 0:
+        return float('inf')
+    return float((np.dot(stats["values"], stats["counts"]) + stats["tail_sum"]) / stats["n"])
+
+def run_length_moments(stats):
+    """
+    Exact (min, median, max, mean, variance) of the accumulated run lengths. The mean and variance
+    include the extrapolated days of censored runs, which all sit at the largest run length.
+    """
+    n, values, counts = stats["n"], stats["values"], stats["counts"]
+    mean = run_length_mean(stats)
+    tail_term = 2 * (values[-1] - mean) * stats["tail_sum"] + stats["tail_sq_sum"] if len(values) else 0.0
+    variance = float((np.dot(counts, (values - mean) ** 2) + tail_term) / (n - 1)) if n > 1 else 0.0
+    median = (_ranked_value(values, counts, (n - 1) // 2) + _ranked_value(values, counts, n // 2)) / 2
+    return _ranked_value(values, counts, 0), median, _ranked_value(values, counts, n - 1), mean, variance
+
+def arl_confidence_interval(stats, z=ARL_CONFIDENCE_Z):
+    """Normal-approximation confidence interval for the ARL: (low, high, relative half-width)."""
+    if stats["n"] < 2:
+        return float('nan'), float('nan'), float('inf')
+    _, _, _, mean, variance = run_length_moments(stats)
+    half_width = z * np.sqrt(variance / stats["n"])
+    return mean - half_width, mean + half_width, half_width / mean
+
+def lambda_summary(stats):
+    """The fixed lambda, or the median of the per-replication optimized lambdas."""
+    counts = stats["lambda_counts"]
+    if counts is None:
+        return stats["lambda_val"]
+    n, steps = int(counts.sum()), np.arange(len(counts))
+    return (_ranked_value(steps, counts, (n - 1) // 2) + _ranked_value(steps, counts, n // 2)) / 2 / LAMBDA_HISTOGRAM_RESOLUTION
+
+def run_length_histogram(stats):
+    """Histogram bin edges and counts of the run lengths (one bin per value when there are at most 10)."""
+    values, weights = stats["values"], stats["counts"]
+    if len(values) <= 10:
+        return np.concatenate(([values[0]-0.5], values+0.5)), weights
+    bins = int(np.ceil(np.sqrt(stats["n"])))
+    counts, edges = np.histogram(values, bins=bins, weights=weights)
+    return edges, counts.astype(np.int64)
+
+# ---------------------------
+# Analytic Run-Length Engine
+# ---------------------------
+# Stable normal data with no change or a step change has a run-length distribution that can be
+# computed directly: geometric for Shewhart, and a Brook-Evans Markov chain for EWMA. Limits are
+# estimated from the baseline just like in the simulation, so the conditional run-length
+# distribution is averaged over the sampling distribution of the estimated sigma (MR-bar / 1.128,
+# approximated by a gamma distribution) and, when a step change scales the estimated mean,
+# of the estimated mean. Long runs come from overestimated sigmas, so short baselines, whose ARL
+# rests on the upper tail of that gamma approximation rather than its bulk, are simulated instead.
+ANALYTIC_SIGMA_NODES = 40         # Quadrature nodes over the estimated sigma
+ANALYTIC_MEAN_NODES = 3           # Gauss-Hermite nodes over the estimated mean (step changes only)
+ANALYTIC_EWMA_STATES = 61         # Markov chain states across the EWMA band (odd); a 2x finer chain
+                                  # is also run and the two are Richardson-extrapolated
+ANALYTIC_EWMA_EXACT_STEPS = 400   # Days propagated exactly before the geometric tail takes over
+ANALYTIC_REQUEST_COST = 1_000_000 # Work units charged to admission control for an analytic request
+ANALYTIC_TAIL_PROBABILITY = 1e-6  # Run lengths beyond this upper quantile are left off the histogram
+ANALYTIC_TAIL_STATES = 31         # Chain states for quasi-stationary EWMA hazards (with a 2x finer chain)
+ANALYTIC_TAIL_NODES = 17          # Chebyshev nodes of a cached EWMA hazard curve over sigma_hat / sigma
+ANALYTIC_MIN_BASELINE = 50        # Shorter baselines are simulated (the gamma shape of sigma_hat is too rough)
+ANALYTIC_MAX_TAIL_SHARE = 0.5     # Simulate when more of the ARL comes from sigma_hat beyond 3 sd above sigma
+TAIL_LAMBDA_RESOLUTION = 200      # Optimized lambdas share hazard curves in steps of 1 / resolution
+TAIL_CURVE_STEP = 0.25            # Hazard curves span sigma_hat / sigma ranges rounded out to this step
+
+def _normal_cdf(x):
+    """Standard normal CDF for arrays (erfc rational approximation, relative error below 1.2e-7)."""
+    z = np.abs(x) / np.sqrt(2)
+    t = 1 / (1 + 0.5 * z)
+    poly = -1.26551223 + t*(1.00002368 + t*(0.37409196 + t*(0.09678418 + t*(-0.18628806 + t*(0.27886807
+            + t*(-1.13520398 + t*(1.48851587 + t*(-0.82215223 + t*0.17087277))))))))
+    upper = 0.5 * t * np.exp(-z*z + poly)
+    return np.where(x >= 0, 1 - upper, upper)
+
+def analytic_supported(behavior, params, n_baseline, change, analysis_method, sigma_multiplier, optimize_lam=False):
+    """Whether analytic_run_lengths covers a configuration (everything else needs Monte Carlo)."""
+    return (behavior == "stable" and params.get("distribution_type", "normal") == "normal"
+            and params.get("std", 0) > 0 and n_baseline >= ANALYTIC_MIN_BASELINE
+            and (change is None or (change["type"] == "step" and change.get("factor") is not None))
+            and (analysis_method == "shewhart" or (analysis_method == "ewma" and not optimize_lam))
+            and _sigma_tail_share(params, n_baseline, change, sigma_multiplier) <= ANALYTIC_MAX_TAIL_SHARE)
+
+def _sigma_tail_share(params, n_baseline, change, sigma_multiplier):
+    """
+    Share of the ARL contributed by sigma estimates more than 3 sd above sigma, taking a Shewhart
+    chart (at the true mean) as a proxy for both detectors.
+    """
+    w, weights = _sigma_estimate_nodes(n_baseline)
+    shift = (change["factor"] - 1) * params.get("mean", 0.0) / params["std"] if change is not None else 0.0
+    p = 1 - _normal_cdf(sigma_multiplier * w - shift) + _normal_cdf(-sigma_multiplier * w - shift)
+    contributions = weights / np.maximum(p, 1e-300)
+    sd = np.sqrt(weights @ (w - 1) ** 2)
+    return float(contributions[w > 1 + 3 * sd].sum() / contributions.sum())
+
+def _sigma_estimate_nodes(n_baseline):
+    """
+    Quadrature nodes and weights for w = sigma_hat / sigma with sigma_hat = MR-bar / 1.128 over
+    n_baseline normal observations. w is modelled as a gamma variable with mean 1 and the exact
+    variance of MR-bar / 1.128 (adjacent moving ranges are correlated).
+    """
+    ranges = n_baseline - 1
+    var_mr, cov_mr = 2 - 4/np.pi, 4/np.pi * (np.sqrt(0.75) + np.pi/12) - 4/np.pi
+    var_w = (ranges * var_mr + 2 * max(ranges - 1, 0) * cov_mr) / ranges**2 / 1.128**2
+    sd = np.sqrt(var_w)
+    w = np.linspace(max(1e-6, 1 - 8*sd), 1 + 8*sd, ANALYTIC_SIGMA_NODES)
+    log_density = (1/var_w - 1) * np.log(w) - w / var_w
+    weights = np.exp(log_density - log_density.max())
+    keep = weights > 1e-12 * weights.max()  # Nodes this far out cannot move the result
+    return w[keep], weights[keep] / weights[keep].sum()
+
+def analytic_run_lengths(behavior, params, n_baseline, change, change_day, analysis_method, sigma_multiplier,
+                         max_days, lambda_val):
+    """
+    Run-length distribution of the configuration, matching the simulation's run-length definition
+    (counted from the baseline period, censored at max_days). Returns {"survival", "offset"} where
+    survival[k] is P(no alarm in the first k monitored days) for k = 0..K and every run length
+    equals offset + (number of monitored days up to the alarm), censored runs offset + K + 1.
+    "tail" is the expected number of days that censored runs would add beyond the horizon, and
+    "tail_sq" the expectation of the square of each censored run's expected extension (the tail
+    terms of run_length_moments).
     """
-    best_lambda = 0
-    best_error = float('inf')
-    baseline_data = np.array(baseline_data)
-    n = len(baseline_data)
-    
-    for lam in np.arange(0.01, 1.0, 0.01):
-        series = np.zeros(n)
-        series[0] = baseline_data[0]
-        if method == "ewma":
-            for i in range(1, n):
-                series[i] = lam * baseline_data[i] + (1 - lam) * series[i-1]
-        elif method == "mc-ewma":
-            for i in range(1, n):
-                series[i] = lam * baseline_data[i-1] + (1 - lam) * series[i-1]
-        else:
-            for i in range(1, n):
-                series[i] = lam * baseline_data[i] + (1 - lam) * series[i-1]
-        residuals = baseline_data - series
-        total_error = np.sum(residuals**2)
-        if total_error < best_error:
-            best_error = total_error
-            best_lambda = lam
-    return best_lambda, best_error
-
-def run_simulation(behavior, params, n_baseline, change, change_day, analysis_method, n_replications, sigma_multiplier, max_days, lambda_val):
     baseline_period = change_day if (change and change_day is not None) else n_baseline
-    run_lengths = []
+    start = max(n_baseline, baseline_period)
+    n_days = max(max_days - start, 0)
+    w, w_weights = _sigma_estimate_nodes(n_baseline)
+    if change is not None:
+        # A step change multiplies the estimated baseline mean, so the shift depends on it
+        x, m_weights = np.polynomial.hermite_e.hermegauss(ANALYTIC_MEAN_NODES)
+        mean_hat = params["mean"] + params["std"] / np.sqrt(n_baseline) * x
+        shift = (change["factor"] - 1) * mean_hat / params["std"]
+        w, shift = np.repeat(w, len(shift)), np.tile(shift, len(w))
+        weights = np.repeat(w_weights, len(m_weights)) * np.tile(m_weights / m_weights.sum(), len(w_weights))
+    else:
+        shift, weights = np.zeros_like(w), w_weights
+    k = np.arange(n_days + 1)
+    if analysis_method == "shewhart":
+        p = 1 - _normal_cdf(sigma_multiplier * w - shift) + _normal_cdf(-sigma_multiplier * w - shift)
+        survival = np.exp(k[None, :] * np.log1p(-np.minimum(p, 1 - 1e-300))[:, None])
+    else:
+        # Brook-Evans discretization error falls off as 1/states^2; extrapolate from two chains
+        coarse, fine = ANALYTIC_EWMA_STATES, 2 * ANALYTIC_EWMA_STATES + 1
+        coarse_survival = _ewma_survival(float(lambda_val), sigma_multiplier, w, shift, weights, start, n_days, coarse)
+        survival = _ewma_survival(float(lambda_val), sigma_multiplier, w, shift, weights, start, n_days, fine)
+        survival += (survival - coarse_survival) / ((fine / coarse)**2 - 1)
+        survival = np.minimum.accumulate(np.clip(survival, 0.0, 1.0), axis=1)
+    # Expected days beyond the horizon: every node's survival decays geometrically by then
+    tail = tail_sq = 0.0
+    if n_days >= 1:
+        decay = np.divide(survival[:, -1], survival[:, -2], out=np.zeros(len(w)), where=survival[:, -2] > 0)
+        extension = decay / np.maximum(1 - decay, 1e-300)
+        tail = float(weights @ (survival[:, -1] * extension))
+        tail_sq = float(weights @ (survival[:, -1] * extension**2))
+    return {"survival": weights @ survival, "offset": start - baseline_period, "tail": tail, "tail_sq": tail_sq}
+
+def _ewma_survival(lambda_val, sigma_multiplier, w, shift, weights, start, n_days, m):
+    """
+    Brook-Evans survival curves of the EWMA statistic in sigma units for each (w, shift) node.
+    Propagation stops early once the weighted survival of every node is negligible.
+    The band +-w * limit factor is split into m cells (m odd); while the time-varying
+    limits are still narrower than the band, cells outside them absorb. The chain is propagated
+    exactly for ANALYTIC_EWMA_EXACT_STEPS days and extended geometrically with the observed decay.
+    """
+    factors = np.broadcast_to(ewma_limit_factors(lambda_val, sigma_multiplier, start, start + max(n_days, 1)), (max(n_days, 1),))
+    half_width = w * factors[-1]
+    edges = half_width[:, None] * np.linspace(-1, 1, m + 1)[None, :]
+    centers = (edges[:, :-1] + edges[:, 1:]) / 2
+    # Q[c, i, j] = P(next EWMA in cell j | current EWMA at center i)
+    z = (edges[:, None, :] - (1 - lambda_val) * centers[:, :, None]) / lambda_val - shift[:, None, None]
+    transition = np.diff(_normal_cdf(z), axis=2)
+    survival = np.ones((len(w), n_days + 1))
+    state = np.zeros((len(w), 1, m))
+    state[:, 0, m // 2] = 1.0
+    exact = min(n_days, ANALYTIC_EWMA_EXACT_STEPS)
+    # Days on which the limits are still too narrow to contain the outermost cell centers
+    narrow_days = np.count_nonzero(factors < factors[-1] * (1 - 1/m))
+    for day in range(exact):
+        state = state @ transition
+        if day < narrow_days:
+            state = np.where(np.abs(centers)[:, None, :] <= (w * factors[day])[:, None, None], state, 0.0)
+        survival[:, day + 1] = state.sum(axis=(1, 2))
+        if day >= narrow_days and (weights * survival[:, day + 1]).max() < 1e-13:
+            exact = day + 1  # Only a negligible tail is left
+            break
+    if n_days > exact:
+        decay = np.divide(survival[:, exact], survival[:, exact - 1], out=np.zeros(len(w)), where=survival[:, exact - 1] > 0)
+        survival[:, exact + 1:] = survival[:, exact, None] * decay[:, None] ** np.arange(1, n_days - exact + 1)
+    return survival
+
+def _ewma_quasi_hazard(lambda_val, sigma_multiplier, w, m):
+    """
+    Daily alarm probability of an in-control EWMA that has been running long enough to forget its
+    start: the exit probability of the Brook-Evans chain on +-w * asymptotic limit (m cells),
+    averaged over its quasi-stationary distribution (the left Perron vector of the chain).
+    Exit probabilities are summed from the tails directly, so tiny hazards keep full precision.
+    """
+    half_width = w * sigma_multiplier * np.sqrt(lambda_val / (2 - lambda_val))
+    edges = half_width[:, None] * np.linspace(-1, 1, m + 1)[None, :]
+    centers = (edges[:, :-1] + edges[:, 1:]) / 2
+    z = (edges[:, None, :] - (1 - lambda_val) * centers[:, :, None]) / lambda_val
+    transition = np.diff(_normal_cdf(z), axis=2)
+    values, vectors = np.linalg.eig(np.swapaxes(transition, 1, 2))
+    perron = np.abs(vectors[np.arange(len(w)), :, values.real.argmax(axis=1)])
+    exit_prob = _normal_cdf(z[:, :, 0]) + _normal_cdf(-z[:, :, -1])
+    return (perron * exit_prob).sum(axis=1) / perron.sum(axis=1)
+
+@lru_cache(maxsize=LIMIT_TABLE_CACHE_SIZE)
+def _ewma_hazard_curve(lambda_val, sigma_multiplier, w_low, w_high):
+    """
+    Chebyshev coefficients of the log quasi-stationary EWMA hazard over w in [w_low, w_high],
+    Richardson-extrapolated from two chain sizes like analytic_run_lengths.
+    """
+    nodes = np.polynomial.chebyshev.chebpts2(ANALYTIC_TAIL_NODES)
+    w = w_low + (nodes + 1) / 2 * (w_high - w_low)
+    coarse, fine = ANALYTIC_TAIL_STATES, 2 * ANALYTIC_TAIL_STATES + 1
+    coarse_hazard = _ewma_quasi_hazard(lambda_val, sigma_multiplier, w, coarse)
+    hazard = _ewma_quasi_hazard(lambda_val, sigma_multiplier, w, fine)
+    hazard += (hazard - coarse_hazard) / ((fine / coarse)**2 - 1)
+    return np.polynomial.chebyshev.chebfit(nodes, np.log(np.maximum(hazard, 1e-300)), ANALYTIC_TAIL_NODES - 1)
+
+def _ewma_hazard(lambda_val, sigma_multiplier, w):
+    """Quasi-stationary EWMA hazards for an array of w from the cached curve covering them."""
+    w_low = max(np.floor(w.min() / TAIL_CURVE_STEP), 1) * TAIL_CURVE_STEP
+    w_high = max(np.ceil(w.max() / TAIL_CURVE_STEP) * TAIL_CURVE_STEP, w_low + TAIL_CURVE_STEP)
+    coefficients = _ewma_hazard_curve(float(lambda_val), float(sigma_multiplier), float(w_low), float(w_high))
+    return np.exp(np.polynomial.chebyshev.chebval(2 * (w - w_low) / (w_high - w_low) - 1, coefficients))
+
+def censored_tail_days(behavior, params, change, change_day, analysis_method, sigma_multiplier, max_days,
+                       lambda_val, baseline_means, sigmas):
+    """
+    Expected number of days that replications still in control at the horizon would add to their
+    censored run lengths, given each one's estimated baseline mean and sigma (and lambda).
+    Stable data is stationary once monitoring starts (and once a step change has happened), so the
+    remaining run length is geometric: exactly for Shewhart, whose daily alarm probability p follows
+    from the estimated limits, and after its start is forgotten for EWMA, whose hazard is the
+    quasi-stationary one of the Brook-Evans chain (no change only). A censored run length counts
+    the first unobserved day, so the extra days are 1/p - 1. Returns None for other configurations.
+    """
+    std = params.get("std", 0)
+    if behavior != "stable" or std <= 0 or analysis_method not in ["shewhart", "ewma"]:
+        return None
+    if change is None:
+        shift = 0.0
+    elif (change["type"] == "step" and change.get("factor") is not None and analysis_method == "shewhart"
+          and (change_day is None or change_day < max_days)):
+        shift = (change["factor"] - 1) * baseline_means / std
+    else:
+        return None
+    w = sigmas / std
+    if len(w) == 0:
+        return np.zeros(0)
+    if analysis_method == "shewhart":
+        hazard = _normal_cdf(shift - sigma_multiplier * w) + _normal_cdf(-sigma_multiplier * w - shift)
+    elif np.ndim(lambda_val):
+        # Optimized lambdas: one cached curve per lambda rounded to 1 / TAIL_LAMBDA_RESOLUTION
+        rounded = np.clip(np.rint(np.asarray(lambda_val) * TAIL_LAMBDA_RESOLUTION), 1, TAIL_LAMBDA_RESOLUTION)
+        hazard = np.empty(len(w))
+        for value in np.unique(rounded):
+            rows = rounded == value
+            hazard[rows] = _ewma_hazard(value / TAIL_LAMBDA_RESOLUTION, sigma_multiplier, w[rows])
+    else:
+        hazard = _ewma_hazard(lambda_val, sigma_multiplier, w)
+    return 1 / np.maximum(hazard, 1e-300) - 1
+
+def analytic_summary(run_lengths, n_replications):
+    """
+    ARL, quantiles, censoring and an expected-frequency histogram (for n_replications runs) from
+    an analytic_run_lengths result, in the same form as the Monte Carlo summary fields.
+    """
+    survival, offset = run_lengths["survival"], run_lengths["offset"]
+    n_days = len(survival) - 1
+    pmf = np.append(-np.diff(survival), survival[-1])   # P(run length = offset + 1 + k)
+    values = offset + 1 + np.arange(n_days + 1)
+    cdf = np.cumsum(pmf)
+    tail, tail_sq = run_lengths.get("tail", 0.0), run_lengths.get("tail_sq", 0.0)
+    arl_value = offset + survival.sum() + tail
+    # Like run_length_moments, censored runs count at values[-1] plus their expected extension
+    second_moment = np.dot(pmf, values.astype(float) ** 2) + 2 * values[-1] * tail + tail_sq
+    variance = max(float(second_moment - arl_value ** 2), 0.0)
+    last = min(int(np.searchsorted(cdf, 1 - ANALYTIC_TAIL_PROBABILITY)), n_days)
+    support = np.flatnonzero(pmf[:last + 1] > 0)
+    low, high = values[support[0]], values[support[-1]]
+    bins = (np.concatenate(([values[support][0] - 0.5], values[support] + 0.5)) if len(support) <= 10
+            else int(np.ceil(np.sqrt(max(n_replications, 1)))))
+    counts, edges = np.histogram(values, bins=bins, range=(low, high), weights=pmf * n_replications)
+    return {"min": float(low), "median": float(values[np.searchsorted(cdf, 0.5)]), "max": float(high),
+            "arl": float(arl_value), "std": float(np.sqrt(variance)), "limit_pct": float(survival[-1] * 100),
+            "bins": edges, "counts": counts}
+
+# ---------------------------
+# Parallel Replications (reproducible per-shard seeding)
+# ---------------------------
+SHARD_REPLICATIONS = 1024  # Fixed shard size, so results do not depend on the worker count
+SIM_WORKERS = int(os.environ.get("WW_SIM_WORKERS", os.cpu_count() or 1))
+PARALLEL_MIN_REPLICATIONS = 4 * SHARD_REPLICATIONS  # Below this, shards run in the request process
+
+_process_pools = {}  # Worker count -> ProcessPoolExecutor, created on first use
+
+def _get_process_pool(workers):
+    if workers not in _process_pools:
+        _process_pools[workers] = ProcessPoolExecutor(max_workers=workers)
+    return _process_pools[workers]
+
+def new_seed():
+    """A fresh user-visible seed for sweeps whose spec has none."""
+    return secrets.randbelow(2**32)
+
+def scenario_seed(behavior, params, n_baseline, change, change_day):
+    """
+    Seed for a form run where none was entered, derived from the scenario settings. Resubmitting the
+    same scenario unseeded reproduces the run (so it is served from the result cache), and detectors
+    tried on one scenario see the same simulated data.
+    """
+    canonical = json.dumps([behavior, params, n_baseline, change, change_day], sort_keys=True, separators=(",", ":"), default=float)
+    return int(hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:8], 16)
+
+def _simulate_shard(task):
+    """Run one shard of replications with its own Generator (top-level so it can be pickled)."""
+    seed_seq, n_replications, keep_traces, args, kwargs = task
+    return simulate_replications_batch(*args, n_replications=n_replications, keep_traces=keep_traces,
+                                       rng=np.random.default_rng(seed_seq), **kwargs)
+
+def shard_tasks(behavior, params, n_baseline, change, change_day, analysis_method, n_replications,
+                sigma_multiplier, max_days, lambda_val, seed=None, optimize_lam=False, keep_traces=TRACE_REPLICATIONS,
+                cusum_k=CUSUM_DEFAULT_K, scan_windows=SCAN_DEFAULT_WINDOWS):
+    """The _simulate_shard tasks for a run; the first shard keeps keep_traces traces."""
+    sizes = [min(SHARD_REPLICATIONS, n_replications - lo) for lo in range(0, n_replications, SHARD_REPLICATIONS)] or [0]
+    streams = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = (behavior, params, n_baseline, change, change_day, analysis_method)
+    kwargs = {"sigma_multiplier": sigma_multiplier, "max_days": max_days, "lambda_val": lambda_val,
+              "optimize_lam": optimize_lam, "cusum_k": cusum_k, "scan_windows": tuple(scan_windows)}
+    return [(stream, size, keep_traces if i == 0 else 0, args, kwargs)
+            for i, (stream, size) in enumerate(zip(streams, sizes))]
+
+def iter_shards(tasks, workers=None, run=None):
+    """
+    Yield shard results in shard order, keeping at most `workers` shards in flight so that
+    consumers such as exports can stream without holding every shard in memory. `run` is the
+    picklable shard function (_simulate_shard by default).
+    """
+    run = _simulate_shard if run is None else run
+    workers = SIM_WORKERS if workers is None else workers
+    if workers <= 1 or len(tasks) < 2:
+        for task in tasks:
+            yield run(task)
+        return
+    pool = _get_process_pool(workers)
+    pending = []
+    try:
+        for task in tasks:
+            pending.append(pool.submit(run, task))
+            if len(pending) >= workers:
+                yield pending.pop(0).result()
+        while pending:
+            yield pending.pop(0).result()
+    finally:
+        for future in pending:  # The consumer stopped early
+            future.cancel()
+
+def simulate_replications_parallel(behavior, params, n_baseline, change, change_day, analysis_method, n_replications,
+                                   sigma_multiplier, max_days, lambda_val, seed=None, optimize_lam=False, workers=None,
+                                   progress=None, precision=None, cusum_k=CUSUM_DEFAULT_K, scan_windows=SCAN_DEFAULT_WINDOWS):
+    """
+    Split the replications into fixed-size shards, give each shard an independent Generator spawned
+    from one SeedSequence(seed), and run the shards across a ProcessPoolExecutor. Because the shard
+    layout and streams depend only on the seed and n_replications, ARL, FAR and the run-length
+    histogram are bit-identical for any worker count. Shards are folded into a run-length
+    accumulator in shard order (see iter_shards and add_shard_stats), so the floating-point sums
+    are added in the same order too, and memory does not grow with n_replications; traces come
+    from the first shard.
+
+    progress, if given, is called as progress(replications_done, partial_arl) after each shard
+    is folded in.
+
+    With a precision, n_replications is only a cap: the run stops after the first shard at which
+    the ARL confidence interval's relative half-width is at most `precision`. Later shards already
+    in flight are discarded, so the stopping point does not depend on the worker count either.
+    Inside a profiled request the shards run in the request's thread, where the profiler sees them.
+    """
+    workers = SIM_WORKERS if workers is None else workers
+    if profiling_active():
+        workers = 1
+    tasks = shard_tasks(behavior, params, n_baseline, change, change_day, analysis_method, n_replications,
+                        sigma_multiplier, max_days, lambda_val, seed, optimize_lam, cusum_k=cusum_k,
+                        scan_windows=scan_windows)
+    stats = new_run_length_stats()
+    for shard in iter_shards(tasks, workers if n_replications >= PARALLEL_MIN_REPLICATIONS else 1):
+        add_shard_stats(stats, shard)
+        if progress is not None:
+            progress(stats["n"], run_length_mean(stats))
+        if precision and arl_confidence_interval(stats)[2] <= precision:
+            break
+    return stats
+
+def uses_analytic_engine(sim_kwargs):
+    """Whether run_simulation(**sim_kwargs) takes the analytic fast path."""
+    return (sim_kwargs.get("engine", "auto") != "montecarlo"
+            and analytic_supported(sim_kwargs["behavior"], sim_kwargs["params"], sim_kwargs["n_baseline"],
+                                   sim_kwargs["change"], sim_kwargs["analysis_method"], sim_kwargs["sigma_multiplier"],
+                                   sim_kwargs["optimize_lam"]))
+
+def run_simulation(behavior, params, n_baseline, change, change_day, analysis_method, n_replications, sigma_multiplier, max_days, lambda_val,
+                   optimize_lam=False, engine="auto", validate=False, precision=None, seed=None, progress=None,
+                   cusum_k=CUSUM_DEFAULT_K, scan_windows=SCAN_DEFAULT_WINDOWS):
+    """
+    Simulate a configuration and return {"title", "arl", "summary", "spec"}. With engine="auto",
+    configurations covered by the analytic engine get their run-length distribution computed
+    directly (only the plotted traces are simulated); validate=True also runs the Monte Carlo
+    replications and overlays them. engine="montecarlo" always simulates.
+    With a precision (relative half-width of the 95% ARL interval), n_replications is a cap and
+    replications stop as soon as the ARL is known that precisely.
+    """
+    analytic = uses_analytic_engine({"behavior": behavior, "params": params, "n_baseline": n_baseline, "change": change,
+                                     "analysis_method": analysis_method, "sigma_multiplier": sigma_multiplier,
+                                     "optimize_lam": optimize_lam, "engine": engine})
+    n_simulated = n_replications if (not analytic or validate) else TRACE_REPLICATIONS
+    stats = simulate_replications_parallel(behavior, params, n_baseline, change, change_day, analysis_method,
+                                           n_simulated, sigma_multiplier, max_days, lambda_val, seed=seed,
+                                           optimize_lam=optimize_lam, progress=progress if n_simulated == n_replications else None,
+                                           precision=precision if n_simulated == n_replications else None, cusum_k=cusum_k,
+                                           scan_windows=scan_windows)
+    record_simulation_metrics(stats)
+    baseline_period = stats["baseline_period"]
     replications = []
-    sigmas = []
-    change_days = []
-    for _ in range(n_replications):
-        data = generate_behavior_data_sim(behavior, params, n_baseline)
-        _, _, baseline_mean, sigma = calculate_limits_sim(data, sigma_multiplier, analysis_method, lambda_val)
-        sigmas.append(sigma)
-        data, out_idx = apply_change_sim(data, change, change_day, params, behavior, baseline_mean, sigma, analysis_method, sigma_multiplier, baseline_period, lambda_val)
-        if out_idx is not None:
-            run_length = (out_idx - baseline_period) + 1
-        else:
-            run_length = (max_days - baseline_period) + 1
-        run_lengths.append(run_length)
-        replications.append((data, out_idx, None, None, baseline_mean, sigma))
-        if change_day is not None:
-            change_days.append(change_day)
-    arl_value = np.mean(run_lengths) if run_lengths else float('inf')
-    avg_sigma = np.mean(sigmas) if sigmas else 0
-    avg_change_day = np.mean(change_days) if change_days else None
-    limit_pct = (sum(1 for r in replications if r[1] is None) / n_replications) * 100
+    for idx, data in enumerate(stats["traces"]):
+        out_idx = stats["trace_out_idx"][idx] if stats["trace_out_idx"][idx] >= 0 else None
+        replications.append((data, out_idx, stats["trace_means"][idx], stats["trace_sigmas"][idx]))
+    rl_min, rl_median, rl_max, arl_value, rl_variance = run_length_moments(stats)
+    avg_sigma = stats["sigma_sum"] / stats["n"] if stats["n"] else 0
+    avg_change_day = change_day if (change_day is not None and n_replications > 0) else None
+    limit_pct = (stats["censored"] / stats["n"]) * 100
     metric_label = "FAR" if change is None else "ARL"
+    bins, counts = run_length_histogram(stats)
+    ci_low, ci_high, _ = arl_confidence_interval(stats)
+    summary = {"n_replications": stats["n"], "min": float(rl_min), "median": float(rl_median),
+               "max": float(rl_max), "arl": float(arl_value), "std": float(np.sqrt(rl_variance)), "metric_label": metric_label,
+               "avg_sigma": float(avg_sigma), "avg_change_day": avg_change_day, "limit_pct": float(limit_pct),
+               "seed": seed, "bins": bins, "counts": counts, "engine": "montecarlo",
+               "ci_low": float(ci_low), "ci_high": float(ci_high), "precision": precision, "max_replications": n_replications,
+               "max_days": max_days, "tail_corrected": bool(stats["tail_corrected"])}
+    if analytic:
+        with stage_timer("analytic"):
+            run_lengths = analytic_run_lengths(behavior, params, n_baseline, change, change_day, analysis_method,
+                                               sigma_multiplier, max_days, lambda_val)
+        summary = dict(summary, **analytic_summary(run_lengths, n_replications),
+                       engine="analytic", avg_sigma=float(params["std"]), n_replications=n_replications, tail_corrected=True,
+                       mc_replications=stats["n"] if validate else None,
+                       mc_arl=float(arl_value) if validate else None)
+        if validate:
+            summary["mc_counts"] = np.histogram(stats["values"], bins=summary["bins"], weights=stats["counts"])[0]
+        arl_value = summary["arl"]
     
-    formatted_lambda = format(lambda_val, '.3f').rstrip('0').rstrip('.')
+    if stats["lambda_counts"] is not None:
+        formatted_lambda = "optimized, median " + format(lambda_summary(stats), '.3f').rstrip('0').rstrip('.')
+    else:
+        formatted_lambda = format(lambda_val, '.3f').rstrip('0').rstrip('.')
     
     if analysis_method == "shewhart":
         chart_title = f"Shewhart Chart ({sigma_multiplier}σ)"
@@ -716,158 +1816,2108 @@ def run_simulation(behavior, params, n_baseline, change, change_day, analysis_me
         chart_title = f"EWMA Chart (λ = {formatted_lambda}, {sigma_multiplier}σ)"
     elif analysis_method == "mc-ewma":
         chart_title = f"MC-EWMA Chart (λ = {formatted_lambda}, {sigma_multiplier}σ)"
+    elif analysis_method in CUSUM_SIDES:
+        sides = {"cusum": "", "cusum-upper": ", upper", "cusum-lower": ", lower"}[analysis_method]
+        chart_title = f"CUSUM Chart (k = {cusum_k:g}, h = {sigma_multiplier}σ{sides})"
+    elif analysis_method == "scan":
+        chart_title = f"SCAN Chart (windows {'/'.join(str(w) for w in scan_windows)} days, {sigma_multiplier}σ)"
     else:
         chart_title = ""
+    if analytic:
+        chart_title += " [analytic]"
     
+    # Everything the chart needs, so it can be rendered later by render_chart_png
+    spec = {"replications": replications, "summary": summary, "change_day": change_day,
+            "analysis_method": analysis_method, "sigma_multiplier": sigma_multiplier,
+            "baseline_period": baseline_period, "cusum_k": cusum_k, "scan_windows": tuple(scan_windows),
+            "lambda_val": np.array(stats["trace_lambdas"]) if stats["lambda_counts"] is not None else stats["lambda_val"]}
+    return {"title": chart_title, "arl": float(arl_value), "summary": summary, "spec": spec}
+
+def render_chart_png(spec):
+    """Render the replicates/histogram chart described by a run_simulation spec to PNG bytes."""
     buf = io.BytesIO()
-    plot_replicates_and_histogram(replications, run_lengths, change_day, analysis_method, sigma_multiplier, baseline_period, n_replications,
-                                  arl_value, metric_label, avg_sigma, avg_change_day, limit_pct, lambda_val)
-    plt.savefig(buf, format="png", dpi=80)
-    buf.seek(0)
-    img_base64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-    plt.close()
-    return img_base64, arl_value, chart_title
+    with render_lock:
+        with stage_timer("plot"):
+            plot_replicates_and_histogram(**spec)
+        with stage_timer("png"):
+            plt.savefig(buf, format="png", dpi=80)
+        plt.close()
+    return buf.getvalue()
 
-@app.route("/", methods=["GET", "POST"])
-def index():
-    global previous_results
-    if request.method == "POST":
-        # --------------------------
-        # Step 1: Block if system is under load
-        # --------------------------
-        mem = psutil.virtual_memory().percent
-        cpu = psutil.cpu_percent(interval=1)
+# ---------------------------
+# Design Sweeps (command line)
+# ---------------------------
+SWEEP_SCENARIO_AXES = ["change_factor", "change_slope", "change_day"]
+SWEEP_DETECTOR_AXES = ["analysis_method", "sigma_multiplier", "lambda_val", "cusum_k", "scan_windows"]
+SWEEP_COLUMNS = ["change_type", "change_factor", "change_slope", "change_day", "analysis_method", "sigma_multiplier",
+                 "lambda", "cusum_k", "scan_windows", "n_replications", "arl", "far", "arl_std", "median_run_length", "censored_fraction", "seed"]
 
-        if mem > 85 or cpu > 85:
-            return render_template_string(
-                "<h2 style='color:red;text-align:center;'> System is under high load. Please try again later.</h2>" + main_template,
-                results=previous_results,
-                full_params_exists=('full_params' in session),
-                nav_bar=nav_bar
-            )
+def expand_sweep_grid(spec):
+    """
+    Expand a sweep spec into [(scenario_kwargs, detectors)]. The spec holds the fixed settings
+    (behavior, params, n_baseline, n_replications, max_days, seed, trend_duration) and a "grid" of
+    axis -> list of values. Scenario axes (change_factor, change_slope, change_day) select the
+    simulated paths; detector axes (analysis_method, sigma_multiplier, lambda_val, which may be
+    "optimized", cusum_k, and scan_windows, a list of window sets or one set) are all evaluated on
+    the same paths. Detectors are (method, sigma_multiplier, lambda setting, cusum_k, scan_windows)
+    tuples; for CUSUM methods sigma_multiplier is the decision interval h. A null change_factor or
+    change_slope means no change, which gives the in-control FAR.
+    """
+    grid = {axis: values if isinstance(values, list) else [values] for axis, values in spec.get("grid", {}).items()}
+    if "scan_windows" in grid and all(isinstance(w, int) for w in grid["scan_windows"]):
+        grid["scan_windows"] = [grid["scan_windows"]]  # A single window set
+    unknown = set(grid) - set(SWEEP_SCENARIO_AXES) - set(SWEEP_DETECTOR_AXES)
+    if unknown:
+        raise ValueError(f"Unknown sweep axes: {', '.join(sorted(unknown))}")
+    changes = []
+    for factor in grid.get("change_factor", []):
+        changes.append(None if factor is None else {"type": "step", "factor": float(factor)})
+    for slope in grid.get("change_slope", []):
+        changes.append(None if slope is None else {"type": "trending", "slope": float(slope),
+                                                   "duration": int(spec.get("trend_duration", spec.get("max_days", DEFAULT_MAX_DAYS)))})
+    change_days = grid.get("change_day", [spec["n_baseline"]])
 
-        # --------------------------
-        # Step 2: Soft cap if replications too high under medium load
-        # --------------------------
-        n_replications_str = request.form.get("n_replications", "0")
-        try:
-            if int(n_replications_str) > 1000 and (mem > 70 or cpu > 70):
-                return render_template_string(
-                    "<h2 style='color:red;text-align:center;'> Too many replications while system is moderately loaded. Please try a smaller number.</h2>" + main_template,
-                    results=previous_results,
-                    full_params_exists=('full_params' in session),
-                    nav_bar=nav_bar
-                )
-        except ValueError:
-            pass  # fallback to error later if needed
+    detectors = []
+    for method in grid.get("analysis_method", ["shewhart"]):
+        if method not in ["shewhart", "ewma", "mc-ewma", "scan", *CUSUM_SIDES]:
+            raise ValueError(f"Unsupported analysis method: {method}")
+        for sigma_multiplier in grid.get("sigma_multiplier", [3.0]):
+            for lambda_val in (grid.get("lambda_val", [0.3]) if method in ["ewma", "mc-ewma"] else [None]):
+                for cusum_k in (grid.get("cusum_k", [CUSUM_DEFAULT_K]) if method in CUSUM_SIDES else [None]):
+                    for windows in (grid.get("scan_windows", [SCAN_DEFAULT_WINDOWS]) if method == "scan" else [None]):
+                        detector = (method, float(sigma_multiplier), lambda_val if lambda_val in (None, "optimized") else float(lambda_val),
+                                    None if cusum_k is None else float(cusum_k), None if windows is None else tuple(sorted(set(int(w) for w in windows))))
+                        if detector not in detectors:
+                            detectors.append(detector)
 
-        fd = request.form.to_dict()
-        try:
-            n_baseline = int(fd.get("n_baseline", "0"))
-            n_replications = int(fd.get("n_replications", "0"))
-            sigma_multiplier = float(fd.get("sigma_multiplier", "0"))
-        except ValueError:
-            n_baseline = n_replications = sigma_multiplier = 0
-        behavior = fd.get("behavior")
-        if behavior == "stable":
-            params = {"mean": float(fd.get("mean", "0")), "std": float(fd.get("std", "0")), "distribution_type": fd.get("dist_type", "normal")}
-        elif behavior == "trending":
-            params = {"start": float(fd.get("start", "0")), "slope": float(fd.get("slope", "0")), "noise": float(fd.get("noise", "0"))}
-        elif behavior == "periodic":
-            params = {"mean": float(fd.get("p_mean", "0")), "amplitude": float(fd.get("amplitude", "0")), "period": int(fd.get("period", "50")), "noise": float(fd.get("p_noise", "0"))}
-        else:
-            params = {}
-        induce = fd.get("induce_change", "no").lower() == "yes"
-        if induce:
-            change_day = int(fd.get("change_day", "0"))
-            ct = fd.get("change_type", "")
-            if ct == "step":
-                factor = float(fd.get("factor", "0")) if fd.get("factor", "").strip() else None
-                change = {"type": "step", "factor": factor}
-            elif ct == "trending":
-                cs = float(fd.get("change_slope", "0")) if fd.get("change_slope", "").strip() else None
-                td = int(fd.get("trend_duration", "0")) if fd.get("trend_duration", "").strip() else None
-                change = {"type": "trending", "slope": cs, "duration": td}
-            else:
-                change = None
-        else:
-            change = None
-            change_day = None
-        analysis_method = fd.get("analysis_method")
-        if analysis_method not in ["shewhart", "ewma", "mc-ewma"]:
-            analysis_method = "shewhart"
-            lambda_val = 0.3
-        else:
-            if analysis_method in ["ewma", "mc-ewma"]:
-                lam_option = fd.get("lam_option", "").strip().lower()
-                if lam_option == "manual":
-                    lambda_val = float(fd.get("lambda_val", "0.3"))
-                elif lam_option == "optimized":
-                    baseline_data = generate_behavior_data_sim(behavior, params, n_baseline)
-                    lambda_val, _ = optimize_lambda(np.array(baseline_data), method=analysis_method)
-                else:
-                    lambda_val = 0.3
+    scenarios = []
+    for change in (changes or [None]):
+        for change_day in (change_days if change else [None]):
+            scenario_kwargs = {"behavior": spec["behavior"], "params": spec["params"], "n_baseline": spec["n_baseline"],
+                               "change": change, "change_day": change_day, "max_days": spec.get("max_days", DEFAULT_MAX_DAYS)}
+            if scenario_kwargs not in [s for s, _ in scenarios]:
+                scenarios.append((scenario_kwargs, detectors))
+    return scenarios
+
+def monitor_detectors_shared(scenario, baseline, baseline_period, detectors, max_days, rng=None):
+    """
+    Run several detectors over the same simulated paths. Each day-block is drawn once for the rows
+    that at least one detector is still monitoring, and every detector then scans its own active
+    rows of it. Returns one simulate_replications_batch-style dict (without traces) per detector.
+    """
+    n_replications, n_baseline = baseline.shape
+    start = max(n_baseline, baseline_period)
+    baseline_means = baseline.mean(axis=1)
+    levels = scenario_levels(scenario, baseline)
+    history = np.concatenate([baseline, sample_scenario_block(scenario, n_baseline, start, baseline_means, None, rng, levels)], axis=1)
+    anchors = scenario_anchors(scenario, history)
+    runs = []
+    limits = {}  # (method, lambda setting) -> (lambdas, sigmas), shared by detectors differing only in sigma_multiplier
+    for analysis_method, sigma_multiplier, lambda_setting, cusum_k, scan_windows in detectors:
+        if (analysis_method, lambda_setting) not in limits:
+            if lambda_setting == "optimized":
+                lambda_val, _ = optimize_lambda_batch(baseline, analysis_method)
             else:
-                lambda_val = 0.3
-        session['full_params'] = {"behavior": behavior, "params": params, "n_baseline": n_baseline,
-                                  "n_replications": n_replications, "sigma_multiplier": sigma_multiplier,
-                                  "change": change, "change_day": change_day, "max_days": 10000}
-        img, arl_value, chart_title = run_simulation(behavior, params, n_baseline, change, change_day,
-                                                     analysis_method, n_replications, sigma_multiplier, 10000, lambda_val)
-        previous_results.append({"image": img, "title": chart_title})
-    return render_template_string(main_template, results=previous_results, full_params_exists=('full_params' in session), nav_bar=nav_bar)
+                lambda_val = 0.3 if lambda_setting is None else lambda_setting
+            limits[(analysis_method, lambda_setting)] = (lambda_val, calculate_limits_batch(baseline, analysis_method, lambda_val)[1])
+        lambda_val, sigmas = limits[(analysis_method, lambda_setting)]
+        runs.append({"method": analysis_method, "sigma_multiplier": sigma_multiplier, "lambda_val": lambda_val,
+                     "cusum_k": CUSUM_DEFAULT_K if cusum_k is None else cusum_k,
+                     "scan_windows": SCAN_DEFAULT_WINDOWS if scan_windows is None else scan_windows, "sigmas": sigmas, "rows": np.arange(n_replications),
+                     "out_idx": np.full(n_replications, -1, dtype=np.int64),
+                     "state": _detector_init(analysis_method, baseline_means, sigmas, history[:, -1],
+                                             SCAN_DEFAULT_WINDOWS if scan_windows is None else scan_windows)})
 
-@app.route("/instructions")
-def instructions():
-    return render_template_string(instructions_template, nav_bar=nav_bar)
+    alive = np.arange(n_replications)
+    day0 = start
+    block_days = BATCH_BLOCK_DAYS
+    while day0 < max_days and len(alive) > 0:
+        day1 = min(day0 + block_days, max_days)
+        alive_levels = levels[alive] if levels is not None else None
+        block = sample_scenario_block(scenario, day0, day1, baseline_means[alive],
+                                      anchors[alive] if anchors is not None else None, rng, alive_levels)
+        if levels is not None:
+            levels[alive] = alive_levels
+        for run in runs:
+            rows = run["rows"]
+            if len(rows) == 0:
+                continue
+            rows_block = block if len(rows) == len(alive) else block[np.searchsorted(alive, rows)]
+            lambda_val = run["lambda_val"]
+            alarms, _ = _detector_block(run["method"], run["state"], rows_block, day0, baseline_means[rows],
+                                        run["sigmas"][rows], run["sigma_multiplier"],
+                                        lambda_val[rows] if np.ndim(lambda_val) else lambda_val, max_days, run["cusum_k"],
+                                        run["scan_windows"])
+            hit = alarms.any(axis=1)
+            run["out_idx"][rows[hit]] = day0 + alarms.argmax(axis=1)[hit]
+            keep = ~hit
+            run["rows"] = rows[keep]
+            run["state"] = {key: value[keep] for key, value in run["state"].items()}
+        alive = np.unique(np.concatenate([run["rows"] for run in runs]))
+        day0 = day1
+        block_days = min(2 * block_days, BATCH_MAX_BLOCK_DAYS)
 
-@app.route("/clear", methods=["POST"])
-def clear():
-    global previous_results
-    previous_results = []
-    return redirect(url_for('index'))
+    results = []
+    for run in runs:
+        out_idx = run["out_idx"]
+        run_lengths = np.where(out_idx < 0, max_days - baseline_period + 1, out_idx - baseline_period + 1)
+        results.append({"out_idx": out_idx, "run_lengths": run_lengths, "traces": [], "baseline_means": baseline_means,
+                        "sigmas": run["sigmas"], "baseline_period": baseline_period, "lambdas": run["lambda_val"]})
+    return results
 
-@app.route("/reanalyze", methods=["GET", "POST"])
-def reanalyze():
-    if 'full_params' not in session:
-        return redirect(url_for('index'))
-    if request.method == "POST":
-        analysis_method = request.form.get("analysis_method")
-        if analysis_method not in ["shewhart", "ewma", "mc-ewma"]:
-            analysis_method = "shewhart"
-            lambda_val = 0.3
-        else:
-            if analysis_method in ["ewma", "mc-ewma"]:
-                lam_option = request.form.get("lam_option", "").strip().lower()
-                if lam_option == "manual":
-                    lambda_val = float(request.form.get("lambda_val", "0.3"))
-                elif lam_option == "optimized":
-                    fp = session['full_params']
-                    behavior, params = fp["behavior"], fp["params"]
-                    n_baseline = fp["n_baseline"]
-                    baseline_data = generate_behavior_data_sim(behavior, params, n_baseline)
-                    lambda_val, _ = optimize_lambda(np.array(baseline_data), method=analysis_method)
-                else:
-                    lambda_val = 0.3
-            else:
-                lambda_val = 0.3
-        sigma_multiplier = float(request.form.get("sigma_multiplier_re", "").strip() or session['full_params'].get("sigma_multiplier", 1))
-        fp = session['full_params']
-        behavior, params = fp["behavior"], fp["params"]
-        n_baseline, n_replications = fp["n_baseline"], fp["n_replications"]
-        change, change_day, max_days = fp["change"], fp["change_day"], fp["max_days"]
-        
-        img, arl_value, chart_title = run_simulation(behavior, params, n_baseline, change, change_day,
-                                                     analysis_method, n_replications, sigma_multiplier, max_days, lambda_val)
-        previous_results.append({"image": img, "title": chart_title})
-        return redirect(url_for('index'))
-    return render_template_string(reanalyze_template, nav_bar=nav_bar)
+def _simulate_sweep_shard(task):
+    """Simulate one shard of a sweep scenario and run all of its detectors on the shared paths."""
+    seed_seq, n_replications, scenario_kwargs, detectors = task
+    rng = np.random.default_rng(seed_seq)
+    change, change_day, n_baseline = scenario_kwargs["change"], scenario_kwargs["change_day"], scenario_kwargs["n_baseline"]
+    baseline_period = change_day if (change and change_day is not None) else n_baseline
+    scenario = compile_scenario(scenario_kwargs["behavior"], scenario_kwargs["params"], change,
+                                baseline_period if change else change_day, n_baseline, scenario_kwargs["max_days"])
+    baseline = sample_scenario_baseline(scenario, n_replications, rng)
+    results = monitor_detectors_shared(scenario, baseline, baseline_period, detectors, scenario_kwargs["max_days"], rng)
+    for (analysis_method, sigma_multiplier, _, _, _), shard in zip(detectors, results):
+        censored = shard["out_idx"] < 0
+        lambdas = shard["lambdas"]
+        tail = censored_tail_days(scenario_kwargs["behavior"], scenario_kwargs["params"], change, change_day, analysis_method,
+                                  sigma_multiplier, scenario_kwargs["max_days"], lambdas[censored] if np.ndim(lambdas) else lambdas,
+                                  shard["baseline_means"][censored], shard["sigmas"][censored])
+        if tail is not None:
+            shard["tail_days"] = np.zeros(n_replications)
+            shard["tail_days"][censored] = tail
+    return results
 
-reanalyze_template = """
-<!DOCTYPE html>
-<html>
-<head>
-  <title>Wastewatch - Reanalyze</title>
+def run_sweep(spec, workers=None, progress=None):
+    """
+    Run every grid point of a sweep spec and return one SWEEP_COLUMNS row per (scenario, detector).
+    Shards are spread over the process pool and folded in order, so results do not depend on the
+    worker count. Every scenario uses the same shard seeds, so scenarios are compared on common
+    random numbers, and detectors within a scenario share the same paths.
+    """
+    workers = SIM_WORKERS if workers is None else workers
+    scenarios = expand_sweep_grid(spec)
+    n_replications = int(spec["n_replications"])
+    seed = spec.get("seed")
+    seed = new_seed() if seed is None else int(seed)
+    sizes = [min(SHARD_REPLICATIONS, n_replications - lo) for lo in range(0, n_replications, SHARD_REPLICATIONS)]
+    streams = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(si, (stream, size, scenario_kwargs, detectors))
+             for si, (scenario_kwargs, detectors) in enumerate(scenarios) for stream, size in zip(streams, sizes)]
+    stats = {(si, di): new_run_length_stats() for si, (_, detectors) in enumerate(scenarios) for di in range(len(detectors))}
+
+    def _record(si, shard_results):
+        for di, shard in enumerate(shard_results):
+            add_shard_stats(stats[(si, di)], shard, keep_traces=0)
+        if progress is not None:
+            progress(sum(s["n"] for s in stats.values()), len(stats) * n_replications)
+
+    for (si, _), shard_results in zip(tasks, iter_shards([task for _, task in tasks], workers, _simulate_sweep_shard)):
+        _record(si, shard_results)
+
+    rows = []
+    for si, (scenario_kwargs, detectors) in enumerate(scenarios):
+        change = scenario_kwargs["change"]
+        for di, (analysis_method, sigma_multiplier, lambda_val, cusum_k, scan_windows) in enumerate(detectors):
+            s = stats[(si, di)]
+            _, median, _, arl_value, variance = run_length_moments(s)
+            if lambda_val == "optimized":
+                lambda_val = f"optimized (median {lambda_summary(s):.3f})"
+            rows.append({"change_type": change["type"] if change else "none",
+                         "change_factor": change.get("factor") if change else None,
+                         "change_slope": change.get("slope") if change else None,
+                         "change_day": scenario_kwargs["change_day"], "analysis_method": analysis_method,
+                         "sigma_multiplier": sigma_multiplier, "lambda": lambda_val, "cusum_k": cusum_k,
+                         "scan_windows": None if scan_windows is None else "/".join(str(w) for w in scan_windows), "n_replications": s["n"],
+                         "arl": arl_value, "far": 1 / arl_value if change is None else None,
+                         "arl_std": float(np.sqrt(variance)), "median_run_length": median,
+                         "censored_fraction": s["censored"] / s["n"] if s["n"] else None, "seed": seed})
+    return rows
+
+def write_sweep_table(rows, path):
+    """Write sweep rows as CSV, or as JSON when path ends in .json; "-" writes CSV to stdout."""
+    if path.endswith(".json"):
+        with open(path, "w") as fh:
+            json.dump(rows, fh, indent=2, default=float)
+        return
+    fh = sys.stdout if path == "-" else open(path, "w", newline="")
+    try:
+        writer = csv.DictWriter(fh, fieldnames=SWEEP_COLUMNS)
+        writer.writeheader()
+        writer.writerows({key: ("" if value is None else value) for key, value in row.items()} for row in rows)
+    finally:
+        if fh is not sys.stdout:
+            fh.close()
+
+def sweep_main(argv):
+    """Command line: python wwCode_apr1_3_instructions_3.py sweep SPEC.json [-o table.csv] [--workers N]."""
+    parser = argparse.ArgumentParser(prog="wastewatch sweep", description="Run an ARL/FAR sweep over a design grid.")
+    parser.add_argument("spec", help="JSON sweep spec (fixed settings plus a 'grid' of axis -> values)")
+    parser.add_argument("-o", "--output", default="-", help="Output table (.csv or .json); default CSV to stdout")
+    parser.add_argument("--workers", type=int, default=None, help="Simulation processes (default WW_SIM_WORKERS)")
+    parser.add_argument("--seed", type=int, default=None, help="Override the spec's seed")
+    args = parser.parse_args(argv)
+    with open(args.spec) as fh:
+        spec = json.load(fh)
+    if args.seed is not None:
+        spec["seed"] = args.seed
+
+    def progress(done, total):
+        print(f"\r{done}/{total} replications", end="", file=sys.stderr, flush=True)
+
+    started = time.time()
+    rows = run_sweep(spec, workers=args.workers, progress=progress)
+    print(f"\n{len(rows)} grid points in {time.time() - started:.1f}s", file=sys.stderr)
+    write_sweep_table(rows, args.output)
+    return 0
+
+# ---------------------------
+# Benchmark Suite (command line: python wwCode_apr1_3_instructions_3.py bench)
+# ---------------------------
+BENCH_BEHAVIORS = {
+    "stable": {"mean": 100.0, "std": 10.0, "distribution_type": "normal"},
+    "trending": {"start": 100.0, "slope": 0.05, "noise": 10.0},
+    "periodic": {"mean": 100.0, "amplitude": 10.0, "period": 50, "noise": 10.0},
+    "randomwalk": {"start": 100.0, "drift": 0.0, "step": 1.0},
+}
+BENCH_CHANGES = {"none": None, "step": {"type": "step", "factor": 1.2},
+                 "trending": {"type": "trending", "slope": 0.5, "duration": 30}}
+BENCH_METHODS = ["shewhart", "ewma", "mc-ewma", "cusum", "scan"]
+BENCH_SIZES = {"small": 256, "large": 8192}  # Replications per case
+BENCH_STAGES = ["generate", "monitor", "optimize_lambda", "plot", "png"]
+BENCH_N_BASELINE = 100
+BENCH_CHANGE_DAY = 150
+BENCH_MAX_DAYS = 5000
+BENCH_SIGMA_MULTIPLIER = 3.0
+BENCH_LAMBDA = 0.3
+BENCH_SEED = 2024                   # Every repeat of a case replays the same random numbers
+BENCH_REPEATS = 3
+BENCH_HISTORY_PATH = os.environ.get("WW_BENCH_HISTORY", "wastewatch_bench.jsonl")
+BENCH_REGRESSION_RATIO = 1.25       # Best-of-repeats time above baseline x this is a regression
+BENCH_NOISE_SECONDS = 0.005         # Slowdowns smaller than this are ignored as timer noise
+
+def bench_cases(sizes=None, pattern=None):
+    """
+    The benchmark grid as (name, behavior, change name, method, size name) tuples, every behavior x
+    change type x method x replication count; `pattern` is a regex the "behavior/change/method/size"
+    name must contain.
+    """
+    cases = []
+    for behavior in BENCH_BEHAVIORS:
+        for change_name in BENCH_CHANGES:
+            for method in BENCH_METHODS:
+                for size in (sizes or BENCH_SIZES):
+                    name = f"{behavior}/{change_name}/{method}/{size}"
+                    if pattern is None or re.search(pattern, name):
+                        cases.append((name, behavior, change_name, method, size))
+    return cases
+
+def run_bench_case(behavior, change_name, method, size, repeats=BENCH_REPEATS):
+    """
+    Time one case's stages `repeats` times with the same seed. Returns {stage: [seconds, ...]} and
+    the simulated days per repeat. generate covers compiling the scenario and drawing the baselines,
+    monitor the limits plus the monitoring phase, and optimize_lambda the batch lambda search (EWMA
+    methods only). plot (building the figure) and png (encoding it) are timed for the first
+    behavior at the small size only: the histogram arrives pre-binned, so rendering depends on the
+    method and change but not on the replication count or the baseline's shape.
+    """
+    params, change = BENCH_BEHAVIORS[behavior], BENCH_CHANGES[change_name]
+    change_day = BENCH_CHANGE_DAY if change else None
+    baseline_period = change_day or BENCH_N_BASELINE
+    n_replications = BENCH_SIZES[size]
+    times = {}
+    days = 0
+    for _ in range(repeats):
+        rng = np.random.default_rng(BENCH_SEED)
+        started = time.perf_counter()
+        scenario = compile_scenario(behavior, params, change, change_day, BENCH_N_BASELINE, BENCH_MAX_DAYS)
+        baseline = sample_scenario_baseline(scenario, n_replications, rng)
+        times.setdefault("generate", []).append(time.perf_counter() - started)
+        if method in ["ewma", "mc-ewma"]:
+            started = time.perf_counter()
+            optimize_lambda_batch(baseline, method)
+            times.setdefault("optimize_lambda", []).append(time.perf_counter() - started)
+        started = time.perf_counter()
+        baseline_means, sigmas = calculate_limits_batch(baseline, method, BENCH_LAMBDA)
+        result = monitor_replications_batch(scenario, baseline, baseline_means, sigmas, baseline_period, method,
+                                            BENCH_SIGMA_MULTIPLIER, BENCH_MAX_DAYS, BENCH_LAMBDA, rng=rng)
+        times.setdefault("monitor", []).append(time.perf_counter() - started)
+        days = int(result["run_lengths"].sum()) + n_replications * baseline_period
+    if behavior == next(iter(BENCH_BEHAVIORS)) and size == min(BENCH_SIZES, key=BENCH_SIZES.get):
+        spec = run_simulation(behavior, params, BENCH_N_BASELINE, change, change_day, method, n_replications,
+                              BENCH_SIGMA_MULTIPLIER, BENCH_MAX_DAYS, BENCH_LAMBDA, engine="montecarlo", seed=BENCH_SEED)["spec"]
+        for _ in range(repeats):
+            with render_lock:
+                started = time.perf_counter()
+                plot_replicates_and_histogram(**spec)
+                plotted = time.perf_counter()
+                plt.savefig(io.BytesIO(), format="png", dpi=80)
+                times.setdefault("plot", []).append(plotted - started)
+                times.setdefault("png", []).append(time.perf_counter() - plotted)
+                plt.close()
+    return times, days
+
+def run_bench(cases, repeats=BENCH_REPEATS, progress=None):
+    """Run the given bench_cases and return {case name: {"days", stage: {"min", "median"}}}."""
+    results = {}
+    for idx, (name, behavior, change_name, method, size) in enumerate(cases):
+        times, days = run_bench_case(behavior, change_name, method, size, repeats)
+        results[name] = {"days": days}
+        for stage, seconds in times.items():
+            results[name][stage] = {"min": float(np.min(seconds)), "median": float(np.median(seconds))}
+        if progress:
+            progress(idx + 1, len(cases), name)
+    return results
+
+def load_bench_history(path):
+    """All runs recorded in a benchmark history file (one JSON object per line), oldest first."""
+    if not os.path.exists(path):
+        return []
+    with open(path) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+def compare_bench(current, baseline, ratio=BENCH_REGRESSION_RATIO, noise=BENCH_NOISE_SECONDS):
+    """
+    Compare two runs' best-of-repeats times for every (case, stage) both contain. Returns rows of
+    (case, stage, baseline seconds, current seconds, current / baseline, regressed).
+    """
+    rows = []
+    for name, stages in current.items():
+        for stage in BENCH_STAGES:
+            if stage not in stages or stage not in baseline.get(name, {}):
+                continue
+            before, after = baseline[name][stage]["min"], stages[stage]["min"]
+            regressed = after > before * ratio and after - before > noise
+            rows.append((name, stage, before, after, after / before if before > 0 else float("inf"), regressed))
+    return rows
+
+def bench_main(argv):
+    """
+    Command line: python wwCode_apr1_3_instructions_3.py bench [--quick] [--filter REGEX]
+    [--baseline LABEL]. Appends the run to the history file and compares it with the baseline run
+    (by default the latest one timing any of the same cases); exits with status 1 when any stage
+    regressed.
+    """
+    parser = argparse.ArgumentParser(prog="wastewatch bench", description="Time the simulation, optimization and rendering hot paths.")
+    parser.add_argument("--quick", action="store_true", help="Small replication counts only")
+    parser.add_argument("--filter", default=None, help="Only cases whose behavior/change/method/size name matches this regex")
+    parser.add_argument("--repeats", type=int, default=BENCH_REPEATS, help="Timed repeats per case (best and median are kept)")
+    parser.add_argument("--history", default=BENCH_HISTORY_PATH, help="JSON-lines history file (default WW_BENCH_HISTORY)")
+    parser.add_argument("--label", default=None, help="Name for this run, e.g. a commit or branch")
+    parser.add_argument("--baseline", default=None, help="Label of the run to compare against (default: the latest run)")
+    parser.add_argument("--threshold", type=float, default=BENCH_REGRESSION_RATIO, help="Slowdown ratio reported as a regression")
+    parser.add_argument("--no-save", action="store_true", help="Compare only; do not append this run to the history")
+    args = parser.parse_args(argv)
+
+    cases = bench_cases(["small"] if args.quick else None, args.filter)
+    if not cases:
+        parser.error("no benchmark cases match")
+    history = load_bench_history(args.history)
+    candidates = [run for run in history if args.baseline is None or run.get("label") == args.baseline]
+    if args.baseline is not None and not candidates:
+        parser.error(f"no run labelled {args.baseline!r} in {args.history}")
+    candidates = [run for run in candidates if any(case[0] in run["results"] for case in cases)]
+
+    def progress(done, total, name):
+        print(f"\r{done}/{total} {name:<40}", end="", file=sys.stderr, flush=True)
+
+    started = time.time()
+    results = run_bench(cases, max(1, args.repeats), progress)
+    print(f"\n{len(cases)} cases in {time.time() - started:.1f}s", file=sys.stderr)
+    run = {"label": args.label, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(),
+           "numpy": np.__version__, "machine": platform.machine(), "cpu_count": os.cpu_count(),
+           "repeats": max(1, args.repeats), "results": results}
+    if not args.no_save:
+        with open(args.history, "a") as fh:
+            fh.write(json.dumps(run) + "\n")
+
+    if not candidates:
+        for name, stages in results.items():
+            print(name, " ".join(f"{stage}={stages[stage]['min'] * 1000:.1f}ms" for stage in BENCH_STAGES if stage in stages))
+        return 0
+    baseline = candidates[-1]
+    rows = compare_bench(results, baseline["results"], args.threshold)
+    print(f"baseline: {baseline.get('label') or baseline['timestamp']}")
+    print(f"{'case':<36} {'stage':<16} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name, stage, before, after, ratio, regressed in rows:
+        print(f"{name:<36} {stage:<16} {before * 1000:>8.1f}ms {after * 1000:>8.1f}ms {ratio:>6.2f}x{'  REGRESSION' if regressed else ''}")
+    regressions = sum(row[-1] for row in rows)
+    print(f"{regressions} regression(s) over {args.threshold:g}x in {len(rows)} timings", file=sys.stderr)
+    return 1 if regressions else 0
+
+# ---------------------------
+# Result Cache (content-addressed, with request coalescing)
+# ---------------------------
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("WW_RESULT_CACHE_BYTES", 64 * 1024 * 1024))  # In-memory size cap
+RESULT_CACHE_DIR = os.environ.get("WW_RESULT_CACHE_DIR")          # Optional on-disk tier; unset disables it
+RESULT_CACHE_DISK_MAX_FILES = int(os.environ.get("WW_RESULT_CACHE_DISK_FILES", 2000))
+RESULT_CACHE_KEY_FIELDS = ["behavior", "params", "n_baseline", "change", "change_day", "analysis_method",
+                           "lambda_val", "optimize_lam", "sigma_multiplier", "n_replications", "max_days", "seed",
+                           "engine", "validate", "precision", "cusum_k", "scan_windows"]
+
+_result_cache = OrderedDict()  # key -> (result dict, size in bytes), least recently used first
+_result_cache_bytes = 0
+_result_cache_lock = threading.Lock()
+_inflight = {}  # key -> Future of the computation that identical requests wait on
+
+def result_cache_key(sim_kwargs):
+    """Canonical SHA-256 of the parameters that determine a simulation's result."""
+    fields = {name: sim_kwargs.get(name) for name in RESULT_CACHE_KEY_FIELDS}
+    if fields["optimize_lam"] or fields["analysis_method"] not in ["ewma", "mc-ewma"]:
+        fields["lambda_val"] = None
+    if fields["analysis_method"] not in CUSUM_SIDES:
+        del fields["cusum_k"]  # Keeps the keys of other methods unchanged
+    if fields["analysis_method"] != "scan":
+        del fields["scan_windows"]
+    canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"), default=float)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def _result_size(result):
+    """Approximate memory held by a run_simulation result (dominated by the plotted traces)."""
+    spec = result["spec"]
+    return (sum(np.asarray(rep[0]).nbytes for rep in spec["replications"])
+            + np.asarray(result["summary"]["bins"]).nbytes + np.asarray(result["summary"]["counts"]).nbytes + 1024)
+
+def _disk_path(key):
+    return os.path.join(RESULT_CACHE_DIR, key + ".pkl")
+
+def _store_in_memory(key, result):
+    global _result_cache_bytes
+    size = _result_size(result)
+    if size > RESULT_CACHE_MAX_BYTES:
+        return
+    with _result_cache_lock:
+        if key in _result_cache:
+            _result_cache_bytes -= _result_cache.pop(key)[1]
+        _result_cache[key] = (result, size)
+        _result_cache_bytes += size
+        while _result_cache_bytes > RESULT_CACHE_MAX_BYTES:
+            _, (_, evicted) = _result_cache.popitem(last=False)
+            _result_cache_bytes -= evicted
+
+def _store_on_disk(key, result):
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    tmp = _disk_path(key) + f".{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        pickle.dump(result, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, _disk_path(key))
+    files = [os.path.join(RESULT_CACHE_DIR, f) for f in os.listdir(RESULT_CACHE_DIR) if f.endswith(".pkl")]
+    if len(files) > RESULT_CACHE_DISK_MAX_FILES:
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - RESULT_CACHE_DISK_MAX_FILES]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def result_cache_get(key):
+    """Cached run_simulation result for key from memory, then disk, or None."""
+    with _result_cache_lock:
+        entry = _result_cache.get(key)
+        if entry is not None:
+            _result_cache.move_to_end(key)
+            return entry[0]
+    if RESULT_CACHE_DIR and os.path.exists(_disk_path(key)):
+        try:
+            with open(_disk_path(key), "rb") as fh:
+                result = pickle.load(fh)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        os.utime(_disk_path(key))
+        _store_in_memory(key, result)
+        return result
+    return None
+
+def result_cache_put(key, result):
+    _store_in_memory(key, result)
+    if RESULT_CACHE_DIR:
+        try:
+            _store_on_disk(key, result)
+        except OSError:
+            pass  # The disk tier is best effort
+
+def run_simulation_cached(sim_kwargs, progress=None, admission_wait=None):
+    """
+    run_simulation(**sim_kwargs) through the result cache. Concurrent identical requests are
+    coalesced: the first computes, the others wait for its result. Returns (key, result).
+    Profiled requests skip the cache lookup so that the profile shows the simulation.
+    With admission_wait set, only the request that actually computes is charged against the
+    work budget (waiting up to admission_wait seconds); a refusal raises AdmissionRejected,
+    for the coalesced requests as well.
+    """
+    key = result_cache_key(sim_kwargs)
+    with _result_cache_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        inc_counter("wastewatch_result_cache_total", outcome="coalesced")
+        return key, future.result()
+    try:
+        result = None if profiling_active() else result_cache_get(key)
+        inc_counter("wastewatch_result_cache_total", outcome="miss" if result is None else "hit")
+        if result is None:
+            cost = None
+            if admission_wait is not None:
+                cost = estimate_request_cost(sim_kwargs)
+                admitted, message, retry_after = admit_request(cost, admission_wait)
+                if not admitted:
+                    raise AdmissionRejected(message, retry_after)
+            try:
+                with stage_timer("simulation"):
+                    result = run_simulation(**sim_kwargs, progress=progress)
+            finally:
+                if cost is not None:
+                    release_request(cost)
+            result["sim_kwargs"] = dict(sim_kwargs)  # Lets exports re-simulate the same replications
+            result_cache_put(key, result)
+        future.set_result(result)
+    except BaseException as exc:
+        future.set_exception(exc)
+        raise
+    finally:
+        with _result_cache_lock:
+            del _inflight[key]
+    return key, result
+
+# ---------------------------
+# Chart Store
+# ---------------------------
+CHART_STORE_SIZE = 128                # Charts whose spec (and PNG, once rendered) are kept in memory
+CHART_MAX_AGE_SECONDS = 31536000      # Chart URLs are content addressed, so browsers may cache them for good
+
+_charts = OrderedDict()
+_charts_lock = threading.Lock()
+
+def register_chart(chart_id, result):
+    """Remember the spec of a result so /chart/<chart_id>.png can render it on first request."""
+    with _charts_lock:
+        if chart_id not in _charts:
+            _charts[chart_id] = {"spec": result["spec"], "png": None}
+        _charts.move_to_end(chart_id)
+        while len(_charts) > CHART_STORE_SIZE:
+            _charts.popitem(last=False)
+
+def chart_png(chart_id):
+    """
+    PNG bytes for a chart, rendering and keeping them on first access. Charts that fell out of the
+    store (or were produced by another worker) are rebuilt from the result cache or the result
+    store; returns None when none of them has the chart.
+    """
+    with _charts_lock:
+        entry = _charts.get(chart_id)
+        if entry is not None:
+            _charts.move_to_end(chart_id)
+            if entry["png"] is not None:
+                return entry["png"]
+    if entry is None:
+        result = result_cache_get(chart_id) or stored_result(chart_id)
+        if result is None:
+            return None
+        register_chart(chart_id, result)
+        entry = {"spec": result["spec"]}
+    png = render_chart_png(entry["spec"])
+    with _charts_lock:
+        if chart_id in _charts:
+            _charts[chart_id]["png"] = png
+    return png
+
+# ---------------------------
+# Per-Session Result Store
+# ---------------------------
+RESULT_STORE_PATH = os.environ.get("WW_RESULT_STORE", os.path.join(tempfile.gettempdir(), "wastewatch_results.sqlite3"))
+RESULT_STORE_PER_SESSION = 20         # Charts kept per browser session (oldest dropped first)
+RESULT_STORE_MAX_ROWS = 2000          # Charts kept across all sessions (least recently viewed dropped first)
+RESULT_STORE_TTL_SECONDS = 7 * 86400  # Sessions not viewed for this long are forgotten
+
+_result_store_ready = set()
+
+def _result_store_connect():
+    """
+    Connection to the SQLite result store. SQLite serializes writers across processes, so every
+    gunicorn worker sees the same results and the same background job status.
+    """
+    conn = sqlite3.connect(RESULT_STORE_PATH, timeout=30)
+    if RESULT_STORE_PATH not in _result_store_ready:
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT, sid TEXT NOT NULL, chart_id TEXT NOT NULL,
+                                title TEXT NOT NULL, summary TEXT NOT NULL, spec BLOB NOT NULL, sim_kwargs TEXT NOT NULL,
+                                created REAL NOT NULL, accessed REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_sid ON results (sid, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_chart ON results (chart_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                job_id TEXT PRIMARY KEY, status TEXT NOT NULL, replications_done INTEGER NOT NULL,
+                                n_replications INTEGER NOT NULL, partial_arl REAL, arl REAL, title TEXT, chart_id TEXT,
+                                error TEXT, created REAL NOT NULL, finished REAL) WITHOUT ROWID""")
+        _result_store_ready.add(RESULT_STORE_PATH)
+    return conn
+
+def session_id():
+    """Random ID identifying the browser session's results in the result store."""
+    if 'sid' not in session:
+        session['sid'] = uuid.uuid4().hex
+    return session['sid']
+
+def _json_summary(summary):
+    return json.dumps({k: (v.tolist() if isinstance(v, np.ndarray) else v) for k, v in summary.items()}, default=float)
+
+def record_result(sid, chart_id, result):
+    """Add a finished simulation to the session's results, evicting beyond the per-session and global caps."""
+    register_chart(chart_id, result)
+    now = time.time()
+    spec = pickle.dumps(result["spec"], protocol=pickle.HIGHEST_PROTOCOL)
+    with stage_timer("result_store"), closing(_result_store_connect()) as conn, conn:
+        conn.execute("""INSERT INTO results (sid, chart_id, title, summary, spec, sim_kwargs, created, accessed)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                     (sid, chart_id, result["title"], _json_summary(result["summary"]), spec,
+                      json.dumps(result["sim_kwargs"], default=float), now, now))
+        conn.execute("""DELETE FROM results WHERE sid = ? AND id NOT IN
+                        (SELECT id FROM results WHERE sid = ? ORDER BY id DESC LIMIT ?)""",
+                     (sid, sid, RESULT_STORE_PER_SESSION))
+        conn.execute("DELETE FROM results WHERE accessed < ?", (now - RESULT_STORE_TTL_SECONDS,))
+        conn.execute("""DELETE FROM results WHERE id NOT IN
+                        (SELECT id FROM results ORDER BY accessed DESC, id DESC LIMIT ?)""",
+                     (RESULT_STORE_MAX_ROWS,))
+
+def session_results(sid):
+    """The session's results, oldest first, marking them as recently viewed."""
+    with closing(_result_store_connect()) as conn, conn:
+        conn.execute("UPDATE results SET accessed = ? WHERE sid = ?", (time.time(), sid))
+        rows = conn.execute("SELECT chart_id, title, summary FROM results WHERE sid = ? ORDER BY id", (sid,)).fetchall()
+    return [{"chart_id": chart_id, "title": title, "summary": json.loads(summary)} for chart_id, title, summary in rows]
+
+def clear_session_results(sid):
+    with closing(_result_store_connect()) as conn, conn:
+        conn.execute("DELETE FROM results WHERE sid = ?", (sid,))
+
+def stored_result(chart_id):
+    """{"title", "summary", "spec", "sim_kwargs"} of a chart held in the result store (by any session), or None."""
+    with closing(_result_store_connect()) as conn:
+        row = conn.execute("SELECT title, summary, spec, sim_kwargs FROM results WHERE chart_id = ? LIMIT 1",
+                           (chart_id,)).fetchone()
+    if row is None:
+        return None
+    title, summary, spec, sim_kwargs = row
+    return {"title": title, "summary": json.loads(summary), "spec": pickle.loads(spec), "sim_kwargs": json.loads(sim_kwargs)}
+
+# ---------------------------
+# Result Export
+# ---------------------------
+EXPORT_FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson", "npy": "application/octet-stream"}
+EXPORT_DTYPE = np.dtype([("replication", np.int64), ("run_length", np.int64), ("alarm_day", np.int64),
+                         ("censored", np.bool_), ("baseline_mean", np.float64), ("sigma", np.float64),
+                         ("lambda", np.float64), ("tail_days", np.float64)])
+
+def export_summary(result):
+    """Summary statistics and the parameters (including the seed) that reproduce a result."""
+    summary = result["summary"]
+    arl_value = summary["arl"]
+    return {"title": result["title"], "n_replications": summary["n_replications"], "arl": arl_value,
+            "far": 1 / arl_value if summary["metric_label"] == "FAR" else None,
+            "censored_fraction": summary["limit_pct"] / 100, "run_length_std": summary.get("std"),
+            "min": summary["min"], "median": summary["median"], "max": summary["max"],
+            "avg_sigma": summary["avg_sigma"], "engine": summary.get("engine", "montecarlo"),
+            "mc_arl": summary.get("mc_arl"), "arl_ci": [summary.get("ci_low"), summary.get("ci_high")],
+            "tail_corrected": summary.get("tail_corrected", False),
+            "parameters": result["sim_kwargs"]}
+
+def iter_replication_records(sim_kwargs, workers=None):
+    """
+    Per-replication records (EXPORT_DTYPE arrays, one per shard) of a run, re-simulated shard by
+    shard from its seed. Shards are reproducible, so these match the run's summary exactly.
+    tail_days is the expected extension of a censored run (NaN when it cannot be extrapolated).
+    """
+    offset = 0
+    replication_kwargs = {key: value for key, value in sim_kwargs.items() if key not in ["engine", "validate", "precision"]}
+    for shard in iter_shards(shard_tasks(**replication_kwargs, keep_traces=0), workers):
+        records = np.empty(len(shard["run_lengths"]), dtype=EXPORT_DTYPE)
+        records["replication"] = np.arange(offset + 1, offset + len(records) + 1)
+        records["run_length"] = shard["run_lengths"]
+        records["alarm_day"] = shard["out_idx"]
+        records["censored"] = shard["out_idx"] < 0
+        records["baseline_mean"] = shard["baseline_means"]
+        records["sigma"] = shard["sigmas"]
+        records["lambda"] = shard["lambdas"]
+        records["tail_days"] = shard["tail_days"] if shard["tail_days"] is not None else np.nan
+        offset += len(records)
+        yield records
+
+def export_stream(fmt, result):
+    """
+    Generate an export as text or bytes chunks, one per shard. CSV starts with the summary as
+    '# ' comment lines and JSON lines with a {"summary": ...} line; .npy holds only the records
+    (the summary is served separately as JSON). alarm_day is -1 (null in JSON) for censored runs;
+    tail_days is NaN (null in JSON) when censored runs are not extrapolated.
+    Runs that stopped early at a target precision export the replications actually simulated.
+    """
+    summary = result["summary"]
+    simulated = summary.get("mc_replications") or summary["n_replications"]
+    sim_kwargs = dict(result["sim_kwargs"], n_replications=simulated)
+    if fmt == "npy":
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {"descr": np.lib.format.dtype_to_descr(EXPORT_DTYPE),
+                                                      "fortran_order": False, "shape": (sim_kwargs["n_replications"],)})
+        yield header.getvalue()
+        for records in iter_replication_records(sim_kwargs):
+            yield records.tobytes()
+    elif fmt == "csv":
+        yield "".join(f"# {key}: {json.dumps(value, default=float)}\n" for key, value in export_summary(result).items())
+        yield ",".join(EXPORT_DTYPE.names) + "\n"
+        for records in iter_replication_records(sim_kwargs):
+            buf = io.StringIO()
+            np.savetxt(buf, records, fmt=["%d", "%d", "%d", "%d", "%.17g", "%.17g", "%.17g", "%.17g"], delimiter=",")
+            yield buf.getvalue()
+    elif fmt == "jsonl":
+        yield json.dumps({"summary": export_summary(result)}, default=float) + "\n"
+        for records in iter_replication_records(sim_kwargs):
+            lines = []
+            for rec in records.tolist():
+                row = dict(zip(EXPORT_DTYPE.names, rec))
+                if row["censored"]:
+                    row["alarm_day"] = None
+                if np.isnan(row["tail_days"]):
+                    row["tail_days"] = None
+                lines.append(json.dumps(row))
+            yield "\n".join(lines) + "\n"
+
+# ---------------------------
+# Admission Control
+# ---------------------------
+# Only memory load shrinks the budget: the simulation pool keeps every core busy while it works, so
+# CPU load mostly measures the work this process admitted, which the budget already bounds.
+LOAD_SAMPLE_SECONDS = 2.0             # How often the background sampler reads CPU and memory load
+MEDIUM_LOAD_PERCENT = 70              # Above this memory load the work budget is halved
+WORK_BUDGET_DAYS = int(os.environ.get("WW_WORK_BUDGET_DAYS", 250_000_000 * max(1, SIM_WORKERS)))
+MAX_CONCURRENT_SIMULATIONS = int(os.environ.get("WW_MAX_CONCURRENT", 4))
+SIMULATED_DAYS_PER_SECOND = 10_000_000 * max(1, SIM_WORKERS)  # Rough throughput used for retry hints
+JOB_ADMISSION_WAIT_SECONDS = 300.0    # How long a queued background job may wait for capacity
+
+_system_load = {"cpu": 0.0, "mem": 0.0}
+_load_sampler = None
+_admission = threading.Condition()
+_admitted = {"work": 0, "count": 0}
+
+def _sample_load_forever():
+    psutil.cpu_percent(interval=None)  # First call only primes the counter
+    while True:
+        time.sleep(LOAD_SAMPLE_SECONDS)
+        with stage_timer("load_sample"):
+            _system_load["cpu"] = psutil.cpu_percent(interval=None)
+            _system_load["mem"] = psutil.virtual_memory().percent
+
+def start_load_sampler():
+    """Start the background CPU/memory sampler once per process."""
+    global _load_sampler
+    with _admission:
+        if _load_sampler is None:
+            _system_load["mem"] = psutil.virtual_memory().percent
+            _load_sampler = threading.Thread(target=_sample_load_forever, name="load-sampler", daemon=True)
+            _load_sampler.start()
+
+def _normal_tail(z):
+    """P(Z > z) for a standard normal Z."""
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+def _cusum_arl(shift, cusum_k, h):
+    """Siegmund's approximation to the ARL of a one-sided CUSUM for a mean shift in sigma units."""
+    delta, b = shift - cusum_k, h + 1.166
+    if abs(delta) < 1e-9:
+        return b * b
+    return (math.exp(min(-2 * delta * b, 700.0)) + 2 * delta * b - 1) / (2 * delta * delta)
+
+def expected_run_length(sim_kwargs):
+    """
+    Rough expected run length of one replication, used only to price a request. In-control runs use
+    the Shewhart ARL0 for the sigma multiplier; step changes use the Shewhart ARL1 for the shift in
+    noise units and trending changes the days until the added trend reaches the limit. CUSUM uses
+    Siegmund's approximation instead of the Shewhart ARL, and SCAN the summed alarm rates of its
+    windows. A random walk leaves limits of h moving-range sigmas (about h x step / sqrt(2)) after
+    roughly h^2 / 2 days whatever the detector. Everything is capped at the simulation horizon.
+    """
+    change, change_day = sim_kwargs["change"], sim_kwargs["change_day"]
+    baseline_period = change_day if (change and change_day is not None) else sim_kwargs["n_baseline"]
+    horizon = max(1, sim_kwargs["max_days"] - baseline_period + 1)
+    sigma_multiplier = max(sim_kwargs["sigma_multiplier"], 0.0)
+    p = 2 * _normal_tail(sigma_multiplier)
+    params = sim_kwargs["params"]
+    if sim_kwargs["behavior"] == "randomwalk":
+        return min(horizon, sigma_multiplier ** 2 / 2 + 1)
+    scale = params.get("std", params.get("noise", 1.0)) or 1.0
+    if change and change["type"] == "step" and change.get("factor") is not None:
+        level = params.get("mean", params.get("start", 0.0))
+        shift = abs(change["factor"] - 1) * abs(level) / scale
+        p = _normal_tail(sigma_multiplier - shift) + _normal_tail(sigma_multiplier + shift)
+    elif change and change["type"] == "trending" and change.get("slope"):
+        return min(horizon, sigma_multiplier * scale / abs(change["slope"]) + 1)
+    if sim_kwargs["analysis_method"] in CUSUM_SIDES:
+        shift = shift if (change and change["type"] == "step" and change.get("factor") is not None) else 0.0
+        upper_side, lower_side = CUSUM_SIDES[sim_kwargs["analysis_method"]]
+        cusum_k = sim_kwargs.get("cusum_k", CUSUM_DEFAULT_K)
+        rate = ((1 / _cusum_arl(shift, cusum_k, sigma_multiplier) if upper_side else 0.0)
+                + (1 / _cusum_arl(-shift, cusum_k, sigma_multiplier) if lower_side else 0.0))
+        return min(horizon, 1 / rate if rate > 0 else horizon)
+    if sim_kwargs["analysis_method"] == "scan":
+        # Each window alone alarms like a Shewhart chart on its mean; overlaps make this an underestimate
+        shift = shift if (change and change["type"] == "step" and change.get("factor") is not None) else 0.0
+        rate = sum(_normal_tail(sigma_multiplier - shift * math.sqrt(w)) + _normal_tail(sigma_multiplier + shift * math.sqrt(w))
+                   for w in sim_kwargs.get("scan_windows", SCAN_DEFAULT_WINDOWS))
+        return min(horizon, 1 / rate if rate > 0 else horizon)
+    return min(horizon, 1 / p if p > 0 else horizon)
+
+def estimate_request_cost(sim_kwargs):
+    """Simulated days a request will generate: replications x (baseline + expected run length)."""
+    if uses_analytic_engine(sim_kwargs) and not sim_kwargs.get("validate"):
+        return ANALYTIC_REQUEST_COST
+    change, change_day = sim_kwargs["change"], sim_kwargs["change_day"]
+    baseline_period = change_day if (change and change_day is not None) else sim_kwargs["n_baseline"]
+    per_replication = max(sim_kwargs["n_baseline"], baseline_period) + expected_run_length(sim_kwargs)
+    return int(max(sim_kwargs["n_replications"], 0) * per_replication)
+
+class AdmissionRejected(RuntimeError):
+    """Raised by run_simulation_cached when the simulation it would compute is not admitted."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _admission_verdict(cost):
+    """
+    (fits, message, retry_after, reason) for charging `cost` now; call with _admission held.
+    Analytic requests are never refused for load: they cost next to nothing.
+    """
+    halved = _system_load["mem"] > MEDIUM_LOAD_PERCENT and cost > ANALYTIC_REQUEST_COST
+    budget = WORK_BUDGET_DAYS // 2 if halved else WORK_BUDGET_DAYS
+    if cost > budget:
+        return False, "This request is too large for the current server capacity. Please try fewer replications.", None, "size"
+    if _admitted["count"] < MAX_CONCURRENT_SIMULATIONS and _admitted["work"] + cost <= budget:
+        return True, None, None, None
+    retry_after = max(1, int(math.ceil(_admitted["work"] / SIMULATED_DAYS_PER_SECOND)))
+    return False, f"The server is busy. Please try again in about {retry_after} seconds.", retry_after, "busy"
+
+def check_admission(cost):
+    """Whether `cost` would be admitted right now, without charging it: (admitted, message, retry_after)."""
+    start_load_sampler()
+    with _admission:
+        fits, message, retry_after, _ = _admission_verdict(cost)
+    return fits, message, retry_after
+
+def admit_request(cost, wait_seconds=0.0):
+    """
+    Charge `cost` against the shared work budget, waiting up to wait_seconds for capacity.
+    Returns (admitted, message, retry_after_seconds); an admitted request must call
+    release_request(cost) when it finishes.
+    """
+    start_load_sampler()
+    deadline = time.time() + wait_seconds
+    with stage_timer("admission"), _admission:
+        while True:
+            fits, message, retry_after, reason = _admission_verdict(cost)
+            if fits:
+                _admitted["work"] += cost
+                _admitted["count"] += 1
+                return True, None, None
+            remaining = deadline - time.time()
+            if reason == "size" or remaining <= 0:
+                inc_counter("wastewatch_rejections_total", reason=reason)
+                return False, message, retry_after
+            _admission.wait(remaining)
+
+def release_request(cost):
+    with _admission:
+        _admitted["work"] -= cost
+        _admitted["count"] -= 1
+        _admission.notify_all()
+
+# ---------------------------
+# Metrics (Prometheus text format on /metrics)
+# ---------------------------
+# Counters and latency histograms live in plain dicts behind one lock, so recording a value costs a
+# dict lookup and a bisect and can stay on for every request. Simulation shards time their own
+# stages and hand the timings back with their results, so work done in the process pool is counted
+# by the process that serves the request. Each server process exposes its own counts.
+METRIC_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+METRIC_HELP = {
+    "wastewatch_request_seconds": ("histogram", "Request latency by endpoint."),
+    "wastewatch_stage_seconds": ("histogram", "Seconds per request spent in each stage; shard stages are summed over shards."),
+    "wastewatch_replications_total": ("counter", "Monte Carlo replications simulated."),
+    "wastewatch_simulated_days_total": ("counter", "Days simulated, baselines included."),
+    "wastewatch_result_cache_total": ("counter", "Simulation requests by result cache outcome."),
+    "wastewatch_rejections_total": ("counter", "Requests turned away by admission control, by reason."),
+    "wastewatch_admitted_work_days": ("gauge", "Estimated simulated days of the requests currently admitted."),
+    "wastewatch_admitted_requests": ("gauge", "Requests currently admitted."),
+    "wastewatch_system_load_percent": ("gauge", "Latest sampled CPU and memory load."),
+}
+
+_metrics_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [per-bucket counts with +Inf last, sum]
+
+def inc_counter(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """Add one observation (in seconds) to a latency histogram."""
+    key = (name, tuple(sorted(labels.items())))
+    bucket = bisect.bisect_left(METRIC_LATENCY_BUCKETS, value)
+    with _metrics_lock:
+        entry = _histograms.get(key)
+        if entry is None:
+            entry = _histograms[key] = [[0] * (len(METRIC_LATENCY_BUCKETS) + 1), 0.0]
+        entry[0][bucket] += 1
+        entry[1] += value
+
+@contextmanager
+def stage_timer(stage):
+    """Time the enclosed block into wastewatch_stage_seconds{stage=...}."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("wastewatch_stage_seconds", time.perf_counter() - started, stage=stage)
+
+def record_simulation_metrics(stats):
+    """Count a run's replications and simulated days and observe the stage times its shards reported."""
+    for stage, seconds in stats["stage_seconds"].items():
+        observe("wastewatch_stage_seconds", seconds, stage=stage)
+    inc_counter("wastewatch_replications_total", stats["n"])
+    inc_counter("wastewatch_simulated_days_total", stats["simulated_days"])
+
+def _metric_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+def metrics_text():
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    with _metrics_lock:
+        counters = dict(_counters)
+        histograms = {key: (list(counts), total) for key, (counts, total) in _histograms.items()}
+    gauges = {("wastewatch_admitted_work_days", ()): _admitted["work"],
+              ("wastewatch_admitted_requests", ()): _admitted["count"],
+              ("wastewatch_system_load_percent", (("resource", "cpu"),)): _system_load["cpu"],
+              ("wastewatch_system_load_percent", (("resource", "mem"),)): _system_load["mem"]}
+    bounds = [f"{bound:g}" for bound in METRIC_LATENCY_BUCKETS] + ["+Inf"]
+    lines = []
+    for name, (kind, help_text) in METRIC_HELP.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        if kind == "histogram":
+            for (metric, labels), (counts, total) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_metric_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_metric_labels(labels)} {total!r}")
+                lines.append(f"{name}_count{_metric_labels(labels)} {cumulative}")
+        else:
+            for (metric, labels), value in sorted((counters if kind == "counter" else gauges).items()):
+                if metric == name:
+                    lines.append(f"{name}{_metric_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+# ---------------------------
+# On-Demand Profiling (admin only)
+# ---------------------------
+# With WW_ADMIN_TOKEN set, a main-form or reanalysis request that sends the token in the
+# X-Wastewatch-Profile header (or that an admin armed via /admin/profiles/arm) runs under cProfile,
+# tracemalloc and a stack sampler. The artifacts are written to PROFILE_DIR and served from
+# /admin/profiles. Requests that do not opt in only pay for a header lookup.
+PROFILE_ADMIN_TOKEN = os.environ.get("WW_ADMIN_TOKEN") or None  # Unset disables profiling and the admin endpoints
+PROFILE_DIR = os.environ.get("WW_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "wastewatch_profiles"))
+PROFILE_HEADER = "X-Wastewatch-Profile"
+ADMIN_TOKEN_HEADER = "X-Wastewatch-Admin-Token"  # Header only: a query-string token would end up in logs and Referers
+PROFILE_KEEP = 50                  # Most recent profiles kept on disk
+PROFILE_SAMPLE_SECONDS = 0.005     # Stack sampling interval for the collapsed-stack flamegraph input
+PROFILE_TRACEBACK_FRAMES = 10      # Frames tracemalloc keeps per allocation
+PROFILE_TOP = 40                   # Lines in the top-functions and top-allocations summaries
+PROFILE_ARTIFACTS = {"pstats": "application/octet-stream", "collapsed": "text/plain", "txt": "text/plain",
+                     "json": "application/json"}
+
+_profile_lock = threading.Lock()  # One profiler at a time: cProfile and tracemalloc are process wide
+_profile_armed = {"count": 0}
+_profile_armed_lock = threading.Lock()
+_profiling = threading.local()
+
+def profiling_active():
+    """Whether the current thread is serving a profiled request."""
+    return getattr(_profiling, "active", False)
+
+def admin_authorized(token):
+    return (PROFILE_ADMIN_TOKEN is not None and token is not None
+            and hmac.compare_digest(token.encode("utf-8"), PROFILE_ADMIN_TOKEN.encode("utf-8")))
+
+def _profile_requested():
+    if admin_authorized(request.headers.get(PROFILE_HEADER)):
+        return True
+    if request.method != "POST" or _profile_armed["count"] <= 0:
+        return False
+    with _profile_armed_lock:
+        if _profile_armed["count"] > 0:
+            _profile_armed["count"] -= 1
+            return True
+    return False
+
+def _sample_stacks(thread_id, stop, stacks):
+    """Tally the thread's call stack every PROFILE_SAMPLE_SECONDS as 'outer;...;inner' keys."""
+    while not stop.wait(PROFILE_SAMPLE_SECONDS):
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if names:
+            stacks[";".join(reversed(names))] += 1
+
+def _write_profile(profile_id, meta, profiler, stacks, snapshot, peak):
+    """Write a profile's pstats, collapsed stacks, text summary and metadata, pruning old profiles."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, profile_id)
+    profiler.dump_stats(path + ".pstats")
+    with open(path + ".collapsed", "w") as fh:
+        fh.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    summary = io.StringIO()
+    summary.write(f"{meta['method']} {meta['path']} -> {meta['status']} in {meta['wall_seconds']:.3f}s\n")
+    summary.write(f"Peak traced memory: {peak / 2**20:.1f} MiB\n\nTop functions by cumulative time\n")
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    summary.write("Top allocations still live at the end of the request (by line)\n")
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                       tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+    for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+        summary.write(f"{stat}\n")
+    with open(path + ".txt", "w") as fh:
+        fh.write(summary.getvalue())
+    with open(path + ".json", "w") as fh:
+        json.dump(meta, fh)
+    for old in list_profiles()[PROFILE_KEEP:]:
+        for kind in PROFILE_ARTIFACTS:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, f"{old['id']}.{kind}"))
+            except OSError:
+                pass
+
+def list_profiles():
+    """Metadata of the stored profiles, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in os.listdir(PROFILE_DIR):
+        if name.endswith(".json"):
+            try:
+                with open(os.path.join(PROFILE_DIR, name)) as fh:
+                    profiles.append(json.load(fh))
+            except (OSError, ValueError):
+                continue
+    return sorted(profiles, key=lambda meta: meta["started"], reverse=True)
+
+def profile_request(view, *args, **kwargs):
+    """
+    Call the view under cProfile, tracemalloc and the stack sampler, store the artifacts and tag the
+    response with the profile ID (X-Wastewatch-Profile-Id).
+    """
+    profile_id = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8]
+    meta = {"id": profile_id, "method": request.method, "path": request.path, "endpoint": request.endpoint,
+            "form": request.form.to_dict(), "started": time.time(), "status": None}
+    with _profile_lock:
+        stacks = Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(target=_sample_stacks, args=(threading.get_ident(), stop, stacks),
+                                   name="profile-sampler", daemon=True)
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start(PROFILE_TRACEBACK_FRAMES)
+        tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        _profiling.active = True
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            profiler.enable()
+            try:
+                response = make_response(view(*args, **kwargs))
+            finally:
+                profiler.disable()
+            meta["status"] = response.status_code
+        finally:
+            meta["wall_seconds"] = time.perf_counter() - started
+            stop.set()
+            sampler.join()
+            _profiling.active = False
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            if not was_tracing:
+                tracemalloc.stop()
+            _write_profile(profile_id, meta, profiler, stacks, snapshot, peak)
+    response.headers["X-Wastewatch-Profile-Id"] = profile_id
+    return response
+
+def profiled(view):
+    """Route decorator: profile the view when the request opts in (see profile_request)."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if PROFILE_ADMIN_TOKEN is None or not _profile_requested():
+            return view(*args, **kwargs)
+        return profile_request(view, *args, **kwargs)
+    return wrapper
+
+# ---------------------------
+# Multi-Site Surveillance (uploaded series)
+# ---------------------------
+# An upload of (site, date, value) rows is parsed chunk by chunk into flat numpy arrays and laid out
+# as a sites x observations matrix: each site's observed values in date order, left-aligned and
+# padded with NaN. Detectors run on consecutive observations, so sites sampled twice a week and
+# sites sampled daily share one vectorized batch; every detector is causal, so the padding after a
+# site's last observation never affects its alarms. Datasets are saved as .npy files and reopened
+# memory-mapped, so reanalyses and charts do not parse the upload again.
+SITE_DATA_DIR = os.environ.get("WW_SITE_DATA_DIR", os.path.join(tempfile.gettempdir(), "wastewatch_sites"))
+SITE_UPLOAD_MAX_BYTES = int(os.environ.get("WW_SITE_UPLOAD_BYTES", 256 * 1024 * 1024))
+SITE_MAX_DATASETS = 100        # Stored uploads kept (least recently created dropped first)
+SITE_CHUNK_ROWS = 100_000      # Rows parsed per CSV chunk or Parquet batch
+SITE_BATCH_ROWS = 2048         # Sites run through a detector at once
+SITE_DEFAULT_BASELINE = 30     # Observations per site used to estimate its limits
+SITE_COLUMNS = ("site", "date", "value")
+SITE_OPTION_FIELDS = ["analysis_method", "lam_option", "lambda_val", "cusum_k", "cusum_sides", "scan_windows",
+                      "sigma_multiplier", "n_baseline"]
+
+app.config["MAX_CONTENT_LENGTH"] = SITE_UPLOAD_MAX_BYTES  # Larger request bodies get a 413 before they are read
+
+def iter_csv_chunks(stream):
+    """Yield (sites, dates, values) column tuples of up to SITE_CHUNK_ROWS rows from a CSV byte stream."""
+    reader = csv.reader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+    header = [name.strip().lower() for name in next(reader, [])]
+    missing = [name for name in SITE_COLUMNS if name not in header]
+    if missing:
+        raise ValueError(f"The file needs the columns {', '.join(SITE_COLUMNS)} (missing: {', '.join(missing)}).")
+    columns = [header.index(name) for name in SITE_COLUMNS]
+    width = max(columns) + 1
+    while True:
+        chunk = list(itertools.islice(reader, SITE_CHUNK_ROWS))
+        if not chunk:
+            return
+        rows = [row for row in chunk if len(row) >= width]  # Blank or truncated lines are skipped
+        if rows:
+            fields = list(zip(*rows))
+            yield tuple(fields[column] for column in columns)
+
+def iter_parquet_chunks(stream):
+    """Yield (sites, dates, values) arrays per record batch of a Parquet file (needs pyarrow)."""
+    if pq is None:
+        raise ValueError("Parquet uploads need the pyarrow package on the server; upload a CSV file instead.")
+    parquet = pq.ParquetFile(stream)
+    names = {name.lower(): name for name in parquet.schema_arrow.names}
+    missing = [name for name in SITE_COLUMNS if name not in names]
+    if missing:
+        raise ValueError(f"The file needs the columns {', '.join(SITE_COLUMNS)} (missing: {', '.join(missing)}).")
+    for batch in parquet.iter_batches(batch_size=SITE_CHUNK_ROWS, columns=[names[name] for name in SITE_COLUMNS]):
+        yield tuple(batch.column(i).to_numpy(zero_copy_only=False) for i in range(len(SITE_COLUMNS)))
+
+def _site_chunk(sites, dates, values, site_index):
+    """
+    Convert one chunk to (site codes, day numbers, values) arrays. New site names are added to
+    site_index (name -> code) in order of first appearance; blank values become NaN.
+    """
+    names, inverse = np.unique(np.asarray(sites).astype(str), return_inverse=True)
+    codes = np.array([site_index.setdefault(name, len(site_index)) for name in names], dtype=np.int64)[inverse]
+    dates = np.asarray(dates)
+    try:
+        if dates.dtype.kind != "M":
+            dates = np.char.strip(dates.astype(str)).astype("U10")  # Drops any time of day
+        days = dates.astype("datetime64[D]").astype(np.int64)
+    except ValueError as exc:
+        raise ValueError(f"Dates must be ISO dates such as 2024-03-01 ({exc}).")
+    values = np.asarray(values)
+    if values.dtype.kind not in "fiub":
+        values = np.char.strip(values.astype(str))
+        values[values == ""] = "nan"
+    try:
+        values = values.astype(float)
+    except ValueError as exc:
+        raise ValueError(f"Values must be numbers ({exc}).")
+    return codes, days, values
+
+def load_site_upload(filename, stream):
+    """
+    Parse an uploaded CSV or Parquet file of (site, date, value) rows into (site names, days,
+    values): (n_sites, n_observations) arrays of day numbers (padded with -1) and values (padded
+    with NaN), each site's observations in date order. Missing values are dropped and repeated
+    (site, date) rows averaged.
+    """
+    chunks = iter_parquet_chunks(stream) if filename.lower().endswith(".parquet") else iter_csv_chunks(stream)
+    site_index = {}
+    parts = [_site_chunk(*chunk, site_index) for chunk in chunks]
+    if not parts:
+        raise ValueError("The file has no data rows.")
+    codes, days, values = (np.concatenate(column) for column in zip(*parts))
+    observed = np.isfinite(values)
+    codes, days, values = codes[observed], days[observed], values[observed]
+    if not len(values):
+        raise ValueError("The file has no numeric values.")
+    first_day = days.min()
+    span = days.max() - first_day + 1
+    keys, inverse = np.unique(codes * span + (days - first_day), return_inverse=True)  # Sorted by site, then date
+    values = np.bincount(inverse, weights=values) / np.bincount(inverse)
+    codes, days = keys // span, keys % span + first_day
+    per_site = np.bincount(codes, minlength=len(site_index))
+    position = np.arange(len(codes)) - (np.cumsum(per_site) - per_site)[codes]
+    value_matrix = np.full((len(site_index), per_site.max()), np.nan)
+    day_matrix = np.full(value_matrix.shape, -1, dtype=np.int64)
+    value_matrix[codes, position] = values
+    day_matrix[codes, position] = days
+    return sorted(site_index, key=site_index.get), day_matrix, value_matrix
+
+def save_site_dataset(names, days, values):
+    """Store a parsed upload under an ID derived from its contents and return the ID."""
+    digest = hashlib.sha256(json.dumps(names).encode())
+    digest.update(days.tobytes())
+    digest.update(values.tobytes())
+    dataset_id = digest.hexdigest()[:32]
+    path = os.path.join(SITE_DATA_DIR, dataset_id)
+    if os.path.isdir(path):
+        return dataset_id
+    staging = f"{path}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(staging)
+    np.save(os.path.join(staging, "days.npy"), days)
+    np.save(os.path.join(staging, "values.npy"), values)
+    with open(os.path.join(staging, "sites.json"), "w") as fh:
+        json.dump(names, fh)
+    try:
+        os.rename(staging, path)
+    except OSError:  # Stored concurrently by another request
+        shutil.rmtree(staging, ignore_errors=True)
+    stored = sorted((entry for entry in os.scandir(SITE_DATA_DIR) if entry.is_dir() and not entry.name.endswith(".tmp")),
+                    key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for old in stored[SITE_MAX_DATASETS:]:
+        shutil.rmtree(old.path, ignore_errors=True)
+    return dataset_id
+
+def open_site_dataset(dataset_id):
+    """(site names, days, values) of a stored dataset with the arrays memory-mapped, or None."""
+    path = os.path.join(SITE_DATA_DIR, dataset_id)
+    if not re.fullmatch(r"[0-9a-f]{32}", dataset_id) or not os.path.isdir(path):
+        return None
+    with open(os.path.join(path, "sites.json")) as fh:
+        names = json.load(fh)
+    return names, np.load(os.path.join(path, "days.npy"), mmap_mode="r"), np.load(os.path.join(path, "values.npy"), mmap_mode="r")
+
+def parse_site_options(fd):
+    """Detector settings for the multi-site page from its form or query string."""
+    fd = dict(fd, lambda_val=fd.get("lambda_val", "").strip() or "0.3")
+    try:
+        analysis_method, lambda_val, optimize_lam, _, _, cusum_k, scan_windows = parse_method_options(fd)
+    except ValueError:
+        analysis_method, lambda_val, optimize_lam, cusum_k, scan_windows = "shewhart", 0.3, False, CUSUM_DEFAULT_K, SCAN_DEFAULT_WINDOWS
+    try:
+        sigma_multiplier = float(fd.get("sigma_multiplier", "").strip() or 3.0)
+    except ValueError:
+        sigma_multiplier = 3.0
+    n_baseline = fd.get("n_baseline", "").strip()
+    n_baseline = max(int(n_baseline), 2) if n_baseline.isdigit() else SITE_DEFAULT_BASELINE
+    return {"analysis_method": analysis_method, "sigma_multiplier": sigma_multiplier, "lambda_val": lambda_val,
+            "optimize_lam": optimize_lam, "n_baseline": n_baseline, "cusum_k": cusum_k, "scan_windows": scan_windows}
+
+def detect_sites(values, n_baseline, analysis_method, sigma_multiplier, lambda_val, optimize_lam=False,
+                 cusum_k=CUSUM_DEFAULT_K, scan_windows=SCAN_DEFAULT_WINDOWS):
+    """
+    Estimate every site's limits from its first n_baseline observations (calculate_limits_batch)
+    and run the detector over the rest, SITE_BATCH_ROWS sites at a time. Returns
+    per-site arrays: n_obs, eligible (more than n_baseline observations), baseline_means, sigmas,
+    lambdas, first_alarm and last_alarm (observation indices, -1 for none), n_alarms, and
+    alarm_now (whether the latest observation alarmed).
+    """
+    n_sites = values.shape[0]
+    out = {"n_obs": np.zeros(n_sites, dtype=np.int64), "eligible": np.zeros(n_sites, dtype=bool),
+           "baseline_means": np.full(n_sites, np.nan), "sigmas": np.full(n_sites, np.nan), "lambdas": np.full(n_sites, np.nan),
+           "first_alarm": np.full(n_sites, -1, dtype=np.int64), "last_alarm": np.full(n_sites, -1, dtype=np.int64),
+           "n_alarms": np.zeros(n_sites, dtype=np.int64), "alarm_now": np.zeros(n_sites, dtype=bool)}
+    for lo in range(0, n_sites, SITE_BATCH_ROWS):
+        block = np.asarray(values[lo:lo + SITE_BATCH_ROWS], dtype=float)
+        n_obs = np.count_nonzero(~np.isnan(block), axis=1)
+        rows = np.flatnonzero(n_obs > n_baseline)
+        out["n_obs"][lo:lo + len(block)] = n_obs
+        if not len(rows):
+            continue
+        sites = lo + rows
+        baseline, monitored = block[rows, :n_baseline], block[rows, n_baseline:n_obs[rows].max()]
+        lam = lambda_val
+        if optimize_lam and analysis_method in ["ewma", "mc-ewma"]:
+            lam, _ = optimize_lambda_batch(baseline, analysis_method)
+        means, sigmas = calculate_limits_batch(baseline, analysis_method, lam)
+        state = _detector_init(analysis_method, means, sigmas, baseline[:, -1], scan_windows)
+        with np.errstate(invalid="ignore"):
+            alarms, _ = _detector_block(analysis_method, state, monitored, n_baseline, means, sigmas, sigma_multiplier,
+                                        lam, cusum_k=cusum_k, scan_windows=scan_windows)
+        hit = alarms.any(axis=1)
+        out["eligible"][sites] = True
+        out["baseline_means"][sites], out["sigmas"][sites] = means, sigmas
+        out["lambdas"][sites] = lam
+        out["first_alarm"][sites] = np.where(hit, n_baseline + alarms.argmax(axis=1), -1)
+        out["last_alarm"][sites] = np.where(hit, n_baseline + alarms.shape[1] - 1 - alarms[:, ::-1].argmax(axis=1), -1)
+        out["n_alarms"][sites] = alarms.sum(axis=1)
+        out["alarm_now"][sites] = alarms[np.arange(len(rows)), n_obs[rows] - 1 - n_baseline]
+    return out
+
+def _day_label(day):
+    return str(np.datetime64(int(day), "D")) if day >= 0 else None
+
+def site_alarm_table(names, days, values, **options):
+    """
+    One row per site with its observation span, limits and alarms. Sites alarming on their latest
+    observation come first, then sites by their most recent alarm, then sites without alarms.
+    """
+    result = detect_sites(values, **options)
+    rows = []
+    for site, name in enumerate(names):
+        n_obs = int(result["n_obs"][site])
+        first, last = result["first_alarm"][site], result["last_alarm"][site]
+        if not result["eligible"][site]:
+            status = "insufficient data"
+        else:
+            status = "alarm" if result["alarm_now"][site] else ("alarmed" if first >= 0 else "in control")
+        rows.append({"site_index": site, "site": name, "status": status, "n_obs": n_obs,
+                     "first_date": _day_label(days[site, 0]) if n_obs else None,
+                     "last_date": _day_label(days[site, n_obs - 1]) if n_obs else None,
+                     "baseline_mean": float(result["baseline_means"][site]), "sigma": float(result["sigmas"][site]),
+                     "lambda": float(result["lambdas"][site]) if options["analysis_method"] in ["ewma", "mc-ewma"] else None,
+                     "first_alarm_date": _day_label(days[site, first]) if first >= 0 else None,
+                     "last_alarm_date": _day_label(days[site, last]) if last >= 0 else None,
+                     "n_alarms": int(result["n_alarms"][site])})
+    order = {"alarm": 0, "alarmed": 1, "in control": 2, "insufficient data": 3}
+    rows.sort(key=lambda row: row["site"])
+    rows.sort(key=lambda row: row["last_alarm_date"] or "", reverse=True)
+    rows.sort(key=lambda row: order[row["status"]])
+    return rows
+
+def render_site_chart_png(name, site_days, site_values, options):
+    """PNG chart of one site's series with its limits and first alarm, dated along the x axis."""
+    n_baseline = options["n_baseline"]
+    result = detect_sites(site_values[None, :], **options)
+    lambda_val = float(result["lambdas"][0]) if options["analysis_method"] in ["ewma", "mc-ewma"] else options["lambda_val"]
+    first_alarm = int(result["first_alarm"][0])
+    buf = io.BytesIO()
+    with render_lock:
+        analyze_data_sim(site_values, None, None, float(result["baseline_means"][0]), float(result["sigmas"][0]),
+                         first_alarm if first_alarm >= 0 else None, None, options["analysis_method"],
+                         options["sigma_multiplier"], n_baseline, lambda_val, options["cusum_k"], options["scan_windows"])
+        plt.axvline(n_baseline - 0.5, color="gray", linestyle="dotted", label="End of Baseline", zorder=2)
+        plt.title(f"{name}: {plt.gca().get_title()}")
+        plt.gca().xaxis.set_major_formatter(FuncFormatter(
+            lambda x, _: _day_label(site_days[int(round(x))]) if 0 <= round(x) < len(site_days) else ""))
+        plt.gcf().autofmt_xdate()
+        plt.legend()
+        plt.savefig(buf, format="png", dpi=80)
+        plt.close()
+    return buf.getvalue()
+
+# ---------------------------
+# Online Monitoring (persisted per-site detector state)
+# ---------------------------
+# Live feeds add about one sample per site per day, so a monitor keeps every site's detector state in
+# SQLite instead of rerunning its series. While a site collects its baseline, its raw values are kept.
+# Once the baseline is complete they are replaced by the baseline mean, sigma and lambda plus the few
+# numbers the detector carries from one day to the next (EWMA value, CUSUM sums, the SCAN window).
+# A bulk update advances every site it touches through _detector_block as one (n_sites, 1) block,
+# so a site's alarms match what the Sites page reports for the same series.
+MONITOR_STORE_PATH = os.environ.get("WW_MONITOR_STORE", os.path.join(tempfile.gettempdir(), "wastewatch_monitors.sqlite3"))
+MONITOR_MAX_OBSERVATIONS = 100_000  # Observations accepted in one bulk update
+MONITOR_SQL_BATCH = 500             # Sites looked up per SELECT (stays below SQLite's variable limit)
+MONITOR_NAME_PATTERN = r"[A-Za-z0-9_.-]{1,64}"
+
+_monitor_store_ready = set()
+
+def _monitor_store_connect():
+    conn = sqlite3.connect(MONITOR_STORE_PATH, timeout=30)
+    if MONITOR_STORE_PATH not in _monitor_store_ready:
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS monitors (
+                                name TEXT PRIMARY KEY, options TEXT NOT NULL, created REAL NOT NULL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS monitor_sites (
+                                monitor TEXT NOT NULL, site TEXT NOT NULL, n_obs INTEGER NOT NULL, last_day INTEGER NOT NULL,
+                                baseline BLOB, mean REAL, sigma REAL, lambda REAL, state BLOB,
+                                PRIMARY KEY (monitor, site)) WITHOUT ROWID""")
+        _monitor_store_ready.add(MONITOR_STORE_PATH)
+    return conn
+
+def _monitor_options(text):
+    options = json.loads(text)
+    options["scan_windows"] = tuple(options["scan_windows"])
+    return options
+
+def put_monitor(name, fd):
+    """
+    Create or reconfigure monitor `name` from detector settings named like the Sites page fields and
+    return the settings in effect. Changing the settings of an existing monitor forgets its sites.
+    A lambda_val without lam_option is taken as a manual lambda. Raises ValueError for an unknown
+    method or a lambda outside (0, 1] instead of falling back like the Sites page does.
+    """
+    if fd.get("analysis_method", "shewhart") not in ["shewhart", "ewma", "mc-ewma", "cusum", "scan"]:
+        raise ValueError("analysis_method must be shewhart, ewma, mc-ewma, cusum or scan.")
+    if fd.get("lambda_val", "").strip():
+        try:
+            lambda_val = float(fd["lambda_val"])
+        except ValueError:
+            lambda_val = None
+        if lambda_val is None or not 0 < lambda_val <= 1:
+            raise ValueError("lambda_val must be a number in (0, 1].")
+        fd = dict(fd, lam_option=fd.get("lam_option") or "manual")
+    options = parse_site_options(fd)
+    with closing(_monitor_store_connect()) as conn, conn:
+        row = conn.execute("SELECT options FROM monitors WHERE name = ?", (name,)).fetchone()
+        if row is None or _monitor_options(row[0]) != options:
+            conn.execute("DELETE FROM monitor_sites WHERE monitor = ?", (name,))
+            conn.execute("INSERT OR REPLACE INTO monitors (name, options, created) VALUES (?, ?, ?)",
+                         (name, json.dumps(options), time.time()))
+    return options
+
+def describe_monitor(name):
+    """Settings and site counts of a monitor, or None."""
+    with closing(_monitor_store_connect()) as conn:
+        row = conn.execute("SELECT options FROM monitors WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        n_sites, n_monitoring = conn.execute("""SELECT COUNT(*), COUNT(state) FROM monitor_sites
+                                                WHERE monitor = ?""", (name,)).fetchone()
+    return {"monitor": name, "options": _monitor_options(row[0]), "n_sites": n_sites,
+            "n_monitoring": n_monitoring, "n_in_baseline": n_sites - n_monitoring}
+
+def delete_monitor(name):
+    with closing(_monitor_store_connect()) as conn, conn:
+        conn.execute("DELETE FROM monitor_sites WHERE monitor = ?", (name,))
+        return conn.execute("DELETE FROM monitors WHERE name = ?", (name,)).rowcount > 0
+
+def _pack_detector_state(analysis_method, state, n_rows):
+    """The per-row state of _detector_init / _detector_block as one (n_rows, k) array."""
+    if analysis_method == "ewma":
+        return state["ewma"][:, None]
+    if analysis_method == "mc-ewma":
+        return np.column_stack([state["mc_ewma"], state["prev"]])
+    if analysis_method in CUSUM_SIDES:
+        return np.column_stack([state["upper"], state["lower"]])
+    if analysis_method == "scan":
+        return np.column_stack([state["seen"], state["recent"]])
+    return np.zeros((n_rows, 0))
+
+def _unpack_detector_state(analysis_method, packed):
+    if analysis_method == "ewma":
+        return {"ewma": packed[:, 0]}
+    if analysis_method == "mc-ewma":
+        return {"mc_ewma": packed[:, 0], "prev": packed[:, 1]}
+    if analysis_method in CUSUM_SIDES:
+        return {"upper": packed[:, 0], "lower": packed[:, 1]}
+    if analysis_method == "scan":
+        return {"seen": packed[:, 0], "recent": packed[:, 1:]}
+    return {}
+
+def monitor_limits(analysis_method, statistic, baseline_means, sigmas, sigma_multiplier, lambda_val, day):
+    """
+    Center and half-width of the control limits that `statistic` (as returned by _detector_block)
+    is compared to on absolute day `day`, one per row. CUSUM and SCAN limits are in sigma units.
+    """
+    if analysis_method == "shewhart":
+        return baseline_means, sigma_multiplier * sigmas
+    if analysis_method == "ewma":
+        return baseline_means, sigmas * np.reshape(ewma_limit_factors(lambda_val, sigma_multiplier, day, day + 1), -1)
+    if analysis_method == "mc-ewma":
+        return statistic, sigma_multiplier * sigmas
+    return np.zeros(len(statistic)), np.full(len(statistic), float(sigma_multiplier))
+
+def _finite(value):
+    return value if math.isfinite(value) else None
+
+def update_monitor(name, observations):
+    """
+    Add a bulk of {"site", "date", "value"} observations to monitor `name`. Returns one result per
+    observation, in order, or None when the monitor does not exist. A site may appear several times
+    (in date order) to backfill; each round of repeats is one vectorized detector step. Observations
+    not dated after a site's latest one are rejected, and null values only advance the site's date.
+    """
+    if not isinstance(observations, list) or not observations:
+        raise ValueError("Send a non-empty list of observations.")
+    if len(observations) > MONITOR_MAX_OBSERVATIONS:
+        raise ValueError(f"At most {MONITOR_MAX_OBSERVATIONS} observations are accepted per update.")
+    if not all(isinstance(obs, dict) and "site" in obs and "date" in obs for obs in observations):
+        raise ValueError("Each observation needs a site, a date and a value.")
+    site_index = {}
+    codes, days, values = _site_chunk([str(obs["site"]) for obs in observations], [str(obs["date"]) for obs in observations],
+                                      [np.nan if obs.get("value") is None else obs["value"] for obs in observations], site_index)
+    names = list(site_index)
+    order = np.argsort(codes, kind="stable")
+    first = np.r_[0, np.flatnonzero(np.diff(codes[order])) + 1]
+    repeat = np.empty(len(codes), dtype=np.int64)
+    repeat[order] = np.arange(len(codes)) - np.repeat(first, np.diff(np.r_[first, len(codes)]))
+
+    with stage_timer("monitor_update"), closing(_monitor_store_connect()) as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")  # Concurrent updates of one monitor must not interleave
+        row = conn.execute("SELECT options FROM monitors WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        options = _monitor_options(row[0])
+        analysis_method, sigma_multiplier, n_baseline = options["analysis_method"], options["sigma_multiplier"], options["n_baseline"]
+        stored = {}
+        for lo in range(0, len(names), MONITOR_SQL_BATCH):
+            batch = names[lo:lo + MONITOR_SQL_BATCH]
+            stored.update((site, rest) for site, *rest in conn.execute(
+                f"""SELECT site, n_obs, last_day, baseline, mean, sigma, lambda, state FROM monitor_sites
+                    WHERE monitor = ? AND site IN ({",".join("?" * len(batch))})""", (name, *batch)))
+        n_sites = len(names)
+        n_obs = np.zeros(n_sites, dtype=np.int64)
+        last_day = np.full(n_sites, np.iinfo(np.int64).min)
+        means, sigmas, lams = np.full(n_sites, np.nan), np.full(n_sites, np.nan), np.full(n_sites, np.nan)
+        baselines = [[] for _ in names]
+        zero = np.zeros(1)
+        init = _detector_init(analysis_method, zero, zero, zero, options["scan_windows"])
+        state = np.zeros((n_sites, _pack_detector_state(analysis_method, init, 1).shape[1]))
+        monitoring = []
+        for i, site in enumerate(names):
+            if site not in stored:
+                continue
+            n_obs[i], last_day[i], baseline, mean, sigma, lam, _ = stored[site]
+            if baseline is not None:
+                baselines[i] = np.frombuffer(baseline).tolist()
+            else:
+                means[i], sigmas[i], lams[i] = mean, sigma, lam
+                baselines[i] = None
+                monitoring.append(i)
+        if monitoring:
+            state[monitoring] = np.frombuffer(b"".join(stored[names[i]][6] for i in monitoring)).reshape(len(monitoring), -1)
+
+        results = [None] * len(codes)
+        for round_ in range(repeat.max() + 1):
+            idx = np.flatnonzero(repeat == round_)
+            rows, day, value = codes[idx], days[idx], values[idx]
+            stale = day <= last_day[rows]
+            for i in idx[stale]:
+                results[i] = {"site": names[codes[i]], "status": "rejected",
+                              "error": "The site already has an observation on or after this date."}
+            last_day[rows[~stale]] = day[~stale]
+            for i in idx[~stale & np.isnan(value)]:
+                results[i] = {"site": names[codes[i]], "status": "missing", "n_obs": int(n_obs[codes[i]])}
+            keep = ~stale & ~np.isnan(value)
+            idx, rows, value = idx[keep], rows[keep], value[keep]
+            accepted = rows
+
+            in_baseline = n_obs[rows] < n_baseline
+            for row, v in zip(rows[in_baseline], value[in_baseline]):
+                baselines[row].append(v)
+            completed = rows[in_baseline][n_obs[rows[in_baseline]] + 1 == n_baseline]
+            if len(completed):
+                baseline = np.array([baselines[row] for row in completed])
+                lam = options["lambda_val"]
+                if options["optimize_lam"] and analysis_method in ["ewma", "mc-ewma"]:
+                    lam, _ = optimize_lambda_batch(baseline, analysis_method)
+                means[completed], sigmas[completed] = calculate_limits_batch(baseline, analysis_method, lam)
+                lams[completed] = lam
+                init = _detector_init(analysis_method, means[completed], sigmas[completed], baseline[:, -1], options["scan_windows"])
+                state[completed] = _pack_detector_state(analysis_method, init, len(completed))
+                for row in completed:
+                    baselines[row] = None
+            for i, row in zip(idx[in_baseline], rows[in_baseline]):
+                results[i] = {"site": names[row], "status": "baseline", "n_obs": int(n_obs[row]) + 1,
+                              "baseline_remaining": int(n_baseline - n_obs[row] - 1)}
+                if baselines[row] is None:
+                    results[i].update(mean=_finite(means[row]), sigma=_finite(sigmas[row]), **{"lambda": _finite(lams[row])})
+
+            rows, idx, value = rows[~in_baseline], idx[~in_baseline], value[~in_baseline]
+            if len(rows):
+                detector = _unpack_detector_state(analysis_method, state[rows])
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    alarms, statistic = _detector_block(analysis_method, detector, value[:, None], n_obs[rows], means[rows],
+                                                        sigmas[rows], sigma_multiplier, lams[rows], cusum_k=options["cusum_k"],
+                                                        scan_windows=options["scan_windows"])
+                    statistic = statistic[:, 0]
+                    center, width = monitor_limits(analysis_method, statistic, means[rows], sigmas[rows], sigma_multiplier,
+                                                   lams[rows], n_obs[rows])
+                    _, warning_width = monitor_limits(analysis_method, statistic, means[rows], sigmas[rows], sigma_multiplier - 1,
+                                                      lams[rows], n_obs[rows])
+                    if analysis_method == "mc-ewma":
+                        statistic = value  # Observations are compared to the MC-EWMA forecast
+                    warnings = np.abs(statistic - center) > warning_width
+                state[rows] = _pack_detector_state(analysis_method, detector, len(rows))
+                for i, row, alarm, warning, stat, c, w, ww in zip(idx, rows, alarms[:, 0].tolist(), warnings.tolist(),
+                                                                   statistic.tolist(), center.tolist(), width.tolist(),
+                                                                   warning_width.tolist()):
+                    results[i] = {"site": names[row], "status": "alarm" if alarm else "warning" if warning else "in control",
+                                  "n_obs": int(n_obs[row]) + 1, "statistic": _finite(stat), "center": _finite(c),
+                                  "lower": _finite(c - w), "upper": _finite(c + w),
+                                  "warning_lower": _finite(c - ww), "warning_upper": _finite(c + ww)}
+            n_obs[accepted] += 1
+
+        conn.executemany("""INSERT OR REPLACE INTO monitor_sites (monitor, site, n_obs, last_day, baseline, mean, sigma, lambda, state)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                         [(name, site, int(n_obs[i]), int(last_day[i]),
+                           None if baselines[i] is None else np.asarray(baselines[i], dtype=float).tobytes(),
+                           _finite(means[i]), _finite(sigmas[i]), _finite(lams[i]),
+                           None if baselines[i] is not None else state[i].tobytes())
+                          for i, site in enumerate(names)])
+    return results
+
+# ---------------------------
+# Form Parsing
+# ---------------------------
+def parse_method_options(fd):
+    """Analysis method, lambda, CUSUM, SCAN and engine settings shared by the main and reanalysis forms."""
+    analysis_method = fd.get("analysis_method")
+    optimize_lam = False
+    cusum_k = CUSUM_DEFAULT_K
+    scan_windows = SCAN_DEFAULT_WINDOWS
+    if analysis_method == "scan":
+        windows = sorted({int(w) for w in re.findall(r"\d+", fd.get("scan_windows", "")) if 1 <= int(w) <= SCAN_MAX_WINDOW})
+        scan_windows = tuple(windows[:SCAN_MAX_WINDOWS]) or SCAN_DEFAULT_WINDOWS
+    if analysis_method == "cusum":
+        sides = fd.get("cusum_sides", "both")
+        analysis_method = {"upper": "cusum-upper", "lower": "cusum-lower"}.get(sides, "cusum")
+        try:
+            cusum_k = max(float(fd.get("cusum_k", "").strip() or CUSUM_DEFAULT_K), 0.0)
+        except ValueError:
+            cusum_k = CUSUM_DEFAULT_K
+    if analysis_method not in ["shewhart", "ewma", "mc-ewma", "scan", *CUSUM_SIDES]:
+        analysis_method = "shewhart"
+        lambda_val = 0.3
+    else:
+        if analysis_method in ["ewma", "mc-ewma"]:
+            lam_option = fd.get("lam_option", "").strip().lower()
+            if lam_option == "manual":
+                lambda_val = float(fd.get("lambda_val", "0.3"))
+            elif lam_option == "optimized":
+                # Each replication gets the lambda optimized on its own baseline
+                lambda_val, optimize_lam = 0.3, True
+            else:
+                lambda_val = 0.3
+        else:
+            lambda_val = 0.3
+    engine = "montecarlo" if fd.get("engine") == "montecarlo" else "auto"
+    validate = fd.get("validate", "").lower() in ["on", "yes", "true", "1"]
+    return analysis_method, lambda_val, optimize_lam, engine, validate, cusum_k, scan_windows
+
+def parse_simulation_form(fd):
+    """
+    Parse the main form. Returns the full_params stored in the session and the keyword
+    arguments for run_simulation.
+    """
+    try:
+        n_baseline = int(fd.get("n_baseline", "0"))
+        n_replications = int(fd.get("n_replications", "0"))
+        sigma_multiplier = float(fd.get("sigma_multiplier", "0"))
+    except ValueError:
+        n_baseline = n_replications = sigma_multiplier = 0
+    behavior = fd.get("behavior")
+    if behavior == "stable":
+        params = {"mean": float(fd.get("mean", "0")), "std": float(fd.get("std", "0")), "distribution_type": fd.get("dist_type", "normal")}
+    elif behavior == "trending":
+        params = {"start": float(fd.get("start", "0")), "slope": float(fd.get("slope", "0")), "noise": float(fd.get("noise", "0"))}
+    elif behavior == "periodic":
+        params = {"mean": float(fd.get("p_mean", "0")), "amplitude": float(fd.get("amplitude", "0")), "period": int(fd.get("period", "50")), "noise": float(fd.get("p_noise", "0"))}
+    elif behavior == "randomwalk":
+        params = {"start": float(fd.get("rw_start", "0")), "drift": float(fd.get("drift", "").strip() or "0"), "step": float(fd.get("step", "0"))}
+    else:
+        params = {}
+    induce = fd.get("induce_change", "no").lower() == "yes"
+    if induce:
+        change_day = int(fd.get("change_day", "0"))
+        ct = fd.get("change_type", "")
+        if ct == "step":
+            factor = float(fd.get("factor", "0")) if fd.get("factor", "").strip() else None
+            change = {"type": "step", "factor": factor}
+        elif ct == "trending":
+            cs = float(fd.get("change_slope", "0")) if fd.get("change_slope", "").strip() else None
+            td = int(fd.get("trend_duration", "0")) if fd.get("trend_duration", "").strip() else None
+            change = {"type": "trending", "slope": cs, "duration": td}
+        else:
+            change = None
+    else:
+        change = None
+        change_day = None
+    seed_str = fd.get("seed", "").strip()
+    seed = int(seed_str) if seed_str.isdigit() else scenario_seed(behavior, params, n_baseline, change, change_day)
+    max_days_str = fd.get("max_days", "").strip()
+    max_days = min(int(max_days_str), MAX_MONITORING_DAYS) if max_days_str.isdigit() else DEFAULT_MAX_DAYS
+    max_days = max(max_days, n_baseline + 1)
+    try:
+        precision = float(fd.get("precision", "").strip()) / 100 if fd.get("precision", "").strip() else None
+    except ValueError:
+        precision = None
+    if precision is not None and precision <= 0:
+        precision = None
+    full_params = {"behavior": behavior, "params": params, "n_baseline": n_baseline,
+                   "n_replications": n_replications, "sigma_multiplier": sigma_multiplier,
+                   "change": change, "change_day": change_day, "max_days": max_days, "seed": seed, "precision": precision}
+    return full_params, simulation_kwargs(full_params, *parse_method_options(fd))
+
+def parse_reanalysis_form(fd, full_params):
+    """Keyword arguments for run_simulation from the reanalysis form and the stored full_params."""
+    sigma_multiplier = float(fd.get("sigma_multiplier_re", "").strip() or full_params.get("sigma_multiplier", 1))
+    return simulation_kwargs(dict(full_params, sigma_multiplier=sigma_multiplier), *parse_method_options(fd))
+
+def simulation_kwargs(fp, analysis_method, lambda_val, optimize_lam, engine="auto", validate=False, cusum_k=CUSUM_DEFAULT_K,
+                      scan_windows=SCAN_DEFAULT_WINDOWS):
+    return {"behavior": fp["behavior"], "params": fp["params"], "n_baseline": fp["n_baseline"],
+            "change": fp["change"], "change_day": fp["change_day"], "analysis_method": analysis_method,
+            "n_replications": fp["n_replications"], "sigma_multiplier": fp["sigma_multiplier"],
+            "max_days": fp["max_days"], "lambda_val": lambda_val, "optimize_lam": optimize_lam,
+            "engine": engine, "validate": validate, "precision": fp.get("precision"), "seed": fp.get("seed"),
+            "cusum_k": cusum_k, "scan_windows": list(scan_windows)}
+
+# ---------------------------
+# Background Simulation Jobs
+# ---------------------------
+JOB_WORKERS = int(os.environ.get("WW_JOB_WORKERS", 2))  # Simulations run concurrently in the background
+JOB_TTL_SECONDS = 3600                                   # Finished jobs are forgotten after this long
+JOB_FIELDS = ("status", "replications_done", "n_replications", "partial_arl", "arl", "title", "chart_id", "error", "finished")
+
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+
+def submit_simulation_job(sim_kwargs, sid):
+    """
+    Queue run_simulation(**sim_kwargs) on the background pool and return the job ID. The result is
+    added to session `sid`. The job is charged against the work budget only if it computes. Its
+    status lives in the result store, so any server process can report it.
+    """
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with closing(_result_store_connect()) as conn, conn:
+        conn.execute("DELETE FROM jobs WHERE finished < ?", (now - JOB_TTL_SECONDS,))
+        conn.execute("INSERT INTO jobs (job_id, status, replications_done, n_replications, created) VALUES (?, ?, ?, ?, ?)",
+                     (job_id, "queued", 0, sim_kwargs["n_replications"], now))
+    _job_executor.submit(_run_simulation_job, job_id, sim_kwargs, sid)
+    return job_id
+
+def _update_job(job_id, **fields):
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with closing(_result_store_connect()) as conn, conn:
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+
+def _run_simulation_job(job_id, sim_kwargs, sid):
+    def progress(done, partial_arl):
+        _update_job(job_id, replications_done=done, partial_arl=partial_arl if done else None)
+
+    _update_job(job_id, status="running")
+    try:
+        chart_id, result = run_simulation_cached(sim_kwargs, progress=progress,
+                                                 admission_wait=JOB_ADMISSION_WAIT_SECONDS)
+        record_result(sid, chart_id, result)
+    except Exception as exc:
+        _update_job(job_id, status="failed", error=str(exc), finished=time.time())
+        return
+    _update_job(job_id, status="done", arl=result["arl"], title=result["title"], chart_id=chart_id, finished=time.time())
+
+def get_job(job_id):
+    with closing(_result_store_connect()) as conn:
+        row = conn.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    return dict(zip(JOB_FIELDS, row)) if row is not None else None
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request_latency(response):
+    started = g.get("request_started")
+    if started is not None:
+        observe("wastewatch_request_seconds", time.perf_counter() - started,
+                endpoint=request.endpoint or "unknown", method=request.method)
+    return response
+
+@app.route("/metrics")
+def metrics():
+    """Counters and latency histograms in the Prometheus text format."""
+    return metrics_text(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+def overloaded_page(exc, full_params_exists):
+    """The main page with a refused request's message, as a 503 carrying Retry-After when known."""
+    page = render_template_string(
+        f"<h2 style='color:red;text-align:center;'> {exc}</h2>" + main_template,
+        results=session_results(session_id()),
+        full_params_exists=full_params_exists,
+        nav_bar=nav_bar
+    )
+    return page, 503, ({"Retry-After": str(exc.retry_after)} if exc.retry_after is not None else {})
+
+@app.route("/", methods=["GET", "POST"])
+@profiled
+def index():
+    if request.method == "POST":
+        full_params, sim_kwargs = parse_simulation_form(request.form.to_dict())
+        # --------------------------
+        # Admission: a request that computes is charged its estimated cost against the shared work
+        # budget and refused at once when there is no room (cached and coalesced results are free)
+        # --------------------------
+        try:
+            chart_id, result = run_simulation_cached(sim_kwargs, admission_wait=0.0)
+        except AdmissionRejected as exc:
+            return overloaded_page(exc, full_params_exists=('full_params' in session))
+        session['full_params'] = full_params
+        record_result(session_id(), chart_id, result)
+    return render_template_string(main_template, results=session_results(session_id()), full_params_exists=('full_params' in session), nav_bar=nav_bar)
+
+@app.route("/instructions")
+def instructions():
+    return render_template_string(instructions_template, nav_bar=nav_bar)
+
+@app.route("/clear", methods=["POST"])
+def clear():
+    clear_session_results(session_id())
+    return redirect(url_for('index'))
+
+@app.route("/reanalyze", methods=["GET", "POST"])
+@profiled
+def reanalyze():
+    if 'full_params' not in session:
+        return redirect(url_for('index'))
+    if request.method == "POST":
+        sim_kwargs = parse_reanalysis_form(request.form.to_dict(), session['full_params'])
+        try:
+            chart_id, result = run_simulation_cached(sim_kwargs, admission_wait=0.0)
+        except AdmissionRejected as exc:
+            return overloaded_page(exc, full_params_exists=True)
+        record_result(session_id(), chart_id, result)
+        return redirect(url_for('index'))
+    return render_template_string(reanalyze_template, nav_bar=nav_bar)
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """
+    Queue a simulation from the main form (or the reanalysis form when job_type=reanalyze) and
+    return its job ID immediately.
+    """
+    fd = request.form.to_dict()
+    if fd.get("job_type") == "reanalyze":
+        if 'full_params' not in session:
+            return jsonify({"error": "Run an analysis before reanalyzing."}), 400
+        sim_kwargs = parse_reanalysis_form(fd, session['full_params'])
+    else:
+        full_params, sim_kwargs = parse_simulation_form(fd)
+    # Refuse at once when the job could not start now; it is charged only once it computes
+    admitted, message, retry_after = True, None, None
+    if result_cache_get(result_cache_key(sim_kwargs)) is None:
+        admitted, message, retry_after = check_admission(estimate_request_cost(sim_kwargs))
+    if not admitted:
+        inc_counter("wastewatch_rejections_total", reason="size" if retry_after is None else "busy")
+        response = jsonify({"error": message, "retry_after": retry_after})
+        if retry_after is not None:
+            response.headers["Retry-After"] = str(retry_after)
+        return response, 503
+    if fd.get("job_type") != "reanalyze":
+        session['full_params'] = full_params
+    job_id = submit_simulation_job(sim_kwargs, session_id())
+    return jsonify({"job_id": job_id, "status_url": url_for('job_status', job_id=job_id)}), 202
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    """Progress (replications done, partial ARL) and, once finished, the summary of a job."""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job."}), 404
+    job.pop("finished")
+    job["job_id"] = job_id
+    if job["chart_id"] is not None:
+        job["chart_url"] = url_for('chart_image', chart_id=job["chart_id"])
+    return jsonify(job)
+
+@app.route("/export/<chart_id>.<fmt>")
+def export_results(chart_id, fmt):
+    """
+    Per-replication results of a simulation streamed as csv, jsonl or npy, or its summary as json.
+    Exports re-simulate the run from its seed, so they are admitted like a new simulation.
+    """
+    result = result_cache_get(chart_id) or stored_result(chart_id)
+    if result is None or "sim_kwargs" not in result or (fmt != "json" and fmt not in EXPORT_FORMATS):
+        return "Export not found.", 404
+    if fmt == "json":
+        return jsonify(export_summary(result))
+    if uses_analytic_engine(result["sim_kwargs"]) and not result["sim_kwargs"].get("validate"):
+        return "Analytic results have no replications to export; download the .json summary instead.", 404
+    cost = estimate_request_cost(result["sim_kwargs"])
+    admitted, message, retry_after = admit_request(cost)
+    if not admitted:
+        return message, 503, ({"Retry-After": str(retry_after)} if retry_after is not None else {})
+    released = threading.Event()
+
+    def release():
+        if not released.is_set():
+            released.set()
+            release_request(cost)
+
+    def generate():
+        try:
+            yield from export_stream(fmt, result)
+        finally:
+            release()
+
+    response = Response(generate(), mimetype=EXPORT_FORMATS[fmt],
+                        headers={"Content-Disposition": f"attachment; filename=wastewatch_{chart_id[:12]}.{fmt}"})
+    response.call_on_close(release)  # Also covers responses that are closed before streaming starts
+    return response
+
+@app.route("/chart/<chart_id>.png")
+def chart_image(chart_id):
+    """A simulation chart, rendered on first request and then served from memory."""
+    etag = f'"{chart_id}"'
+    cache_control = f"public, max-age={CHART_MAX_AGE_SECONDS}, immutable"
+    if request.headers.get("If-None-Match") == etag:
+        return "", 304, {"ETag": etag, "Cache-Control": cache_control}
+    png = chart_png(chart_id)
+    if png is None:
+        return "Chart not found.", 404
+    return png, 200, {"Content-Type": "image/png", "ETag": etag, "Cache-Control": cache_control}
+
+@app.errorhandler(413)
+def request_too_large(error):
+    """Bodies over MAX_CONTENT_LENGTH; uploads to the Sites page get the page back with the limit."""
+    if request.endpoint == "sites":
+        return render_template_string(sites_template, nav_bar=nav_bar, rows=None,
+                                      error=f"Uploads are limited to {SITE_UPLOAD_MAX_BYTES // 2**20} MiB."), 413
+    return "The request is too large.", 413
+
+@app.route("/sites", methods=["GET", "POST"])
+def sites():
+    """Upload a (site, date, value) file; the alarm table is then shown at /sites/<dataset_id>."""
+    if request.method == "POST":
+        upload = request.files.get("file")
+        if upload is None or not upload.filename:
+            return render_template_string(sites_template, nav_bar=nav_bar, error="Choose a file to upload.", rows=None), 400
+        try:
+            with stage_timer("site_ingest"):
+                dataset_id = save_site_dataset(*load_site_upload(upload.filename, upload.stream))
+        except (ValueError, UnicodeDecodeError, csv.Error) as exc:
+            return render_template_string(sites_template, nav_bar=nav_bar, error=str(exc), rows=None), 400
+        options = {key: value for key, value in request.form.items() if key in SITE_OPTION_FIELDS and value}
+        return redirect(url_for('site_table', dataset_id=dataset_id, **options))
+    return render_template_string(sites_template, nav_bar=nav_bar, error=None, rows=None)
+
+@app.route("/sites/<dataset_id>")
+def site_table(dataset_id):
+    """Per-site alarm table of an uploaded dataset for the detector settings in the query string (?format=csv to download)."""
+    dataset = open_site_dataset(dataset_id)
+    if dataset is None:
+        return "Dataset not found.", 404
+    query = {key: value for key, value in request.args.items() if key in SITE_OPTION_FIELDS}
+    options = parse_site_options(query)
+    with stage_timer("site_detection"):
+        rows = site_alarm_table(*dataset, **options)
+    if request.args.get("format") == "csv":
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=[key for key in rows[0] if key != "site_index"], extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows({key: ("" if value is None else value) for key, value in row.items()} for row in rows)
+        return buf.getvalue(), 200, {"Content-Type": "text/csv",
+                                     "Content-Disposition": f"attachment; filename=wastewatch_sites_{dataset_id[:12]}.csv"}
+    counts = Counter(row["status"] for row in rows)
+    return render_template_string(sites_template, nav_bar=nav_bar, error=None, rows=rows, counts=counts,
+                                  dataset_id=dataset_id, query=query, options=options)
+
+@app.route("/sites/<dataset_id>/<int:site>.png")
+def site_chart(dataset_id, site):
+    """Chart of one site, rendered only when it is opened."""
+    dataset = open_site_dataset(dataset_id)
+    if dataset is None or not 0 <= site < len(dataset[0]):
+        return "Chart not found.", 404
+    names, days, values = dataset
+    query = {key: value for key, value in request.args.items() if key in SITE_OPTION_FIELDS}
+    options = parse_site_options(query)
+    etag = '"' + hashlib.sha256(json.dumps([dataset_id, site, sorted(query.items())]).encode()).hexdigest()[:32] + '"'
+    cache_control = f"public, max-age={CHART_MAX_AGE_SECONDS}, immutable"
+    if request.headers.get("If-None-Match") == etag:
+        return "", 304, {"ETag": etag, "Cache-Control": cache_control}
+    n_obs = int(np.count_nonzero(~np.isnan(values[site])))
+    if n_obs <= options["n_baseline"]:
+        return "This site has too few observations for the chosen baseline.", 404
+    with stage_timer("site_chart"):
+        png = render_site_chart_png(names[site], np.asarray(days[site, :n_obs]), np.asarray(values[site, :n_obs], dtype=float), options)
+    return png, 200, {"Content-Type": "image/png", "ETag": etag, "Cache-Control": cache_control}
+
+@app.route("/api/monitors/<name>", methods=["GET", "PUT", "DELETE"])
+def monitor_api(name):
+    """
+    PUT detector settings (JSON, named like the Sites page fields) to create or reconfigure a
+    monitor, GET its settings (including the lambda in effect) and site counts, or DELETE it with
+    all its site state.
+    """
+    if not re.fullmatch(MONITOR_NAME_PATTERN, name):
+        return jsonify({"error": "Monitor names are 1-64 letters, digits, '.', '_' or '-'."}), 400
+    if request.method == "PUT":
+        settings = request.get_json(silent=True)
+        if not isinstance(settings, dict):
+            return jsonify({"error": "Send the detector settings as a JSON object."}), 400
+        fd = {key: ",".join(map(str, value)) if isinstance(value, list) else str(value)
+              for key, value in settings.items() if key in SITE_OPTION_FIELDS}
+        try:
+            options = put_monitor(name, fd)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        return jsonify({"monitor": name, "options": options})
+    if request.method == "DELETE":
+        if not delete_monitor(name):
+            return jsonify({"error": "Unknown monitor."}), 404
+        return "", 204
+    info = describe_monitor(name)
+    if info is None:
+        return jsonify({"error": "Unknown monitor."}), 404
+    return jsonify(info)
+
+@app.route("/api/monitors/<name>/observations", methods=["POST"])
+def monitor_observations(name):
+    """
+    Add {"observations": [{"site", "date", "value"}, ...]} to a monitor and return every
+    observation's status (baseline, in control, warning, alarm, missing or rejected) with the
+    detector statistic and the control and warning limits it was compared to.
+    """
+    body = request.get_json(silent=True)
+    try:
+        results = update_monitor(name, body.get("observations") if isinstance(body, dict) else body)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    if results is None:
+        return jsonify({"error": "Unknown monitor."}), 404
+    return jsonify({"monitor": name, "results": results})
+
+def _admin_token():
+    return request.headers.get(ADMIN_TOKEN_HEADER)
+
+@app.route("/admin/profiles")
+def admin_profiles():
+    """Stored profiles, newest first, with links to their artifacts."""
+    if not admin_authorized(_admin_token()):
+        return "Not found.", 404
+    profiles = [dict(meta, artifacts={kind: url_for('admin_profile_artifact', profile_id=meta["id"], kind=kind)
+                                      for kind in PROFILE_ARTIFACTS})
+                for meta in list_profiles()]
+    return jsonify({"armed": _profile_armed["count"], "profiles": profiles})
+
+@app.route("/admin/profiles/arm", methods=["POST"])
+def admin_arm_profiling():
+    """Profile the next `count` (default 1) main-form or reanalysis submissions."""
+    if not admin_authorized(_admin_token()):
+        return "Not found.", 404
+    try:
+        count = max(int(request.values.get("count", "1")), 0)
+    except ValueError:
+        return jsonify({"error": "count must be an integer."}), 400
+    with _profile_armed_lock:
+        _profile_armed["count"] = count
+    return jsonify({"armed": count})
+
+@app.route("/admin/profiles/<profile_id>.<kind>")
+def admin_profile_artifact(profile_id, kind):
+    """Download a profile artifact: pstats, collapsed (flamegraph input), txt (summary) or json (metadata)."""
+    if not admin_authorized(_admin_token()):
+        return "Not found.", 404
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.{kind}")
+    if kind not in PROFILE_ARTIFACTS or not re.fullmatch(r"[0-9a-f-]+", profile_id) or not os.path.exists(path):
+        return "Profile not found.", 404
+    return send_file(path, mimetype=PROFILE_ARTIFACTS[kind], as_attachment=True,
+                     download_name=f"wastewatch_{profile_id}.{kind}")
+
+reanalyze_template = """
+<!DOCTYPE html>
+<html>
+<head>
+  <title>Wastewatch - Reanalyze</title>
   <style>
     body { background-color: #e0f7fa; font-family: Arial, sans-serif; margin: 20px; }
     h1 { text-align: center; }
@@ -885,9 +3935,23 @@ reanalyze_template = """
         <option value="shewhart">Shewhart</option>
         <option value="ewma">EWMA</option>
         <option value="mc-ewma">MC-EWMA</option>
-        <option value="cusum" disabled style="color: gray;">CUSUM</option>
-        <option value="scan" disabled style="color: gray;">SCAN</option>
+        <option value="cusum">CUSUM</option>
+        <option value="scan">SCAN</option>
       </select><br><br>
+      <div id="scanInputRe" style="display:none;">
+        <label>Window lengths in days (comma-separated):</label><br>
+        <input type="text" name="scan_windows" value="7, 14, 28"><br><br>
+      </div>
+      <div id="cusumInputRe" style="display:none;">
+        <label>Reference value k (in sigmas):</label><br>
+        <input type="number" step="any" name="cusum_k" min="0" value="0.5"><br>
+        <label>Sides:</label><br>
+        <select name="cusum_sides">
+          <option value="both" selected>Two-sided</option>
+          <option value="upper">Upper (increases only)</option>
+          <option value="lower">Lower (decreases only)</option>
+        </select><br><br>
+      </div>
       <div id="lambdaInputRe" style="display:none;">
         <label>Choose your lambda option:</label><br>
         <select name="lam_option" id="lam_option_re">
@@ -899,11 +3963,17 @@ reanalyze_template = """
           <label>Enter your lambda value (0 &lt; lambda &lt; 1):</label><br>
           <input type="number" step="any" name="lambda_val" id="lambda_val_re"><br><br>
         </div>
-        <div id="sigmaInputRe" style="display:none;">
-          <label>Enter sigma multiplier:</label><br>
-          <input type="number" step="any" name="sigma_multiplier_re"><br><br>
-        </div>
       </div>
+      <div id="sigmaInputRe" style="display:none;">
+        <label>Enter sigma multiplier (the decision interval h for CUSUM):</label><br>
+        <input type="number" step="any" name="sigma_multiplier_re"><br><br>
+      </div>
+      <label>Engine:</label><br>
+      <select name="engine">
+        <option value="auto" selected>Auto (analytic when available)</option>
+        <option value="montecarlo">Monte Carlo</option>
+      </select><br>
+      <label><input type="checkbox" name="validate"> Overlay a Monte Carlo check on analytic results</label><br><br>
       <input type="submit" value="Reanalyze">
     </form>
   </div>
@@ -917,7 +3987,9 @@ reanalyze_template = """
     document.getElementById('analysisSelectRe').addEventListener('change', function(){
       var val = this.value;
       document.getElementById('lambdaInputRe').style.display = (val === 'ewma' || val === 'mc-ewma') ? 'block' : 'none';
-      document.getElementById('sigmaInputRe').style.display = (val === 'ewma' || val === 'mc-ewma') ? 'block' : 'none';
+      document.getElementById('sigmaInputRe').style.display = (val === 'ewma' || val === 'mc-ewma' || val === 'cusum' || val === 'scan') ? 'block' : 'none';
+      document.getElementById('cusumInputRe').style.display = (val === 'cusum') ? 'block' : 'none';
+      document.getElementById('scanInputRe').style.display = (val === 'scan') ? 'block' : 'none';
     });
     document.getElementById('lam_option_re').addEventListener('change', function(){
       document.getElementById('manualLambdaRe').style.display = (this.value.toLowerCase() === 'manual') ? 'block' : 'none';
@@ -927,5 +3999,119 @@ reanalyze_template = """
 </html>
 """
 
+sites_template = """
+<!DOCTYPE html>
+<html>
+<head>
+  <title>Wastewatch - Sites</title>
+  <style>
+    body { background-color: #e0f7fa; font-family: Arial, sans-serif; margin: 20px; }
+    h1 { text-align: center; }
+    .box { background-color: #fff; padding: 20px; border-radius: 8px; max-width: 1100px; margin: 20px auto; line-height: 1.6; }
+    .options { display: flex; flex-wrap: wrap; gap: 10px 30px; }
+    table { border-collapse: collapse; width: 100%; font-size: 0.9em; }
+    th, td { border-bottom: 1px solid #ddd; padding: 4px 6px; text-align: left; }
+    tr.alarm td { background-color: #ffebee; }
+    tr.alarmed td { background-color: #fff8e1; }
+    .error { color: red; text-align: center; }
+  </style>
+</head>
+<body>
+  <h1>Wastewatch - Sites</h1>
+  {{ nav_bar|safe }}
+  {% if error %}<h2 class="error">{{ error }}</h2>{% endif %}
+  <div class="box">
+    {% if rows is none %}
+    <form method="post" enctype="multipart/form-data">
+      <label><strong>Measurements file</strong> (CSV or Parquet with columns site, date, value):</label><br>
+      <input type="file" name="file" accept=".csv,.parquet,text/csv"><br><br>
+    {% else %}
+    <form method="get" action="{{ url_for('site_table', dataset_id=dataset_id) }}">
+    {% endif %}
+      <div class="options">
+        <div>
+          <label>Analysis Method:</label><br>
+          <select name="analysis_method" id="siteMethod">
+            {% for value, label in [("shewhart", "Shewhart"), ("ewma", "EWMA"), ("mc-ewma", "MC-EWMA"), ("cusum", "CUSUM"), ("scan", "SCAN")] %}
+            <option value="{{ value }}" {% if query and query.get("analysis_method") == value %}selected{% endif %}>{{ label }}</option>
+            {% endfor %}
+          </select>
+        </div>
+        <div>
+          <label>Baseline observations per site:</label><br>
+          <input type="number" name="n_baseline" min="2" value="{{ query.get('n_baseline', '') if query else '' }}" placeholder="30">
+        </div>
+        <div>
+          <label>Sigma multiplier (h for CUSUM):</label><br>
+          <input type="number" step="any" name="sigma_multiplier" value="{{ query.get('sigma_multiplier', '') if query else '' }}" placeholder="3">
+        </div>
+        <div id="siteLambda">
+          <label>Lambda:</label><br>
+          <select name="lam_option">
+            <option value="manual" {% if query and query.get("lam_option") == "manual" %}selected{% endif %}>Manual</option>
+            <option value="optimized" {% if query and query.get("lam_option") == "optimized" %}selected{% endif %}>Optimized per site</option>
+          </select>
+          <input type="number" step="any" name="lambda_val" value="{{ query.get('lambda_val', '') if query else '' }}" placeholder="0.3">
+        </div>
+        <div id="siteCusum">
+          <label>CUSUM k and sides:</label><br>
+          <input type="number" step="any" name="cusum_k" min="0" value="{{ query.get('cusum_k', '') if query else '' }}" placeholder="0.5">
+          <select name="cusum_sides">
+            {% for value, label in [("both", "Two-sided"), ("upper", "Upper"), ("lower", "Lower")] %}
+            <option value="{{ value }}" {% if query and query.get("cusum_sides") == value %}selected{% endif %}>{{ label }}</option>
+            {% endfor %}
+          </select>
+        </div>
+        <div id="siteScan">
+          <label>SCAN windows (observations):</label><br>
+          <input type="text" name="scan_windows" value="{{ query.get('scan_windows', '7, 14, 28') if query else '7, 14, 28' }}">
+        </div>
+      </div><br>
+      <input type="submit" value="{{ 'Upload and Analyze' if rows is none else 'Reanalyze' }}">
+    </form>
+  </div>
+  {% if rows is not none %}
+  <div class="box">
+    <p>
+      {{ rows|length }} sites: {{ counts["alarm"] }} in alarm now, {{ counts["alarmed"] }} alarmed earlier,
+      {{ counts["in control"] }} in control, {{ counts["insufficient data"] }} with too few observations.
+      <a href="{{ url_for('site_table', dataset_id=dataset_id, format='csv', **query) }}">Download CSV</a>
+    </p>
+    <table>
+      <tr><th>Site</th><th>Status</th><th>Observations</th><th>From</th><th>To</th><th>Baseline Mean</th><th>Sigma</th>
+          {% if options.analysis_method in ["ewma", "mc-ewma"] %}<th>λ</th>{% endif %}
+          <th>First Alarm</th><th>Latest Alarm</th><th>Alarms</th><th></th></tr>
+      {% for row in rows %}
+      <tr class="{{ row.status }}">
+        <td>{{ row.site }}</td><td>{{ row.status }}</td><td>{{ row.n_obs }}</td>
+        <td>{{ row.first_date or "" }}</td><td>{{ row.last_date or "" }}</td>
+        <td>{{ "%.3g"|format(row.baseline_mean) if row.status != "insufficient data" else "" }}</td>
+        <td>{{ "%.3g"|format(row.sigma) if row.status != "insufficient data" else "" }}</td>
+        {% if options.analysis_method in ["ewma", "mc-ewma"] %}<td>{{ "%.3f"|format(row["lambda"]) if row.status != "insufficient data" else "" }}</td>{% endif %}
+        <td>{{ row.first_alarm_date or "" }}</td><td>{{ row.last_alarm_date or "" }}</td><td>{{ row.n_alarms }}</td>
+        <td>{% if row.status != "insufficient data" %}<a href="{{ url_for('site_chart', dataset_id=dataset_id, site=row.site_index, **query) }}" target="_blank">Chart</a>{% endif %}</td>
+      </tr>
+      {% endfor %}
+    </table>
+  </div>
+  {% endif %}
+  <script>
+    function toggleSiteOptions() {
+      var val = document.getElementById('siteMethod').value;
+      document.getElementById('siteLambda').style.display = (val === 'ewma' || val === 'mc-ewma') ? 'block' : 'none';
+      document.getElementById('siteCusum').style.display = (val === 'cusum') ? 'block' : 'none';
+      document.getElementById('siteScan').style.display = (val === 'scan') ? 'block' : 'none';
+    }
+    document.getElementById('siteMethod').addEventListener('change', toggleSiteOptions);
+    toggleSiteOptions();
+  </script>
+</body>
+</html>
+"""
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "sweep":
+        sys.exit(sweep_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        sys.exit(bench_main(sys.argv[2:]))
     app.run(debug=True)